@@ -101,9 +101,9 @@ class TestApiMethods(unittest.TestCase):
 		i = 0
 		for v in vals:
 			if i == 0:
-				self.assertEqual(v, '21.6')
+				self.assertEqual(v, 21.6)
 			else:
-				self.assertEqual(v, '21.7')
+				self.assertEqual(v, 21.7)
 			i += 1
 
 		req = requests.put(addr + "/alias?id=42", json=json.dumps("room"))
@@ -7,13 +7,26 @@ import requests
 import sys
 import socket
 import json
+import threading
 import time
 
+try:
+	import websocket
+except ImportError:
+	websocket = None
+
 from utils import *
 
 address = "http://"
 port = "60000"
 
+# entity tags and bodies of last responses of polled addresses
+tagged_responses = {}
+
+# parts of GUI showing settings of valve: key in last settings, key in valve event, GUI element
+SETTINGS_WIDGETS = (("desired", "desired", "des_tmp"), ("comfort", "comfort", "com_tmp"), ("eco", "eco", "eco_tmp"),
+                    ("band", "hysteresis_band", "h_band"), ("kp", "kp", "kp"), ("ki", "ki", "ki"), ("kd", "kd", "kd"))
+
 def is_ipv4(addr):
 	"""
 	Checks if given string is valid IPv4 address.
@@ -55,16 +68,40 @@ def get_valve_list(ids):
 		return list with full names of valves as are shown in gui (ID? <valve_id> (<alias>)
 	"""
 	valves_list = []
+	infos = requests.get(address + "/device/radiator-valve/info?ids=" + ",".join(str(valve) for valve in ids))
+	infos = json.loads(infos.text) if infos.status_code == 200 else {}
 	for valve in ids:
-		alias = requests.get(address + "/device/radiator-valve/alias?id=" + str(valve))
-		if alias.status_code == 200:
-			alias = json.loads(alias.text)
-		else:
-			alias = ''
+		alias = infos[str(valve)]["alias"] if str(valve) in infos else ''
 		valves_list.append("ID: " + str(valve) + " (" + alias + ")")
 	return valves_list
 
 
+def get_tagged(url):
+	"""
+	Performs GET request with entity tag of the previous response, unchanged response is not sent again by server.
+
+	Parameters
+	----------
+	url : str
+		address of request
+	Returns
+	-------
+	int
+		HTTP response code, 304 if response did not change
+	str
+		response body, the previous one if it did not change
+	"""
+	headers = {}
+	if url in tagged_responses:
+		headers["If-None-Match"] = tagged_responses[url][0]
+	req = requests.get(url, headers=headers)
+	if req.status_code == 304 and url in tagged_responses:
+		return 304, tagged_responses[url][1]
+	if req.status_code == 200 and "ETag" in req.headers:
+		tagged_responses[url] = (req.headers["ETag"], req.text)
+	return req.status_code, req.text
+
+
 def get_id_from_text(w):
 	"""
 	Extracts identifier from selected valve in valves list.
@@ -109,7 +146,8 @@ def set_window_info(w, v, info):
 	w["kd"].update(v["kd"])
 
 	info = {"comfort": v["comfort"], "eco": v["eco"], "hourly": v["hourly"], "mode": v["mode"],
-	"heating": v["heating_mode"], "band": v["hysteresis_band"], "kp": v["kp"], "ki": v["ki"], "kd": v["kd"]}
+	"heating": v["heating_mode"], "band": v["hysteresis_band"], "kp": v["kp"], "ki": v["ki"], "kd": v["kd"],
+	"desired": v["desired"], "current": v["current"]}
 
 	return info
 
@@ -213,6 +251,166 @@ def draw_graph_lines(g, w):
 			            ((times[i] - start_time) / 720 - 2, int(tmps[i] * 10) - 100), color="red", width=2)
 
 
+def update_valve_list(w, valves_list, selected):
+	"""
+	Sets valves list shown in GUI and keeps the previously selected valve selected.
+
+	Parameters
+	----------
+	w : sg.Window
+		PySimpleGUI Window instance of used window
+	valves_list : list
+		full names of valves as are shown in gui
+	selected : list
+		full names of valves selected before the change
+	"""
+	if selected:
+		old_id = selected[0].split(' ', 2)[1]
+		new_id = None
+		for i in range(0, len(valves_list)):
+			if old_id == valves_list[i].split(' ', 2)[1]:
+				new_id = i
+				break
+		w["valves"].update(valves_list)
+		w["valves"].update(set_to_index=new_id) if new_id is not None else None
+	else:
+		w["valves"].update(valves_list)
+
+
+def set_changed_info(w, settings, info, change):
+	"""
+	Sets only parts of GUI whose values differ from last settings of selected valve.
+
+	Parameters
+	----------
+	w : sg.Window
+		PySimpleGUI Window instance of used window
+	settings : dict
+		settings of valve from valve event
+	info : dict
+		dictionary with last valid values of valve settings
+	change : boolean
+		True if settings were changed in GUI and not yet sent, then only desired temperature is set
+	Returns
+	-------
+	dict
+		dictionary with last valid values of valve settings
+	"""
+	for key, name, widget in SETTINGS_WIDGETS if not change else SETTINGS_WIDGETS[:1]:
+		if info.get(key) != settings[name]:
+			w[widget].update(settings[name])
+			info[key] = settings[name]
+	if info.get("mode") != settings["mode"]:
+		w["mode"].update(set_to_index=int(settings["mode"]))
+		info["mode"] = settings["mode"]
+	if not change and info.get("heating") != settings["heating_mode"]:
+		w["heating_mode"].update(set_to_index=int(settings["heating_mode"]))
+		info["heating"] = settings["heating_mode"]
+	return info
+
+
+def apply_event(w, e, values, info, change, g):
+	"""
+	Shows valve event received from server, only parts of GUI affected by the event are updated.
+
+	Parameters
+	----------
+	w : sg.Window
+		PySimpleGUI Window instance of used window
+	e : dict
+		the valve event
+	values : dict
+		dictionary of value of all GUI parts
+	info : dict
+		dictionary with last valid values of settings of selected valve
+	change : boolean
+		True if settings were changed in GUI and not yet sent
+	g : sg.Graph
+		graph of temperatures of selected valve
+	Returns
+	-------
+	dict
+		dictionary with last valid values of settings of selected valve
+	"""
+	valves_list = w["valves"].get_list_values()
+	selected = w["valves"].get()
+	name = "ID: " + e["id"] + " ("
+	if e["type"] == "added":
+		update_valve_list(w, valves_list + [name + ")"], selected)
+		return info
+	if e["type"] == "removed":
+		update_valve_list(w, [v for v in valves_list if not v.startswith(name)], selected)
+		return info
+
+	if e["type"] == "changed":
+		label = name + e["settings"]["alias"] + ")"
+		if label not in valves_list:
+			update_valve_list(w, [label if v.startswith(name) else v for v in valves_list], selected)
+
+	if not selected or not selected[0].startswith(name):
+		return info
+
+	if e["type"] == "temperature":
+		if info.get("current") != e["current"]:
+			w["cur_tmp"].update(e["current"])
+			info["current"] = e["current"]
+		if info.get("desired") != e["desired"]:
+			w["des_tmp"].update(e["desired"])
+			info["desired"] = e["desired"]
+		if values["valve_tab"] == "valve_graph":
+			draw_graph_lines(g, w)
+		return info
+
+	info = set_changed_info(w, e["settings"], info, change)
+	if e["request"] in ["PUT_TIMETMP", "PUT_WEEKTMP"] and values["day_change"] in ["Mon", "Tue", "Wed", "Thu", "Fri",
+			"Sat", "Sun"] and values["hour_change"] in [h for h in range(0, 24)]:
+		req = requests.get(
+			address + "/device/radiator-valve/temperature/hourly?id=" + e["id"] + "&day=" +
+			str(get_day_index(values["day_change"])) + "&hour=" + str(values["hour_change"]))
+		if req.status_code == 200:
+			w["time_tmp"].update(json.loads(req.text))
+	return info
+
+
+def listen_events(w, stopped):
+	"""
+	Receives valve events from server through websocket and passes them to event loop of GUI.
+	 Lost connection is reconnected, while it is lost GUI polls the server.
+
+	Parameters
+	----------
+	w : sg.Window
+		PySimpleGUI Window instance of used window
+	stopped : threading.Event
+		set when GUI is closed
+	"""
+	url = "ws" + address[len("http"):] + "/device/radiator-valve/events"
+	delay = 1
+	while not stopped.is_set():
+		try:
+			connection = websocket.create_connection(url)
+		except (OSError, websocket.WebSocketException):
+			# server without websocket support is asked again only rarely
+			stopped.wait(delay)
+			delay = min(delay * 2, 60)
+			continue
+
+		delay = 1
+		w.write_event_value("events_connected", None)
+		try:
+			while not stopped.is_set():
+				message = connection.recv()
+				if not message:
+					break
+				w.write_event_value("valve_event", json.loads(message))
+		except (OSError, ValueError, websocket.WebSocketException):
+			pass
+		finally:
+			connection.close()
+		if not stopped.is_set():
+			w.write_event_value("events_lost", None)
+
+
 def run():
 	"""
 	Creates elements needed for GUI and runs loop for event handling.
@@ -289,13 +487,20 @@ def run():
 
 	settings_info = {}
 
+	# with websocket connection server sends changes of valves as they happen, so GUI does not poll it
+	live = False
+	stopped = threading.Event()
+	if websocket is not None:
+		threading.Thread(target=listen_events, args=(window, stopped), daemon=True).start()
+
 	# event handling loop
 	while True:
 		# reading event, values of elements (whenever event occurs, timeout is event)
-		event, values = window.read(timeout=5000)
+		event, values = window.read(timeout=10000 if live else 5000)
 
 		# event for closing window (pressing x button on window)
 		if event == sg.WIN_CLOSED:
+			stopped.set()
 			# if changes were made, send them to server before closing window
 			if change and values["valves"]:
 				change_info[get_id_from_text(window)] = {}
@@ -304,14 +509,22 @@ def run():
 				requests.put(address + "/device/radiator-valve", json=change_info)
 			break  # closing window with break
 
+		if event == "events_connected":
+			live = True
+			# changes missed while connection was lost are fetched once
+			time_interval = 0
+		elif event == "events_lost":
+			live = False
+
 		# checking if server is on and getting identifiers of valves in system
-		try:
-			valve_ids = requests.get(address + "/device/radiator-valve")
-		except requests.exceptions.ConnectionError:
-			print("Trying to connect")
-			continue
+		if not live or event == "events_connected":
+			try:
+				valve_ids = get_tagged(address + "/device/radiator-valve")[1]
+			except requests.exceptions.ConnectionError:
+				print("Trying to connect")
+				continue
 
-		valve_ids = json.loads(valve_ids.text)
+			valve_ids = json.loads(valve_ids)
 
 		# time interval when changes should be sent to server, or settings should be requested
 		if time.monotonic() - time_interval > 10:
@@ -324,7 +537,7 @@ def run():
 				change_info = {}
 
 				change = False
-			elif values["valves"]:
+			elif values["valves"] and (not live or event == "events_connected"):
 				if (values["day_change"] not in ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"] or
 					values["hour_change"] not in [h for h in range(0, 24)]):
 					values["day_change"] = "Mon"
@@ -332,11 +545,12 @@ def run():
 					window["day_change"].update("Mon")
 					window["hour_change"].update(0)
 
-				req = requests.get(
+				# unchanged settings are neither sent again by server nor set again in GUI
+				code, text = get_tagged(
 					address + "/device/radiator-valve?id=" + str(get_id_from_text(window)) + "&day=" +
 					str(get_day_index(values["day_change"])) + "&hour=" + str(values["hour_change"]))
-				if req.status_code == 200:
-					valve_info = json.loads(req.text)
+				if code == 200:
+					valve_info = json.loads(text)
 					settings_info = set_window_info(window, valve_info, settings_info)
 
 			elif not values["valves"]:
@@ -348,25 +562,19 @@ def run():
 		# updating shown time
 		window["time"].update(time.strftime("%H:%M"))
 
-		# do if timeout occurred or there is difference between GUIs valves list, and servers valves list
-		if event == "__TIMEOUT__" or valve_ids != [x.split(' ', 2)[1] for x in window["valves"].get_list_values()]:
+		# do if connection of events was made, or without it if timeout occurred or there is difference between
+		# GUIs valves list, and servers valves list
+		if event == "events_connected" or (not live and (event == "__TIMEOUT__" or
+				valve_ids != [x.split(' ', 2)[1] for x in window["valves"].get_list_values()])):
 			print("list are not the same")
 			print(valve_ids)
 			print(values["valves"])
-			valves_list = get_valve_list(valve_ids)
-
-			# setting selected valve to be the same as it was before changing the list
-			if values["valves"]:
-				old_id = values["valves"][0].split(' ', 2)[1]
-				new_id = None
-				for i in range(0, len(valves_list)):
-					if old_id == valves_list[i].split(' ', 2)[1]:
-						new_id = i
-						break
-				window["valves"].update(valves_list)
-				window["valves"].update(set_to_index=new_id) if new_id is not None else None
-			else:
-				window["valves"].update(valves_list)
+			update_valve_list(window, get_valve_list(valve_ids), values["valves"])
+
+		# valve event received from server updates only affected parts of GUI
+		if event == "valve_event":
+			settings_info = apply_event(window, values[event], values, settings_info, change, graph)
+			continue
 
 		# if no valve is selected from list and event is not selection of valve, then continue the loop
 		if valve_selected is None and event != "valves":
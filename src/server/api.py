@@ -1,19 +1,154 @@
 #!/usr/bin/env python3
 
+import atexit
+import logging
+import queue
+import threading
+import time
+
 import flask
 from flask import request
 
 from server import *
+from logs import setup_logging
+from settings import Settings
+from persistence import recover
+from eventBus import QUEUE_SIZE
+from temperatureStore import TemperatureStore
+
+try:
+	from flask_sock import Sock
+except ImportError:
+	Sock = None
+
+api = flask.Blueprint("api", __name__)
+sock = Sock() if Sock is not None else None
+logger = logging.getLogger("dtrv.api")
+
+
+def create_app(settings=None):
+	"""
+	Creates Flask application serving valve API with its own server state.
+
+	Parameters
+	----------
+	settings : Settings
+		server settings, read from environment if None
+	Returns
+	-------
+	flask.Flask
+		the application
+	"""
+	settings = Settings() if settings is None else settings
+	setup_logging(settings.log_level, settings.log_sample)
+
+	store = None
+	if settings.store:
+		store = TemperatureStore(settings.store)
+		atexit.register(store.close)
+
+	app = flask.Flask(__name__)
+	app.config["SETTINGS"] = settings
+	app.config["SERVER"] = Server(settings.history_size, store, settings.poll_waiters)
+	if settings.snapshot or settings.journal:
+		atexit.register(recover(app.config["SERVER"], settings))
+	app.register_blueprint(api)
+	if sock is not None:
+		sock.init_app(app)
+	app.before_request(start_timer)
+	app.after_request(record_request)
+	return app
+
+
+def get_server():
+	"""
+	Returns server of application handling current request.
+
+	Returns
+	-------
+	Server
+		the server
+	"""
+	return flask.current_app.config["SERVER"]
 
-app = flask.Flask(__name__)
-server = Server()
+
+def tagged_response(method):
+	"""
+	Handles request by Server method with tagged json response. When request has header If-None-Match
+	 with the current tag, the response is 304 and Server method is not called.
+
+	Parameters
+	----------
+	method : str
+		name of Server method handling request
+	Returns
+	-------
+	flask.Response
+		the response
+	"""
+	server = get_server()
+	etag = server.get_etag(method, request)
+	if etag is not None and request.if_none_match.contains_weak(etag):
+		response = flask.Response(status=304)
+	else:
+		body, code = getattr(server, method)(request)
+		response = flask.jsonify(body)
+		response.status_code = code
+		if code != 200:
+			return response
+	if etag is not None:
+		response.set_etag(etag)
+	return response
+
+
+def start_timer():
+	"""
+	Remembers start of request handling.
+	"""
+	flask.g.start = time.perf_counter()
 
 
-@app.route("/device/radiator-valve", methods=["GET"])
+def record_request(response):
+	"""
+	Records route, response code and duration of handled request to server metrics, and logs
+	 sampled request on DEBUG level.
+
+	Parameters
+	----------
+	response : flask.Response
+		response of request
+	Returns
+	-------
+	flask.Response
+		the same response
+	"""
+	route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+	duration = time.perf_counter() - flask.g.start
+	get_server().metrics.observe_request(request.method, route, response.status_code, duration)
+	if logger.isEnabledFor(logging.DEBUG):
+		logger.debug("request", extra={"sampled": True, "fields": {"method": request.method, "route": route,
+			"args": request.args.to_dict(), "code": response.status_code, "ms": duration * 1000}})
+	return response
+
+
+@api.route("/device/radiator-valve", methods=["GET"])
 def get_info():
 	"""
 	Handles request for valve info.
 
+	Returns
+	-------
+	flask.Response
+		the response message for client in json with entity tag, empty with code 304 if tag matches
+	"""
+	return tagged_response("get_info")
+
+
+@api.route("/device/radiator-valve/info", methods=["GET"])
+def get_infos():
+	"""
+	Handles request for info of all valves, or valves selected by ids argument.
+
 	Returns
 	-------
 	str
@@ -21,11 +156,11 @@ def get_info():
 	int
 		the HTTP response code
 	"""
-	response = server.get_info(request)
+	response = get_server().get_infos(request)
 	return flask.jsonify(response[0]), response[1]
 
 
-@app.route("/device/radiator-valve/temperature", methods=["GET"])
+@api.route("/device/radiator-valve/temperature", methods=["GET"])
 def get_temperature():
 	"""
 	Handles request for valve temperatures.
@@ -37,11 +172,11 @@ def get_temperature():
 	int
 		the HTTP response code
 	"""
-	response = server.get_temperature(request)
+	response = get_server().get_temperature(request)
 	return flask.jsonify(response[0]), response[1]
 
 
-@app.route("/device/radiator-valve/temperature/current", methods=["GET"])
+@api.route("/device/radiator-valve/temperature/current", methods=["GET"])
 def get_current_temperature():
 	"""
 	Handles request for last temperatures posted.
@@ -53,28 +188,24 @@ def get_current_temperature():
 	int
 		the HTTP response code
 	"""
-	response = server.get_current_temperature(request)
+	response = get_server().get_current_temperature(request)
 	return flask.jsonify(response[0]), response[1]
 
 
-@app.route("/device/radiator-valve/temperature/desired", methods=["GET"])
+@api.route("/device/radiator-valve/temperature/desired", methods=["GET"])
 def get_desired_temperature():
 	"""
 	Handles request for valve desired temperature.
 
 	Returns
 	-------
-	str
-		the response message for client in json
-	int
-		the HTTP response code
+	flask.Response
+		the response message for client in json with entity tag, empty with code 304 if tag matches
 	"""
-	response = server.get_desired_temperature(request)
-	print(response[0])
-	return flask.jsonify(response[0]), response[1]
+	return tagged_response("get_desired_temperature")
 
 
-@app.route("/device/radiator-valve/temperature/eco", methods=["GET"])
+@api.route("/device/radiator-valve/temperature/eco", methods=["GET"])
 def get_eco_temperature():
 	"""
 	Handles request for valve eco temperatures.
@@ -86,11 +217,11 @@ def get_eco_temperature():
 	int
 		the HTTP response code
 	"""
-	response = server.get_eco_temperature(request)
+	response = get_server().get_eco_temperature(request)
 	return flask.jsonify(response[0]), response[1]
 
 
-@app.route("/device/radiator-valve/temperature/comfort", methods=["GET"])
+@api.route("/device/radiator-valve/temperature/comfort", methods=["GET"])
 def get_comfort_temperature():
 	"""
 	Handles request for valve comfort temperatures.
@@ -102,11 +233,11 @@ def get_comfort_temperature():
 	int
 		the HTTP response code
 	"""
-	response = server.get_comfort_temperature(request)
+	response = get_server().get_comfort_temperature(request)
 	return flask.jsonify(response[0]), response[1]
 
 
-@app.route("/device/radiator-valve/temperature/hourly", methods=["GET"])
+@api.route("/device/radiator-valve/temperature/hourly", methods=["GET"])
 def get_hour_temperature():
 	"""
 	Handles request for valve time based temperatures.
@@ -118,11 +249,27 @@ def get_hour_temperature():
 	int
 		the HTTP response code
 	"""
-	response = server.get_hour_temperature(request)
+	response = get_server().get_hour_temperature(request)
 	return flask.jsonify(response[0]), response[1]
 
 
-@app.route("/device/radiator-valve/mode/temperature", methods=["GET"])
+@api.route("/device/radiator-valve/temperature/weekly", methods=["GET"])
+def get_week_temperature():
+	"""
+	Handles request for valve week program of whole week or day.
+
+	Returns
+	-------
+	str
+		the response message for client in json
+	int
+		the HTTP response code
+	"""
+	response = get_server().get_week_temperature(request)
+	return flask.jsonify(response[0]), response[1]
+
+
+@api.route("/device/radiator-valve/mode/temperature", methods=["GET"])
 def get_temperature_mode():
 	"""
 	Handles request for valve temperature mode (eco, comfort, time program...).
@@ -134,11 +281,11 @@ def get_temperature_mode():
 	int
 		the HTTP response code
 	"""
-	response = server.get_temperature_mode(request)
+	response = get_server().get_temperature_mode(request)
 	return flask.jsonify(response[0]), response[1]
 
 
-@app.route("/device/radiator-valve/mode/heating", methods=["GET"])
+@api.route("/device/radiator-valve/mode/heating", methods=["GET"])
 def get_heating_mode():
 	"""
 	Handles request for valve heating mode (hysteresis, PID).
@@ -150,15 +297,28 @@ def get_heating_mode():
 	int
 		the HTTP response code
 	"""
-	response = server.get_heating_mode(request)
+	response = get_server().get_heating_mode(request)
 	return flask.jsonify(response[0]), response[1]
 
 
-@app.route("/device/radiator-valve/temperature/currents", methods=["GET"])
+@api.route("/device/radiator-valve/temperature/currents", methods=["GET"])
 def get_current_temperatures():
 	"""
 	Handles request for valve temperature measurements.
 
+	Returns
+	-------
+	flask.Response
+		the response message for client in json with entity tag, empty with code 304 if tag matches
+	"""
+	return tagged_response("get_current_temperatures")
+
+
+@api.route("/device/radiator-valve/temperature/history", methods=["GET"])
+def get_temperature_history():
+	"""
+	Handles request for persisted valve temperature measurements in time range.
+
 	Returns
 	-------
 	str
@@ -166,11 +326,11 @@ def get_current_temperatures():
 	int
 		the HTTP response code
 	"""
-	response = server.get_current_temperatures(request)
+	response = get_server().get_temperature_history(request)
 	return flask.jsonify(response[0]), response[1]
 
 
-@app.route("/device/radiator-valve/alias", methods=["GET"])
+@api.route("/device/radiator-valve/alias", methods=["GET"])
 def get_alias():
 	"""
 	Handles request for valve alias.
@@ -182,11 +342,80 @@ def get_alias():
 	int
 		the HTTP response code
 	"""
-	response = server.get_alias(request)
+	response = get_server().get_alias(request)
 	return flask.jsonify(response[0]), response[1]
 
 
-@app.route("/device/radiator-valve", methods=["POST"])
+@api.route("/device/radiator-valve/fleet/below", methods=["GET"])
+def get_fleet_below():
+	"""
+	Handles request for valves that are colder than desired by more than given difference.
+
+	Returns
+	-------
+	str
+		the response message for client in json
+	int
+		the HTTP response code
+	"""
+	response = get_server().get_fleet_below(request)
+	return flask.jsonify(response[0]), response[1]
+
+
+@api.route("/device/radiator-valve/fleet/stats", methods=["GET"])
+def get_fleet_stats():
+	"""
+	Handles request for mean of valve values grouped by mode.
+
+	Returns
+	-------
+	str
+		the response message for client in json
+	int
+		the HTTP response code
+	"""
+	response = get_server().get_fleet_stats(request)
+	return flask.jsonify(response[0]), response[1]
+
+
+@api.route("/device/radiator-valve/control", methods=["GET"])
+def poll_control():
+	"""
+	Handles long poll of valve head for change of desired temperature, mode or control parameters.
+	 Waiting poll holds thread of server, so only limited number of polls can wait at once.
+
+	Returns
+	-------
+	str
+		the response message for client in json, empty if nothing changed or too many polls wait
+	int
+		the HTTP response code
+	"""
+	response = get_server().poll_control(request)
+	if response[1] == 304:
+		return '', 304
+	if response[1] == 503:
+		return '', 503, {"Retry-After": str(int(POLL_TIMEOUT))}
+	return flask.jsonify(response[0]), response[1]
+
+
+@api.route("/metrics", methods=["GET"])
+def get_metrics():
+	"""
+	Handles request for server metrics.
+
+	Returns
+	-------
+	str
+		the metrics in Prometheus text format
+	int
+		the HTTP response code
+	"""
+	response = get_server().get_metrics(request)
+	return response[0], response[1], {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+
+@api.route("/device/radiator-valve", methods=["POST"])
 def post_new_valve():
 	"""
 	Handles request for valve creation in system.
@@ -198,11 +427,11 @@ def post_new_valve():
 	int
 		the HTTP response code
 	"""
-	response = server.post_new_valve(request)
+	response = get_server().post_new_valve(request)
 	return flask.jsonify(response[0]), response[1]
 
 
-@app.route("/device/radiator-valve", methods=["PUT"])
+@api.route("/device/radiator-valve", methods=["PUT"])
 def put_info():
 	"""
 	Handles request for valves info update.
@@ -214,11 +443,11 @@ def put_info():
 	int
 		the HTTP response code
 	"""
-	response = server.put_info(request)
+	response = get_server().put_info(request)
 	return response[0], response[1]
 
 
-@app.route("/device/radiator-valve/temperature/current", methods=["PUT"])
+@api.route("/device/radiator-valve/temperature/current", methods=["PUT"])
 def put_current_temperature():
 	"""
 	Handles request for valve temperature measurement update.
@@ -230,11 +459,27 @@ def put_current_temperature():
 	int
 		the HTTP response code
 	"""
-	response = server.put_current_temperature(request)
+	response = get_server().put_current_temperature(request)
 	return response[0], response[1]
 
 
-@app.route("/device/radiator-valve/temperature/eco", methods=["PUT"])
+@api.route("/device/radiator-valve/temperature/currents", methods=["PUT"])
+def put_current_temperatures():
+	"""
+	Handles request for batch of temperature measurements of many valves.
+
+	Returns
+	-------
+	str
+		the response message for client in json with status of each valve
+	int
+		the HTTP response code
+	"""
+	response = get_server().put_current_temperatures(request)
+	return flask.jsonify(response[0]), response[1]
+
+
+@api.route("/device/radiator-valve/temperature/eco", methods=["PUT"])
 def put_eco_temperature():
 	"""
 	Handles request for valve eco temperature update.
@@ -246,11 +491,11 @@ def put_eco_temperature():
 	int
 		the HTTP response code
 	"""
-	response = server.put_eco_temperature(request)
+	response = get_server().put_eco_temperature(request)
 	return response[0], response[1]
 
 
-@app.route("/device/radiator-valve/temperature/comfort", methods=["PUT"])
+@api.route("/device/radiator-valve/temperature/comfort", methods=["PUT"])
 def put_comfort_temperature():
 	"""
 	Handles request for valve comfort temperature update.
@@ -262,11 +507,11 @@ def put_comfort_temperature():
 	int
 		the HTTP response code
 	"""
-	response = server.put_comfort_temperature(request)
+	response = get_server().put_comfort_temperature(request)
 	return response[0], response[1]
 
 
-@app.route("/device/radiator-valve/temperature/hourly", methods=["PUT"])
+@api.route("/device/radiator-valve/temperature/hourly", methods=["PUT"])
 def put_hour_temperature():
 	"""
 	Handles request for valve time based temperature update.
@@ -278,11 +523,27 @@ def put_hour_temperature():
 	int
 		the HTTP response code
 	"""
-	response = server.put_hour_temperature(request)
+	response = get_server().put_hour_temperature(request)
 	return response[0], response[1]
 
 
-@app.route("/device/radiator-valve/mode/temperature", methods=["PUT"])
+@api.route("/device/radiator-valve/temperature/weekly", methods=["PUT"])
+def put_week_temperature():
+	"""
+	Handles request for valve week program update of whole week or day.
+
+	Returns
+	-------
+	str
+		empty string
+	int
+		the HTTP response code
+	"""
+	response = get_server().put_week_temperature(request)
+	return response[0], response[1]
+
+
+@api.route("/device/radiator-valve/mode/temperature", methods=["PUT"])
 def put_temperature_mode():
 	"""
 	Handles request for valve temperature mode update.
@@ -294,11 +555,11 @@ def put_temperature_mode():
 	int
 		the HTTP response code
 	"""
-	response = server.put_temperature_mode(request)
+	response = get_server().put_temperature_mode(request)
 	return response[0], response[1]
 
 
-@app.route("/device/radiator-valve/mode/heating", methods=["PUT"])
+@api.route("/device/radiator-valve/mode/heating", methods=["PUT"])
 def put_heating_mode():
 	"""
 	Handles request for valve heating mode update.
@@ -310,11 +571,11 @@ def put_heating_mode():
 	int
 		the HTTP response code
 	"""
-	response = server.put_heating_mode(request)
+	response = get_server().put_heating_mode(request)
 	return response[0], response[1]
 
 
-@app.route("/device/radiator-valve/alias", methods=["PUT"])
+@api.route("/device/radiator-valve/alias", methods=["PUT"])
 def put_alias():
 	"""
 	Handles request for valve alias update.
@@ -326,11 +587,11 @@ def put_alias():
 	int
 		the HTTP response code
 	"""
-	response = server.put_alias(request)
+	response = get_server().put_alias(request)
 	return response[0], response[1]
 
 
-@app.route("/device/radiator-valve", methods=["DELETE"])
+@api.route("/device/radiator-valve", methods=["DELETE"])
 def delete_valve():
 	"""
 	Handles request for valve deletion in system.
@@ -342,8 +603,64 @@ def delete_valve():
 	int
 		the HTTP response code
 	"""
-	response = server.delete_valve(request)
+	response = get_server().delete_valve(request)
 	return response[0], response[1]
 
 
-app.run(host="0.0.0.0", port="60000")
+def valve_events(ws):
+	"""
+	Handles websocket of live client, which receives events of created, deleted and changed valves
+	 and new measurements as they happen. Every connected client holds one thread of the server.
+
+	Parameters
+	----------
+	ws : simple_websocket.Server
+		websocket of client
+	"""
+	events = get_server().events
+	waiting = queue.Queue(QUEUE_SIZE)
+	overflow = threading.Event()
+
+	def subscriber(text):
+		try:
+			waiting.put_nowait(text)
+		except queue.Full:
+			overflow.set()
+
+	events.subscribe(subscriber)
+	try:
+		while ws.connected and not overflow.is_set():
+			try:
+				ws.send(waiting.get(timeout=1.0))
+			except queue.Empty:
+				pass
+	finally:
+		events.unsubscribe(subscriber)
+	if overflow.is_set():
+		ws.close(reason=1008, message="too slow")
+
+
+if sock is not None:
+	sock.route("/device/radiator-valve/events")(valve_events)
+
+
+def serve(app):
+	"""
+	Serves application with waitress if it is installed, otherwise with threaded Flask server.
+
+	Parameters
+	----------
+	app : flask.Flask
+		the application
+	"""
+	settings = app.config["SETTINGS"]
+	try:
+		import waitress
+	except ImportError:
+		app.run(host=settings.host, port=settings.port, threaded=True)
+	else:
+		waitress.serve(app, host=settings.host, port=settings.port, threads=settings.threads)
+
+
+if __name__ == "__main__":
+	serve(create_app())
@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+
+import asyncio
+import json
+import logging
+import time
+
+from aiohttp import web
+
+from server import *
+from logs import setup_logging
+from settings import Settings
+from persistence import recover
+from eventBus import QUEUE_SIZE
+from temperatureStore import TemperatureStore
+from utils import Message, to_number, get_schedule_slot_end
+
+SETTINGS = web.AppKey("settings", Settings)
+SERVER = web.AppKey("server", Server)
+PERSISTENCE = web.AppKey("persistence")
+
+logger = logging.getLogger("dtrv.api")
+
+# routes of valve API: HTTP method, path, Server method handling request,
+# True if response body is json, and True if handling can block on storage
+routes = [
+	("GET", "/device/radiator-valve", "get_info", True, False),
+	("GET", "/device/radiator-valve/info", "get_infos", True, False),
+	("GET", "/device/radiator-valve/temperature", "get_temperature", True, False),
+	("GET", "/device/radiator-valve/temperature/current", "get_current_temperature", True, False),
+	("GET", "/device/radiator-valve/temperature/desired", "get_desired_temperature", True, False),
+	("GET", "/device/radiator-valve/temperature/eco", "get_eco_temperature", True, False),
+	("GET", "/device/radiator-valve/temperature/comfort", "get_comfort_temperature", True, False),
+	("GET", "/device/radiator-valve/temperature/hourly", "get_hour_temperature", True, False),
+	("GET", "/device/radiator-valve/temperature/weekly", "get_week_temperature", True, False),
+	("GET", "/device/radiator-valve/mode/temperature", "get_temperature_mode", True, False),
+	("GET", "/device/radiator-valve/mode/heating", "get_heating_mode", True, False),
+	("GET", "/device/radiator-valve/temperature/currents", "get_current_temperatures", True, False),
+	("GET", "/device/radiator-valve/temperature/history", "get_temperature_history", True, True),
+	("GET", "/device/radiator-valve/alias", "get_alias", True, False),
+	("GET", "/device/radiator-valve/fleet/below", "get_fleet_below", True, False),
+	("GET", "/device/radiator-valve/fleet/stats", "get_fleet_stats", True, False),
+	("GET", "/metrics", "get_metrics", False, False),
+	("POST", "/device/radiator-valve", "post_new_valve", True, False),
+	("PUT", "/device/radiator-valve", "put_info", False, False),
+	("PUT", "/device/radiator-valve/temperature/current", "put_current_temperature", False, False),
+	("PUT", "/device/radiator-valve/temperature/currents", "put_current_temperatures", True, False),
+	("PUT", "/device/radiator-valve/temperature/eco", "put_eco_temperature", False, False),
+	("PUT", "/device/radiator-valve/temperature/comfort", "put_comfort_temperature", False, False),
+	("PUT", "/device/radiator-valve/temperature/hourly", "put_hour_temperature", False, False),
+	("PUT", "/device/radiator-valve/temperature/weekly", "put_week_temperature", False, False),
+	("PUT", "/device/radiator-valve/mode/temperature", "put_temperature_mode", False, False),
+	("PUT", "/device/radiator-valve/mode/heating", "put_heating_mode", False, False),
+	("PUT", "/device/radiator-valve/alias", "put_alias", False, False),
+	("DELETE", "/device/radiator-valve", "delete_valve", False, False),
+]
+
+
+async def read_message(request):
+	"""
+	Reads request arguments and json body.
+
+	Parameters
+	----------
+	request : web.Request
+		aiohttp request
+	Returns
+	-------
+	Message
+		request arguments and decoded body, body is None if request has no json body
+	"""
+	body = None
+	if request.method == "PUT" and request.content_type == "application/json" and request.can_read_body:
+		body = json.loads(await request.text())
+	return Message(request.query, body)
+
+
+def make_handler(method, is_json, blocking):
+	"""
+	Creates aiohttp handler delegating request to Server method. Response of method with entity tag
+	 is tagged, and request with header If-None-Match with the current tag is answered with 304
+	 without calling the method.
+
+	Parameters
+	----------
+	method : str
+		name of Server method handling request
+	is_json : boolean
+		True if response body is encoded as json
+	blocking : boolean
+		True if Server method can block, it is then run in thread pool
+	Returns
+	-------
+	coroutine function
+		the handler
+	"""
+	async def handler(request):
+		try:
+			message = await read_message(request)
+		except ValueError:
+			return web.Response(text='', status=400)
+
+		server = request.app[SERVER]
+		etag = server.get_etag(method, message)
+		if etag is not None and request.if_none_match and any(t.value in (etag, "*") for t in request.if_none_match):
+			response = web.Response(status=304)
+			response.etag = etag
+			return response
+
+		server_method = getattr(server, method)
+		if blocking:
+			response = await asyncio.get_running_loop().run_in_executor(None, server_method, message)
+		else:
+			response = server_method(message)
+
+		if is_json:
+			response = web.json_response(response[0], status=response[1])
+		else:
+			response = web.Response(text=response[0], status=response[1])
+		if etag is not None and response.status == 200:
+			response.etag = etag
+		return response
+
+	return handler
+
+
+async def poll_control(request):
+	"""
+	Handles long poll of valve head for change of desired temperature, mode or control parameters.
+	 The poll waits in event loop, so it does not hold any thread.
+
+	Parameters
+	----------
+	request : web.Request
+		aiohttp request
+	Returns
+	-------
+	web.Response
+		control information in json, empty response with code 304 if nothing changed until timeout
+	"""
+	server = request.app[SERVER]
+	query = request.query
+	timeout = to_number(query.get("timeout", POLL_TIMEOUT))
+	if timeout is None:
+		return web.Response(text='', status=400)
+	timeout = min(max(timeout, 0.0), MAX_POLL_TIMEOUT)
+	check = Message(dict(query, timeout="0"))
+
+	response = server.poll_control(check)
+	valve = server.keeper.get_valves().get(query["id"]) if response[1] == 304 else None
+	if valve is not None:
+		loop = asyncio.get_running_loop()
+		changed = asyncio.Event()
+		watcher = lambda: loop.call_soon_threadsafe(changed.set)
+		valve.watch(watcher)
+		try:
+			deadline = loop.time() + timeout
+			while response[1] == 304:
+				remaining = deadline - loop.time()
+				if remaining <= 0:
+					break
+				try:
+					await asyncio.wait_for(changed.wait(),
+						min(remaining, max(0.0, get_schedule_slot_end() - time.time()) + 0.001))
+				except asyncio.TimeoutError:
+					pass
+				changed.clear()
+				response = server.poll_control(check)
+		finally:
+			valve.unwatch(watcher)
+
+	if response[1] == 304:
+		return web.Response(status=304)
+	return web.json_response(response[0], status=response[1])
+
+
+def offer(queue, text):
+	"""
+	Queues event for websocket client, when client does not keep up, queues None that disconnects it.
+
+	Parameters
+	----------
+	queue : asyncio.Queue
+		events waiting for client
+	text : str
+		event encoded in json
+	"""
+	if queue.qsize() < QUEUE_SIZE:
+		queue.put_nowait(text)
+	elif queue.qsize() == QUEUE_SIZE:
+		queue.put_nowait(None)
+
+
+async def send_events(ws, queue):
+	"""
+	Sends queued events to websocket client.
+
+	Parameters
+	----------
+	ws : web.WebSocketResponse
+		websocket of client
+	queue : asyncio.Queue
+		events waiting for client
+	"""
+	try:
+		while True:
+			text = await queue.get()
+			if text is None:
+				await ws.close(code=1008, message=b"too slow")
+				return
+			await ws.send_str(text)
+	except ConnectionResetError:
+		pass
+
+
+async def valve_events(request):
+	"""
+	Handles websocket of live client, which receives events of created, deleted and changed valves
+	 and new measurements as they happen.
+
+	Parameters
+	----------
+	request : web.Request
+		aiohttp request
+	Returns
+	-------
+	web.WebSocketResponse
+		the websocket
+	"""
+	ws = web.WebSocketResponse(heartbeat=30.0)
+	await ws.prepare(request)
+
+	loop = asyncio.get_running_loop()
+	queue = asyncio.Queue()
+	subscriber = lambda text: loop.call_soon_threadsafe(offer, queue, text)
+	events = request.app[SERVER].events
+	events.subscribe(subscriber)
+	sender = asyncio.ensure_future(send_events(ws, queue))
+	try:
+		async for message in ws:
+			pass
+	finally:
+		events.unsubscribe(subscriber)
+		sender.cancel()
+	return ws
+
+
+@web.middleware
+async def record_request(request, handler):
+	"""
+	Records route, response code and duration of handled request to server metrics, and logs
+	 sampled request on DEBUG level.
+
+	Parameters
+	----------
+	request : web.Request
+		aiohttp request
+	handler : coroutine function
+		handler of request
+	Returns
+	-------
+	web.StreamResponse
+		response of handler
+	"""
+	start = time.perf_counter()
+	code = 500
+	try:
+		response = await handler(request)
+		code = response.status
+	except web.HTTPException as e:
+		code = e.status
+		raise
+	finally:
+		route = request.match_info.route.resource
+		route = route.canonical if route is not None else "unmatched"
+		duration = time.perf_counter() - start
+		request.app[SERVER].metrics.observe_request(request.method, route, code, duration)
+		if logger.isEnabledFor(logging.DEBUG):
+			logger.debug("request", extra={"sampled": True, "fields": {"method": request.method, "route": route,
+				"args": dict(request.query), "code": code, "ms": duration * 1000}})
+	return response
+
+
+async def close_store(app):
+	"""
+	Writes final snapshot, journaled changes and queued measurements of application store on shutdown.
+
+	Parameters
+	----------
+	app : web.Application
+		the application
+	"""
+	if PERSISTENCE in app:
+		await asyncio.get_running_loop().run_in_executor(None, app[PERSISTENCE])
+	store = app[SERVER].store
+	if store is not None:
+		await asyncio.get_running_loop().run_in_executor(None, store.close)
+
+
+def create_app(settings=None):
+	"""
+	Creates asyncio application serving valve API with its own server state.
+
+	Parameters
+	----------
+	settings : Settings
+		server settings, read from environment if None
+	Returns
+	-------
+	web.Application
+		the application
+	"""
+	settings = Settings() if settings is None else settings
+	setup_logging(settings.log_level, settings.log_sample)
+
+	store = None
+	if settings.store:
+		store = TemperatureStore(settings.store)
+
+	app = web.Application(middlewares=[record_request])
+	app[SETTINGS] = settings
+	app[SERVER] = Server(settings.history_size, store)
+	if settings.snapshot or settings.journal:
+		app[PERSISTENCE] = recover(app[SERVER], settings)
+	for http_method, path, method, is_json, blocking in routes:
+		app.router.add_route(http_method, path, make_handler(method, is_json, blocking))
+	app.router.add_get("/device/radiator-valve/control", poll_control)
+	app.router.add_get("/device/radiator-valve/events", valve_events)
+	app.on_cleanup.append(close_store)
+	return app
+
+
+if __name__ == "__main__":
+	application = create_app()
+	web.run_app(application, host=application[SETTINGS].host, port=application[SETTINGS].port)
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+
+import math
+
+# position of fully opened valve, fully closed valve has position 0
+MAX_POSITION = 30
+
+
+class ControlState:
+	"""
+	A class used to represent state of valve control between measurements.
+
+	...
+
+	Attributes
+	----------
+	position : int
+		last computed position of valve (0 - 30)
+	integral : float
+		integral part of PID controller
+	falling : boolean
+		True if hysteresis control lets temperature fall (valve is closed)
+	temperature : float
+		last measured temperature, None before first measurement
+	time : float
+		time of last measurement, None before first measurement
+	"""
+	__slots__ = ("position", "integral", "falling", "temperature", "time")
+
+	def __init__(self):
+		self.position = 0
+		self.integral = 0.0
+		self.falling = True
+		self.temperature = None
+		self.time = None
+
+
+def hysteresis_control(state, tmp, desired, band):
+	"""
+	Calculates position of valve with hysteresis algorithm, valve is opened when temperature falls
+	 under lower limit of the band and closed when temperature exceeds upper limit of the band.
+
+	Parameters
+	----------
+	state : ControlState
+		control state of valve
+	tmp : float
+		measured temperature
+	desired : float
+		desired temperature
+	band : float
+		hysteresis band
+	Returns
+	-------
+	int
+		the new position of valve
+	"""
+	if tmp >= desired + band and not state.falling:
+		state.falling = True
+		return 0
+	elif tmp <= desired - band and state.falling:
+		state.falling = False
+		return MAX_POSITION
+	return state.position
+
+
+def pid_control(state, tmp, desired, kp, ki, kd, minutes):
+	"""
+	Calculates position of valve with PID controller, P = Kp*e + sum(Ki*e_n*dt) + Kd*(t_(n-1) - t_n)/dt,
+	 where e is difference between desired and measured temperature and dt is time between
+	 measurements in minutes. The integral part is kept within range of positions, so it does not
+	 wind up while valve is fully opened or closed.
+
+	Parameters
+	----------
+	state : ControlState
+		control state of valve
+	tmp : float
+		measured temperature
+	desired : float
+		desired temperature
+	kp : float
+		proportional coeficient
+	ki : float
+		integral coeficient
+	kd : float
+		derivative coeficient
+	minutes : float
+		time since last measurement in minutes, None for first measurement
+	Returns
+	-------
+	int
+		the new position of valve
+	"""
+	error = desired - tmp
+	derivative = 0.0
+	if minutes:
+		state.integral = min(MAX_POSITION, max(0.0, state.integral + ki * error * minutes))
+		derivative = kd * (state.temperature - tmp) / minutes
+
+	output = kp * error + state.integral + derivative
+	if not math.isfinite(output):
+		return state.position
+	return min(MAX_POSITION, max(0, int(output + 0.5)))
+
+
+def control(state, valve, tmp, timestamp):
+	"""
+	Calculates position of valve from new measurement with heating algorithm of the valve.
+	 Measurement that is not finite number leaves the state and position unchanged.
+
+	Parameters
+	----------
+	state : ControlState
+		control state of valve
+	valve : ThermostaticValve
+		controlled valve
+	tmp : float
+		measured temperature
+	timestamp : float
+		time of measurement
+	Returns
+	-------
+	int
+		the new position of valve
+	"""
+	if tmp is None or timestamp is None or not (math.isfinite(tmp) and math.isfinite(timestamp)):
+		return state.position
+	desired = valve.get_desired_temperature()
+	if desired is not None:
+		if valve.get_heating_mode() == 0:
+			state.position = hysteresis_control(state, tmp, desired, valve.get_hysteresis_band())
+		else:
+			kp, ki, kd = valve.get_pid_coeficients()
+			minutes = None
+			if state.time is not None and timestamp > state.time:
+				minutes = (timestamp - state.time) / 60.0
+			state.position = pid_control(state, tmp, desired, kp, ki, kd, minutes)
+
+	state.temperature = tmp
+	state.time = timestamp
+	return state.position
+
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+
+import json
+import threading
+
+from valveRegistry import ValveRegistry
+
+# number of events waiting for slow subscriber, after which the subscriber is disconnected
+QUEUE_SIZE = 1000
+
+
+def valve_settings(valve):
+	"""
+	Returns settings of valve shown by GUI, called under lock of the valve.
+
+	Parameters
+	----------
+	valve : ThermostaticValve
+		the valve
+	Returns
+	-------
+	dict
+		temperatures, modes, control parameters and alias of valve
+	"""
+	kp, ki, kd = valve.get_pid_coeficients()
+	return {
+		"comfort": valve.get_comfort_temperature(),
+		"eco": valve.get_eco_temperature(),
+		"desired": valve.get_desired_temperature(),
+		"mode": valve.get_temperature_mode(),
+		"heating_mode": valve.get_heating_mode(),
+		"hysteresis_band": valve.get_hysteresis_band(),
+		"kp": kp,
+		"ki": ki,
+		"kd": kd,
+		"alias": valve.get_alias()
+	}
+
+
+class EventBus:
+	"""
+	A class used to represent publisher of valve events for live clients.
+
+	The bus observes ValveKeeper and turns created, deleted and changed valves and new measurements
+	 into events encoded in json once for all subscribers. Event is json object with type "added",
+	 "removed", "changed" or "temperature" and identifier of valve, changed event contains request
+	 type and settings of valve, temperature event contains measured temperature, time of measurement,
+	 desired temperature and position of valve.
+
+	...
+
+	Attributes
+	----------
+	subscribers : tuple
+		functions called with every encoded event
+	lock : threading.Lock
+		lock held while subscribers are added or removed
+	"""
+	def __init__(self):
+		self.subscribers = ()
+		self.lock = threading.Lock()
+
+	def subscribe(self, subscriber):
+		"""
+		Adds function called with every event encoded in json. The function is called in thread
+		 that changed valve, under lock of the valve, so it must only queue the event.
+
+		Parameters
+		----------
+		subscriber : function
+			function taking encoded event
+		"""
+		with self.lock:
+			self.subscribers = self.subscribers + (subscriber,)
+
+	def unsubscribe(self, subscriber):
+		"""
+		Removes function added by subscribe.
+
+		Parameters
+		----------
+		subscriber : function
+			function taking encoded event
+		"""
+		with self.lock:
+			self.subscribers = tuple(s for s in self.subscribers if s != subscriber)
+
+	def publish(self, event):
+		"""
+		Encodes event and passes it to all subscribers.
+
+		Parameters
+		----------
+		event : dict
+			the event
+		"""
+		text = json.dumps(event, separators=(",", ":"))
+		for subscriber in self.subscribers:
+			subscriber(text)
+
+	def valve_added(self, valve):
+		"""
+		Publishes created valve.
+
+		Parameters
+		----------
+		valve : ThermostaticValve
+			subscribed valve
+		"""
+		if self.subscribers:
+			self.publish({"type": "added", "id": str(ValveRegistry.key(valve.get_id()))})
+
+	def valves_added(self, valves):
+		"""
+		Publishes batch of created valves.
+
+		Parameters
+		----------
+		valves : list
+			subscribed valves
+		"""
+		if self.subscribers:
+			for valve in valves:
+				self.valve_added(valve)
+
+	def valve_removed(self, valve):
+		"""
+		Publishes deleted valve.
+
+		Parameters
+		----------
+		valve : ThermostaticValve
+			unsubscribed valve
+		"""
+		if self.subscribers:
+			self.publish({"type": "removed", "id": str(ValveRegistry.key(valve.get_id()))})
+
+	def valve_changed(self, valve, message_type, args, body):
+		"""
+		Publishes new measurement or changed settings of valve.
+
+		Parameters
+		----------
+		valve : ThermostaticValve
+			changed valve
+		message_type : string
+			identifier of request type
+		args : dict
+			request arguments
+		body : object
+			decoded request body
+		"""
+		if not self.subscribers:
+			return
+		identifier = str(ValveRegistry.key(valve.get_id()))
+		if message_type == "PUT_CURTMP":
+			self.publish({"type": "temperature", "id": identifier, "current": valve.get_current_temperature(),
+				"time": valve.temperatures_time.last(), "desired": valve.get_desired_temperature(),
+				"position": valve.get_valve_position()})
+		else:
+			self.publish({"type": "changed", "id": identifier, "request": message_type, "settings": valve_settings(valve)})
@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+
+import logging
+import threading
+from operator import attrgetter
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+from utils import get_schedule_slot
+from valveRegistry import ValveRegistry
+
+logger = logging.getLogger("dtrv.fleet")
+
+# reads values of row of valve except desired temperature, which is computed, in order of FleetView.columns
+fields = attrgetter("current_temperature", "mode", "heating_mode", "h_band", "kp", "ki", "kd")
+
+
+class FleetView:
+	"""
+	A class used to represent columnar view of subscribed valves for vectorized fleet queries.
+
+	The view observes ValveKeeper, changed valves are only marked and their rows are
+	 refreshed together before the next query. Valve with value that is not a number
+	 is left out of queries until it changes again.
+
+	...
+
+	Attributes
+	----------
+	columns : tuple
+		names of columns of the view
+	data : dict
+		numpy array for each column, indexed by row of valve
+	active : numpy.ndarray
+		True for rows that belong to subscribed valve
+	rows : dict
+		row of each valve keyed by registry key
+	valves : list
+		valve of each row, None for free rows
+	free : list
+		free rows
+	dirty : set
+		registry keys of valves whose row has to be refreshed
+	slot : tuple
+		week program slot desired temperatures were resolved for
+	lock : threading.Lock
+		lock held while view is refreshed or queried
+	"""
+
+	columns = ("current", "mode", "heating_mode", "hysteresis_band", "kp", "ki", "kd", "desired")
+
+	def __init__(self, capacity=1024):
+		"""
+		Parameters
+		-------
+		capacity : int
+			initial number of rows
+		"""
+		if numpy is None:
+			raise RuntimeError("FleetView needs numpy")
+		self.data = {name: numpy.full(capacity, numpy.nan) for name in FleetView.columns}
+		self.active = numpy.zeros(capacity, dtype=bool)
+		self.rows = {}
+		self.valves = [None] * capacity
+		self.free = list(range(capacity - 1, -1, -1))
+		self.dirty = set()
+		self.slot = None
+		self.lock = threading.Lock()
+
+	@staticmethod
+	def available():
+		"""
+		Checks if numpy is installed, so the view can be created.
+
+		Returns
+		-------
+		boolean
+			True if numpy is installed, False otherwise
+		"""
+		return numpy is not None
+
+	def _grow(self):
+		"""
+		Doubles number of rows of the view.
+		"""
+		capacity = len(self.valves)
+		for name in FleetView.columns:
+			self.data[name] = numpy.concatenate((self.data[name], numpy.full(capacity, numpy.nan)))
+		self.active = numpy.concatenate((self.active, numpy.zeros(capacity, dtype=bool)))
+		self.valves.extend([None] * capacity)
+		self.free.extend(range(2 * capacity - 1, capacity - 1, -1))
+
+	def valve_added(self, valve):
+		"""
+		Assigns row to subscribed valve.
+
+		Parameters
+		----------
+		valve : ThermostaticValve
+			subscribed valve
+		"""
+		key = ValveRegistry.key(valve.get_id())
+		with self.lock:
+			if key in self.rows:
+				row = self.rows[key]
+			else:
+				if not self.free:
+					self._grow()
+				row = self.free.pop()
+				self.rows[key] = row
+			self.valves[row] = valve
+			self.active[row] = True
+			self.dirty.add(key)
+
+	def valves_added(self, valves):
+		"""
+		Assigns rows to batch of subscribed valves.
+
+		Parameters
+		----------
+		valves : list
+			subscribed valves
+		"""
+		keys = [ValveRegistry.key(valve.get_id()) for valve in valves]
+		with self.lock:
+			new = [key for key in dict.fromkeys(keys) if key not in self.rows]
+			while len(self.free) < len(new):
+				self._grow()
+			if new:
+				self.rows.update(zip(new, reversed(self.free[-len(new):])))
+				del self.free[-len(new):]
+			rows = [self.rows[key] for key in keys]
+			for row, valve in zip(rows, valves):
+				self.valves[row] = valve
+			self.active[rows] = True
+			self.dirty.update(keys)
+
+	def valve_removed(self, valve):
+		"""
+		Frees row of unsubscribed valve.
+
+		Parameters
+		----------
+		valve : ThermostaticValve
+			unsubscribed valve
+		"""
+		key = ValveRegistry.key(valve.get_id())
+		with self.lock:
+			row = self.rows.pop(key, None)
+			if row is None:
+				return
+			self.valves[row] = None
+			self.active[row] = False
+			for name in FleetView.columns:
+				self.data[name][row] = numpy.nan
+			self.free.append(row)
+			self.dirty.discard(key)
+
+	def valve_changed(self, valve, message_type, args, body):
+		"""
+		Marks row of changed valve to be refreshed.
+
+		Parameters
+		----------
+		valve : ThermostaticValve
+			changed valve
+		message_type : string
+			identifier of request type
+		args : dict
+			request arguments
+		body : object
+			decoded request body
+		"""
+		self.dirty.add(ValveRegistry.key(valve.get_id()))
+
+	def _refresh(self):
+		"""
+		Refreshes rows of changed valves, and desired temperatures of hourly mode valves
+		 when week program slot changed. Called under lock of the view.
+		"""
+		slot = get_schedule_slot()
+		if slot != self.slot:
+			self.slot = slot
+			for row in numpy.flatnonzero(self.active & (self.data["mode"] == 2)):
+				self.dirty.add(ValveRegistry.key(self.valves[row].get_id()))
+
+		rows = []
+		keys = []
+		records = []
+		while self.dirty:
+			key = self.dirty.pop()
+			row = self.rows.get(key)
+			if row is None:
+				continue
+			valve = self.valves[row]
+			try:
+				record = fields(valve) + (valve.get_desired_temperature(),)
+			except (TypeError, ValueError, IndexError):
+				record = None
+			rows.append(row)
+			keys.append(key)
+			records.append(record)
+
+		if rows:
+			try:
+				table = numpy.array(records, dtype=float)
+			except (TypeError, ValueError):
+				table = numpy.array([FleetView._checked(key, record) for key, record in zip(keys, records)])
+			for i, name in enumerate(FleetView.columns):
+				self.data[name][rows] = table[:, i]
+
+	@staticmethod
+	def _checked(key, record):
+		"""
+		Converts values of valve row to numbers, None is converted to NaN. Row with value that
+		 is not a number is logged and all its values are NaN.
+
+		Parameters
+		----------
+		key : int
+			registry key of valve
+		record : tuple
+			values in order of columns, None if they could not be read
+		Returns
+		-------
+		tuple
+			numbers in order of columns
+		"""
+		try:
+			return tuple(numpy.nan if value is None else float(value) for value in record)
+		except (TypeError, ValueError):
+			logger.warning("valve left out of fleet view", extra={"fields": {"valve": str(key)}})
+			return (numpy.nan,) * len(FleetView.columns)
+
+	def below_desired(self, delta=0.0):
+		"""
+		Returns valves whose current temperature is more than delta below desired temperature.
+
+		Parameters
+		----------
+		delta : float
+			difference between desired and current temperature
+		Returns
+		-------
+		list
+			identifiers of valves
+		"""
+		with self.lock:
+			self._refresh()
+			with numpy.errstate(invalid="ignore"):
+				mask = self.active & (self.data["desired"] - self.data["current"] > delta)
+			return [self.valves[row].get_id() for row in numpy.flatnonzero(mask)]
+
+	def mean_by(self, column, by="mode"):
+		"""
+		Returns mean of column for each group of valves with same value in other column.
+		 Valves with unknown value of column are left out.
+
+		Parameters
+		----------
+		column : str
+			name of column to average
+		by : str
+			name of column valves are grouped by
+		Returns
+		-------
+		dict
+			mean of column keyed by value of grouping column
+		"""
+		if column not in FleetView.columns or by not in FleetView.columns:
+			raise KeyError(column if column not in FleetView.columns else by)
+		with self.lock:
+			self._refresh()
+			values = self.data[column]
+			groups = self.data[by]
+			mask = self.active & ~numpy.isnan(values) & ~numpy.isnan(groups)
+			keys, inverse = numpy.unique(groups[mask], return_inverse=True)
+			sums = numpy.bincount(inverse, weights=values[mask], minlength=len(keys))
+			counts = numpy.bincount(inverse, minlength=len(keys))
+			return {int(k) if k.is_integer() else float(k): float(total / count)
+				for k, total, count in zip(keys, sums, counts)}
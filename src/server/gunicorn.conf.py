@@ -0,0 +1,27 @@
+#!/usr/bin/env python3
+
+"""
+Gunicorn configuration, read by gunicorn started in this directory.
+
+Valves are kept in memory of one process, so gunicorn serves them with one worker and more
+ threads, and refuses to start with more workers (the lock taken by wsgi.py does not catch
+ workers forked from preloaded application).
+"""
+
+import os
+
+workers = 1
+threads = int(os.environ.get("DTRV_THREADS", 8))
+
+
+def on_starting(server):
+	"""
+	Stops gunicorn before any worker is started when more workers are configured.
+
+	Parameters
+	----------
+	server : gunicorn.arbiter.Arbiter
+		the gunicorn master
+	"""
+	if server.cfg.workers > 1:
+		raise RuntimeError("valves are kept in memory of one process, run gunicorn with --workers 1 and more --threads")
@@ -0,0 +1,300 @@
+#!/usr/bin/env python3
+
+import json
+import logging
+import os
+import struct
+import threading
+import zlib
+
+from thermostaticValve import ThermostaticValve
+from valveRegistry import ValveRegistry
+
+logger = logging.getLogger("dtrv.journal")
+
+# sequence number, length of payload, crc32 of payload; payload is json list
+# [request type, valve identifier, request arguments, decoded request body]
+RECORD = struct.Struct("<QII")
+
+
+def scan(data):
+	"""
+	Finds valid records in journal data, scanning stops at the first incomplete or damaged record.
+
+	Parameters
+	----------
+	data : bytes
+		content of journal file
+	Returns
+	-------
+	list
+		(sequence number, start of payload, end of payload) tuples
+	int
+		length of the valid part of data
+	"""
+	records = []
+	offset = 0
+	while offset + RECORD.size <= len(data):
+		sequence, length, crc = RECORD.unpack_from(data, offset)
+		start = offset + RECORD.size
+		end = start + length
+		if end > len(data) or zlib.crc32(data[start:end]) != crc:
+			break
+		records.append((sequence, start, end))
+		offset = end
+	return records, offset
+
+
+class Journal:
+	"""
+	A class used to represent write-ahead journal of changes of valves.
+
+	The journal observes ValveKeeper, every change is numbered and queued, and queued changes are
+	 written and synced to disk together every interval, so a request never waits for disk. Changes
+	 of the last interval can be lost by crash. Measured temperatures are not journaled, they are
+	 kept by snapshot and temperature store.
+
+	...
+
+	Attributes
+	----------
+	path : str
+		path to journal file
+	interval : float
+		seconds between writes of queued changes
+	sequence : int
+		sequence number of the last journaled change
+	pending : list
+		encoded changes waiting for write
+	file : file
+		journal file opened for appending
+	lock : threading.Lock
+		lock held while change is numbered and queued
+	write_lock : threading.Lock
+		lock held while queued changes are written
+	stopped : threading.Event
+		set when journal is closed
+	thread : threading.Thread
+		thread writing queued changes
+	"""
+
+	skipped = {"PUT_CURTMP"}
+
+	def __init__(self, path, interval=0.05):
+		self.path = path
+		self.interval = interval
+		self.sequence = 0
+		self.pending = []
+		self.file = None
+		self.lock = threading.Lock()
+		self.write_lock = threading.Lock()
+		self.stopped = threading.Event()
+		self.thread = threading.Thread(target=self._run, daemon=True)
+
+	def read(self):
+		"""
+		Reads journaled changes. Reading stops at the first incomplete or damaged record, which can be
+		 left by crash during write.
+
+		Returns
+		-------
+		list
+			(sequence number, request type, valve identifier, request arguments, decoded request body) tuples
+		int
+			length of the valid part of journal
+		"""
+		if not os.path.exists(self.path):
+			return [], 0
+		with open(self.path, "rb") as f:
+			data = f.read()
+		records, length = scan(data)
+		return [(sequence, *json.loads(data[start:end])) for sequence, start, end in records], length
+
+	def replay(self, server, sequence=0):
+		"""
+		Applies journaled changes newer than snapshot to valves of server, and opens journal for appending.
+		 Damaged end of journal is cut off.
+
+		Parameters
+		----------
+		server : Server
+			server changes are applied to
+		sequence : int
+			sequence number of the last change contained in restored snapshot
+		Returns
+		-------
+		int
+			number of applied changes
+		"""
+		changes, length = self.read()
+		keeper = server.keeper
+		applied = 0
+		for number, message_type, identifier, args, body in changes:
+			self.sequence = max(self.sequence, number)
+			if number <= sequence:
+				continue
+			applied += 1
+			if message_type == "POST":
+				if not keeper.valve_exists(identifier):
+					keeper.subscribe(ThermostaticValve(identifier, server.history_size, server.store))
+			elif message_type == "DELETE":
+				keeper.unsubscribe(identifier)
+			else:
+				valve = keeper.get_valves().get(identifier)
+				handler = ThermostaticValve.get_handler(message_type)
+				if valve is not None and handler is not None:
+					with valve.lock:
+						handler(valve, args, body)
+						keeper.changed(valve, message_type, args, body)
+		self.sequence = max(self.sequence, sequence)
+
+		self.file = open(self.path, "ab")
+		if self.file.tell() != length:
+			logger.warning("damaged end of journal cut off", extra={"fields": {"bytes": self.file.tell() - length}})
+			self.file.truncate(length)
+		logger.info("journal replayed", extra={"fields": {"changes": applied, "sequence": self.sequence}})
+		return applied
+
+	def start(self):
+		"""
+		Starts thread writing queued changes.
+		"""
+		if self.file is None:
+			self.file = open(self.path, "ab")
+		self.thread.start()
+
+	def append(self, message_type, identifier, args, body):
+		"""
+		Numbers change and queues it for write.
+
+		Parameters
+		----------
+		message_type : string
+			identifier of request type, or POST and DELETE for created and deleted valve
+		identifier : str
+			identifier of valve
+		args : dict
+			request arguments
+		body : object
+			decoded request body
+		Returns
+		-------
+		int
+			sequence number of the change
+		"""
+		payload = json.dumps([message_type, identifier, dict(args), body], separators=(",", ":")).encode()
+		with self.lock:
+			self.sequence += 1
+			self.pending.append(RECORD.pack(self.sequence, len(payload), zlib.crc32(payload)) + payload)
+			return self.sequence
+
+	def flush(self):
+		"""
+		Writes queued changes and syncs them to disk.
+		"""
+		with self.write_lock:
+			with self.lock:
+				pending, self.pending = self.pending, []
+			if pending:
+				self.file.write(b''.join(pending))
+				self.file.flush()
+				os.fsync(self.file.fileno())
+
+	def compact(self, sequence):
+		"""
+		Removes changes contained in snapshot from journal.
+
+		Parameters
+		----------
+		sequence : int
+			sequence number of the last change contained in snapshot
+		"""
+		with self.write_lock:
+			with self.lock:
+				pending, self.pending = self.pending, []
+			self.file.write(b''.join(pending))
+			self.file.flush()
+
+			with open(self.path, "rb") as f:
+				data = f.read()
+			records = scan(data)[0]
+			temporary = self.path + ".tmp"
+			with open(temporary, "wb") as t:
+				t.write(b''.join(data[start - RECORD.size:end] for number, start, end in records if number > sequence))
+				t.flush()
+				os.fsync(t.fileno())
+			self.file.close()
+			os.replace(temporary, self.path)
+			self.file = open(self.path, "ab")
+
+	def close(self):
+		"""
+		Stops thread and writes remaining queued changes.
+		"""
+		if self.stopped.is_set():
+			return
+		self.stopped.set()
+		if self.thread.is_alive():
+			self.thread.join()
+		if self.file is not None:
+			self.flush()
+			self.file.close()
+
+	def _run(self):
+		while not self.stopped.wait(self.interval):
+			try:
+				self.flush()
+			except OSError:
+				logger.exception("journal write failed")
+
+	def valve_added(self, valve):
+		"""
+		Journals created valve.
+
+		Parameters
+		----------
+		valve : ThermostaticValve
+			subscribed valve
+		"""
+		self.append("POST", str(ValveRegistry.key(valve.get_id())), {}, None)
+
+	def valves_added(self, valves):
+		"""
+		Journals batch of created valves.
+
+		Parameters
+		----------
+		valves : list
+			subscribed valves
+		"""
+		for valve in valves:
+			self.valve_added(valve)
+
+	def valve_removed(self, valve):
+		"""
+		Journals deleted valve.
+
+		Parameters
+		----------
+		valve : ThermostaticValve
+			unsubscribed valve
+		"""
+		self.append("DELETE", str(ValveRegistry.key(valve.get_id())), {}, None)
+
+	def valve_changed(self, valve, message_type, args, body):
+		"""
+		Journals change of valve made by request.
+
+		Parameters
+		----------
+		valve : ThermostaticValve
+			changed valve
+		message_type : string
+			identifier of request type
+		args : dict
+			request arguments
+		body : object
+			decoded request body
+		"""
+		if message_type not in Journal.skipped:
+			self.append(message_type, str(ValveRegistry.key(valve.get_id())), args, body)
@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+
+"""
+Load test of valve API with emulated swarm of valve heads.
+
+Every head registers itself, then periodically puts measured temperature and polls desired
+ temperature like the NodeMCU firmware does. Without --url the API is started locally in its own
+ process, so the load generator does not compete with the server for the interpreter.
+
+Usage:
+	python3 loadTest.py --heads 2000 --duration 30 --put-interval 5 --get-interval 5
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+
+# seconds the local server has to start accepting connections
+START_TIMEOUT = 10.0
+
+
+def start_server(script):
+	"""
+	Starts API server in subprocess listening on free local port.
+
+	Parameters
+	----------
+	script : str
+		file name of server script next to this file, api.py or asyncApi.py
+	Returns
+	-------
+	subprocess.Popen
+		the server process
+	int
+		port of the server
+	"""
+	with socket.socket() as s:
+		s.bind(("127.0.0.1", 0))
+		port = s.getsockname()[1]
+	env = dict(os.environ, DTRV_HOST="127.0.0.1", DTRV_PORT=str(port), DTRV_LOG_LEVEL="WARNING")
+	directory = os.path.dirname(os.path.abspath(__file__))
+	process = subprocess.Popen([sys.executable, os.path.join(directory, script)], cwd=directory, env=env,
+		stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+	deadline = time.monotonic() + START_TIMEOUT
+	while True:
+		try:
+			socket.create_connection(("127.0.0.1", port), timeout=1.0).close()
+			return process, port
+		except OSError:
+			if process.poll() is not None or time.monotonic() > deadline:
+				process.kill()
+				raise RuntimeError("{} did not start".format(script))
+			time.sleep(0.1)
+
+
+class Statistics:
+	"""
+	A class used to represent latencies of requests of one endpoint.
+
+	...
+
+	Attributes
+	----------
+	latencies : list
+		latencies of successful requests in seconds
+	errors : int
+		number of failed requests
+	"""
+	def __init__(self):
+		self.latencies = []
+		self.errors = 0
+
+	def percentile(self, p):
+		"""
+		Returns percentile of latencies.
+
+		Parameters
+		----------
+		p : float
+			percentile (0 - 100)
+		Returns
+		-------
+		float
+			latency in milliseconds, None if there are no latencies
+		"""
+		if not self.latencies:
+			return None
+		ordered = sorted(self.latencies)
+		return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))] * 1000
+
+	def report(self, duration):
+		"""
+		Returns summary of latencies.
+
+		Parameters
+		----------
+		duration : float
+			length of test in seconds
+		Returns
+		-------
+		dict
+			number of requests, errors, requests per second and p50/p99 latency in milliseconds
+		"""
+		return {"requests": len(self.latencies), "errors": self.errors,
+			"rps": len(self.latencies) / duration, "p50_ms": self.percentile(50), "p99_ms": self.percentile(99)}
+
+
+async def request(host, port, method, path, body=None):
+	"""
+	Sends HTTP request on new connection, as valve heads do.
+
+	Parameters
+	----------
+	host : str
+		server address
+	port : int
+		server port
+	method : str
+		HTTP method
+	path : str
+		requested path with arguments
+	body : str
+		json request body
+	Returns
+	-------
+	int
+		HTTP response code
+	"""
+	reader, writer = await asyncio.open_connection(host, port)
+	try:
+		data = body.encode() if body is not None else b''
+		head = "{} {} HTTP/1.1\r\nHost: {}\r\nConnection: close\r\nContent-Length: {}\r\n".format(
+			method, path, host, len(data))
+		if body is not None:
+			head += "Content-Type: application/json\r\n"
+		writer.write(head.encode() + b"\r\n" + data)
+		await writer.drain()
+		status = await reader.readline()
+		await reader.read()
+		return int(status.split()[1])
+	finally:
+		writer.close()
+
+
+async def head(ident, host, port, stats, end, put_interval, get_interval, limit):
+	"""
+	Emulates one valve head until end of test.
+
+	Parameters
+	----------
+	ident : int
+		identifier of valve
+	host : str
+		server address
+	port : int
+		server port
+	stats : dict
+		Statistics keyed by endpoint
+	end : float
+		time of end of test (time.monotonic)
+	put_interval : float
+		seconds between temperature measurements
+	get_interval : float
+		seconds between desired temperature polls
+	limit : asyncio.Semaphore
+		limit of open connections
+	"""
+	endpoints = {
+		"PUT current": ("PUT", "/device/radiator-valve/temperature/current?id={}".format(ident), put_interval),
+		"GET desired": ("GET", "/device/radiator-valve/temperature/desired?id={}".format(ident), get_interval),
+	}
+	async with limit:
+		await request(host, port, "POST", "/device/radiator-valve?id={}".format(ident))
+
+	due = {name: time.monotonic() + random.uniform(0, e[2]) for name, e in endpoints.items()}
+	while True:
+		name = min(due, key=due.get)
+		if due[name] >= end:
+			return
+		await asyncio.sleep(max(0.0, due[name] - time.monotonic()))
+		method, path, interval = endpoints[name]
+		body = json.dumps("{:.2f}".format(random.uniform(18.0, 23.0))) if method == "PUT" else None
+
+		try:
+			async with limit:
+				start = time.monotonic()
+				code = await request(host, port, method, path, body)
+		except OSError:
+			code = None
+		if code == 200:
+			stats[name].latencies.append(time.monotonic() - start)
+		else:
+			stats[name].errors += 1
+		due[name] += interval
+
+
+async def run(host, port, heads, duration, put_interval, get_interval, connections):
+	"""
+	Runs swarm of valve heads against server.
+
+	Parameters
+	----------
+	host : str
+		server address
+	port : int
+		server port
+	heads : int
+		number of emulated heads
+	duration : float
+		length of test in seconds
+	put_interval : float
+		seconds between temperature measurements of one head
+	get_interval : float
+		seconds between desired temperature polls of one head
+	connections : int
+		maximal number of open connections
+	Returns
+	-------
+	dict
+		summary of latencies keyed by endpoint
+	"""
+	stats = {"PUT current": Statistics(), "GET desired": Statistics()}
+	limit = asyncio.Semaphore(connections)
+	end = time.monotonic() + duration
+	await asyncio.gather(*(head(i, host, port, stats, end, put_interval, get_interval, limit)
+		for i in range(1, heads + 1)))
+	return {name: s.report(duration) for name, s in stats.items()}
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Load test of valve API with emulated valve heads.")
+	parser.add_argument("--url", help="host:port of running server, local server is started if not given")
+	parser.add_argument("--asyncio", action="store_true", help="start local asyncio server instead of Flask one")
+	parser.add_argument("--heads", type=int, default=500, help="number of emulated valve heads")
+	parser.add_argument("--duration", type=float, default=20.0, help="length of test in seconds")
+	parser.add_argument("--put-interval", type=float, default=5.0, help="seconds between temperature puts of head")
+	parser.add_argument("--get-interval", type=float, default=5.0, help="seconds between desired temperature polls")
+	parser.add_argument("--connections", type=int, default=64, help="maximal number of open connections")
+	parser.add_argument("--output", help="file the results are written to as json")
+	a = parser.parse_args()
+
+	local = None
+	if a.url is None:
+		local, port = start_server("asyncApi.py" if a.asyncio else "api.py")
+		host = "127.0.0.1"
+	else:
+		host, port = a.url.rsplit(":", 1)
+		port = int(port)
+
+	try:
+		results = asyncio.run(run(host, port, a.heads, a.duration, a.put_interval, a.get_interval, a.connections))
+	finally:
+		if local is not None:
+			local.terminate()
+			local.wait()
+
+	for name, r in results.items():
+		print("{}: {requests} requests, {errors} errors, {rps:.0f} req/s, p50 {p50} ms, p99 {p99} ms".format(
+			name, p50="-" if r["p50_ms"] is None else "{:.1f}".format(r["p50_ms"]),
+			p99="-" if r["p99_ms"] is None else "{:.1f}".format(r["p99_ms"]), **r))
+	if a.output:
+		with open(a.output, "w") as f:
+			json.dump(results, f, indent=2)
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+import atexit
+import json
+import logging
+import queue
+import random
+from logging.handlers import QueueHandler, QueueListener
+
+# listener writing records of server loggers, None before logging is set up
+listener = None
+
+
+class JsonFormatter(logging.Formatter):
+	"""
+	A class used to represent formatter writing log records as one line json objects.
+
+	Fields given in extra={"fields": {...}} are added to the object.
+	"""
+	def format(self, record):
+		entry = {"time": record.created, "level": record.levelname, "logger": record.name,
+			"message": record.getMessage()}
+		entry.update(getattr(record, "fields", {}))
+		return json.dumps(entry, default=str)
+
+
+class SamplingFilter(logging.Filter):
+	"""
+	A class used to represent filter that passes only part of records marked with extra={"sampled": True},
+	 so logging of high rate requests costs little. Other records pass always.
+
+	...
+
+	Attributes
+	----------
+	rate : float
+		share of passed sampled records (0 - 1)
+	"""
+	def __init__(self, rate=1.0):
+		super().__init__()
+		self.rate = rate
+
+	def filter(self, record):
+		return not getattr(record, "sampled", False) or random.random() < self.rate
+
+
+def setup_logging(level="INFO", sample_rate=1.0, stream=None):
+	"""
+	Sets up loggers of server (dtrv.*) to pass records through queue to thread writing them,
+	 so request handling never waits for console. Previous setup is replaced.
+
+	Parameters
+	----------
+	level : str
+		the lowest level of logged records
+	sample_rate : float
+		share of logged records of sampled requests (0 - 1)
+	stream : file
+		stream records are written to, sys.stderr if None
+	Returns
+	-------
+	QueueListener
+		the listener writing records
+	"""
+	global listener
+	if listener is not None:
+		listener.stop()
+	else:
+		atexit.register(stop_logging)
+
+	records = queue.SimpleQueue()
+	handler = logging.StreamHandler(stream)
+	handler.setFormatter(JsonFormatter())
+	queue_handler = QueueHandler(records)
+	queue_handler.addFilter(SamplingFilter(sample_rate))
+
+	logger = logging.getLogger("dtrv")
+	logger.setLevel(level)
+	logger.handlers = [queue_handler]
+	logger.propagate = False
+
+	listener = QueueListener(records, handler)
+	listener.start()
+	return listener
+
+
+def stop_logging():
+	"""
+	Writes queued records and stops thread writing them.
+	"""
+	global listener
+	if listener is not None:
+		listener.stop()
+		listener = None
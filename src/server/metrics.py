@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+
+import threading
+import weakref
+from bisect import bisect_left
+
+
+class Sharded:
+	"""
+	A class used to represent values counted in separate shard of every thread, so counting needs
+	 no lock. Shards of finished threads are merged into retired values.
+
+	...
+
+	Attributes
+	----------
+	size : int
+		number of values in shard
+	local : threading.local
+		shard of current thread
+	shards : list
+		shards of running threads
+	retired : list
+		sums of shards of finished threads
+	lock : threading.Lock
+		lock held while shard is added, retired or collected
+	"""
+	def __init__(self, size):
+		self.size = size
+		self.local = threading.local()
+		self.shards = []
+		self.retired = [0] * size
+		self.lock = threading.Lock()
+
+	def shard(self):
+		"""
+		Returns shard of current thread, creates it with the first use in thread.
+
+		Returns
+		-------
+		list
+			values counted by current thread
+		"""
+		try:
+			return self.local.shard
+		except AttributeError:
+			shard = self.local.shard = [0] * self.size
+			with self.lock:
+				self.shards.append(shard)
+			weakref.finalize(threading.current_thread(), self._retire, shard)
+			return shard
+
+	def _retire(self, shard):
+		"""
+		Merges shard of finished thread into retired values.
+
+		Parameters
+		----------
+		shard : list
+			shard of finished thread
+		"""
+		with self.lock:
+			self.shards.remove(shard)
+			for i, value in enumerate(shard):
+				self.retired[i] += value
+
+	def collect(self):
+		"""
+		Returns sums of values of all threads.
+
+		Returns
+		-------
+		list
+			summed values
+		"""
+		with self.lock:
+			values = list(self.retired)
+			for shard in self.shards:
+				for i, value in enumerate(shard):
+					values[i] += value
+		return values
+
+
+class Counter(Sharded):
+	"""
+	A class used to represent monotonically increasing counter.
+	"""
+	def __init__(self):
+		super().__init__(1)
+
+	def inc(self, amount=1):
+		"""
+		Increases counter.
+
+		Parameters
+		----------
+		amount : int
+			increment
+		"""
+		self.shard()[0] += amount
+
+	def value(self):
+		"""
+		Returns value of counter.
+
+		Returns
+		-------
+		int
+			the value
+		"""
+		return self.collect()[0]
+
+
+class Histogram(Sharded):
+	"""
+	A class used to represent histogram of observed values with fixed buckets.
+
+	...
+
+	Attributes
+	----------
+	buckets : tuple
+		sorted upper bounds of buckets, values above the last bound are counted in +Inf bucket
+	"""
+	def __init__(self, buckets):
+		self.buckets = tuple(buckets)
+		# count of each bucket, +Inf bucket and sum of observed values
+		super().__init__(len(self.buckets) + 2)
+
+	def observe(self, value):
+		"""
+		Counts observed value in its bucket.
+
+		Parameters
+		----------
+		value : float
+			observed value
+		"""
+		shard = self.shard()
+		shard[bisect_left(self.buckets, value)] += 1
+		shard[-1] += value
+
+	def render(self, name, labels=""):
+		"""
+		Returns histogram in Prometheus text format.
+
+		Parameters
+		----------
+		name : str
+			name of metric
+		labels : str
+			formatted labels of histogram without braces
+		Returns
+		-------
+		list
+			lines of cumulative buckets, sum and count
+		"""
+		values = self.collect()
+		separator = "," if labels else ""
+		lines = []
+		total = 0
+		for bound, count in zip(self.buckets + ("+Inf",), values):
+			total += count
+			lines.append('{}_bucket{{{}{}le="{}"}} {}'.format(name, labels, separator, bound, total))
+		suffix = "{{{}}}".format(labels) if labels else ""
+		lines.append("{}_sum{} {}".format(name, suffix, values[-1]))
+		lines.append("{}_count{} {}".format(name, suffix, total))
+		return lines
+
+
+class Metrics:
+	"""
+	A class used to represent request metrics of server exposed in Prometheus text format.
+
+	...
+
+	Attributes
+	----------
+	requests : dict
+		Counter of requests keyed by HTTP method, route and response code
+	latency : dict
+		Histogram of request durations in seconds keyed by HTTP method and route
+	fanout : Histogram
+		numbers of valves single request was delivered to
+	lock : threading.Lock
+		lock held while counter or histogram of new route is created
+	"""
+
+	latency_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+	fanout_buckets = (0, 1, 10, 100, 1000, 10000, 100000)
+
+	def __init__(self):
+		self.requests = {}
+		self.latency = {}
+		self.fanout = Histogram(Metrics.fanout_buckets)
+		self.lock = threading.Lock()
+
+	def observe_request(self, method, route, code, seconds):
+		"""
+		Records handled request.
+
+		Parameters
+		----------
+		method : str
+			HTTP method
+		route : str
+			route rule that handled request
+		code : int
+			HTTP response code
+		seconds : float
+			duration of request handling
+		"""
+		counter = self.requests.get((method, route, code))
+		if counter is None:
+			with self.lock:
+				counter = self.requests.setdefault((method, route, code), Counter())
+		counter.inc()
+
+		histogram = self.latency.get((method, route))
+		if histogram is None:
+			with self.lock:
+				histogram = self.latency.setdefault((method, route), Histogram(Metrics.latency_buckets))
+		histogram.observe(seconds)
+
+	def observe_fanout(self, valves):
+		"""
+		Records number of valves request was delivered to.
+
+		Parameters
+		----------
+		valves : int
+			number of valves
+		"""
+		self.fanout.observe(valves)
+
+	def render(self, valves):
+		"""
+		Returns all metrics in Prometheus text format, gauges of subscribed valves are computed now.
+
+		Parameters
+		----------
+		valves : ValveRegistry
+			subscribed valves
+		Returns
+		-------
+		str
+			the metrics
+		"""
+		with self.lock:
+			requests = sorted(self.requests.items())
+			latency = sorted(self.latency.items())
+
+		lines = ["# HELP valve_requests_total Handled HTTP requests.", "# TYPE valve_requests_total counter"]
+		for (method, route, code), counter in requests:
+			lines.append('valve_requests_total{{method="{}",route="{}",code="{}"}} {}'.format(
+				method, route, code, counter.value()))
+
+		lines += ["# HELP valve_request_duration_seconds Duration of HTTP request handling.",
+			"# TYPE valve_request_duration_seconds histogram"]
+		for (method, route), histogram in latency:
+			lines += histogram.render("valve_request_duration_seconds", 'method="{}",route="{}"'.format(method, route))
+
+		lines += ["# HELP valve_fire_fanout Number of valves single request was delivered to.",
+			"# TYPE valve_fire_fanout histogram"]
+		lines += self.fanout.render("valve_fire_fanout")
+
+		count = 0
+		fill = 0.0
+		full = 0
+		for valve in valves:
+			size, capacity = valve.get_history_fill()
+			count += 1
+			fill += size / capacity
+			if size == capacity:
+				full += 1
+		lines += ["# HELP valve_registry_size Number of subscribed valves.", "# TYPE valve_registry_size gauge",
+			"valve_registry_size {}".format(count),
+			"# HELP valve_history_fill_ratio Mean fill of temperature history of valves.",
+			"# TYPE valve_history_fill_ratio gauge",
+			"valve_history_fill_ratio {}".format(fill / count if count else 0.0),
+			"# HELP valve_history_full Number of valves with full temperature history.",
+			"# TYPE valve_history_full gauge",
+			"valve_history_full {}".format(full)]
+		return "\n".join(lines) + "\n"
@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+
+from journal import Journal
+from snapshot import SnapshotWriter, restore
+
+
+def recover(server, settings):
+	"""
+	Restores valves of server from snapshot and journal, and starts persisting their changes
+	 as configured by settings.
+
+	Parameters
+	----------
+	server : Server
+		the server
+	settings : Settings
+		server settings with paths to snapshot and journal
+	Returns
+	-------
+	function
+		function without arguments that writes the final snapshot and closes journal
+	"""
+	sequence = 0
+	if settings.snapshot:
+		sequence = restore(server, settings.snapshot)
+
+	journal = None
+	if settings.journal:
+		journal = Journal(settings.journal, settings.journal_interval)
+		journal.replay(server, sequence)
+		server.keeper.observe(journal)
+		journal.start()
+
+	writer = None
+	if settings.snapshot:
+		writer = SnapshotWriter(settings.snapshot, server.keeper, settings.snapshot_interval, journal)
+		writer.start()
+
+	def close():
+		# queued changes are written to journal even when the final snapshot fails
+		try:
+			if writer is not None:
+				writer.stop()
+		finally:
+			if journal is not None:
+				journal.close()
+
+	return close
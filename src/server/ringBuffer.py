@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+
+from array import array
+
+
+class RingBuffer:
+	"""
+	A class used to represent fixed capacity circular buffer of floats.
+
+	...
+
+	Attributes
+	----------
+	values : array
+		storage of buffered values, allocated with the first appended value
+	capacity : int
+		maximal number of stored values
+	start : int
+		index of the oldest stored value
+	size : int
+		number of stored values (up to capacity)
+	"""
+	__slots__ = ("values", "capacity", "start", "size")
+
+	def __init__(self, capacity):
+		"""
+		Parameters
+		-------
+		capacity : int
+			maximal number of stored values, oldest value is overwritten when exceeded
+		"""
+		if capacity < 1:
+			raise ValueError("capacity must be positive")
+		self.values = None
+		self.capacity = capacity
+		self.start = 0
+		self.size = 0
+
+	def get_capacity(self):
+		"""
+		Returns maximal number of stored values.
+
+		Returns
+		-------
+		int
+			capacity of buffer
+		"""
+		return self.capacity
+
+	def append(self, value):
+		"""
+		Appends value to the buffer, overwrites the oldest value if buffer is full.
+
+		Parameters
+		----------
+		value : float
+			value to be appended
+		"""
+		capacity = self.capacity
+		if self.values is None:
+			self.values = array('d', bytes(8 * capacity))
+		if self.size < capacity:
+			self.values[(self.start + self.size) % capacity] = value
+			self.size += 1
+		else:
+			self.values[self.start] = value
+			self.start = (self.start + 1) % capacity
+
+	def last(self):
+		"""
+		Returns the newest value in buffer.
+
+		Returns
+		-------
+		float
+			the newest value, None if buffer is empty
+		"""
+		if self.size == 0:
+			return None
+		return self.values[(self.start + self.size - 1) % self.capacity]
+
+	def snapshot(self):
+		"""
+		Returns stored values ordered from the oldest.
+
+		Returns
+		-------
+		list
+			stored values
+		"""
+		if self.size == 0:
+			return []
+		capacity = self.capacity
+		end = self.start + self.size
+		if end <= capacity:
+			return self.values[self.start:end].tolist()
+		return self.values[self.start:].tolist() + self.values[:end - capacity].tolist()
+
+	def dump(self):
+		"""
+		Returns stored values ordered from the oldest as array.
+
+		Returns
+		-------
+		array
+			stored values
+		"""
+		if self.size == 0:
+			return array('d')
+		capacity = self.capacity
+		end = self.start + self.size
+		if end <= capacity:
+			return self.values[self.start:end]
+		return self.values[self.start:] + self.values[:end - capacity]
+
+	def load(self, values):
+		"""
+		Replaces stored values, only the newest values are kept if there are more values than capacity.
+
+		Parameters
+		----------
+		values : array
+			values ordered from the oldest, the array is taken over by the buffer
+		"""
+		capacity = self.capacity
+		if len(values) > capacity:
+			values = values[-capacity:]
+		self.start = 0
+		self.size = len(values)
+		self.values = None
+		if self.size:
+			if self.size < capacity:
+				values.frombytes(bytes(8 * (capacity - self.size)))
+			self.values = values
+
+	def __len__(self):
+		return self.size
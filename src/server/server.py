@@ -1,5 +1,20 @@
+import logging
+import threading
+import time
+
 from valveKeeper import *
 from thermostaticValve import *
+from valveRegistry import ValveRegistry
+from utils import Message, load_json, is_float, to_number, get_schedule_slot, get_schedule_slot_end
+from fleetView import FleetView
+from metrics import Metrics
+from eventBus import EventBus
+
+logger = logging.getLogger("dtrv.server")
+
+# default and maximal time in seconds a poll waits for change of valve control
+POLL_TIMEOUT = 30.0
+MAX_POLL_TIMEOUT = 300.0
 
 class Server:
 	"""
@@ -11,9 +26,48 @@ class Server:
 	----------
 	keeper : ValveKeeper
 		publisher to which server sends updates
+	history_size : int
+		number of measured temperatures kept for each valve
+	store : TemperatureStore
+		persistent store of measured temperatures, None if history is not persisted
+	fleet : FleetView
+		columnar view of valves for fleet queries, None if numpy is not installed
+	metrics : Metrics
+		request metrics of server
+	events : EventBus
+		publisher of valve events for live clients
+	epoch : str
+		start time of server in entity tags, so tags of previous run never match
+	pollers : threading.BoundedSemaphore
+		limit of polls waiting in threads for change of valve control, None if not limited
 	"""
-	def __init__(self):
-		self.keeper = ValveKeeper()
+
+	# Server methods whose responses carry entity tag
+	tagged = {"get_info", "get_desired_temperature", "get_current_temperatures"}
+
+	def __init__(self, history_size=40, store=None, pollers=None):
+		"""
+		Parameters
+		-------
+		history_size : int
+			number of measured temperatures kept for each valve
+		store : TemperatureStore
+			persistent store of measured temperatures
+		pollers : int
+			the most polls waiting in threads at once, not limited if None
+		"""
+		self.pollers = None if pollers is None else threading.BoundedSemaphore(pollers)
+		self.epoch = "{:x}".format(time.time_ns())
+		self.metrics = Metrics()
+		self.keeper = ValveKeeper(self.metrics)
+		self.history_size = history_size
+		self.store = store
+		self.events = EventBus()
+		self.keeper.observe(self.events)
+		self.fleet = None
+		if FleetView.available():
+			self.fleet = FleetView()
+			self.keeper.observe(self.fleet)
 
 	def get_info(self, args):
 		"""
@@ -33,10 +87,78 @@ class Server:
 			return_values = self.keeper.fire(args, "GET_INFO")
 			return return_values
 		else:
-			id_list = []
-			for v in self.keeper.get_valves():
-				id_list.append(v.get_id())
-			return (id_list, 200)
+			return (self.keeper.get_valves().ids(), 200)
+
+	def get_etag(self, method, args):
+		"""
+		Returns entity tag of response of Server method to request. The tag is made of registry generation
+		 for identifiers list and of valve version for valve, with week program slot in time based mode,
+		 so it is read without lock and response need not be created when client has the same tag.
+
+		Parameters
+		----------
+		method : str
+			name of Server method handling request
+		args : request
+			request object with information about request
+		Returns
+		-------
+		str
+			the tag, None if response of method has no tag or there is no such valve
+		"""
+		if method not in Server.tagged:
+			return None
+		if "id" not in args.args:
+			if method != "get_info":
+				return None
+			return "{}-{}".format(self.epoch, self.keeper.get_valves().generation)
+		valve = self.keeper.get_valves().get(args.args["id"])
+		if valve is None:
+			return None
+		version = valve.version
+		if valve.mode == 2:
+			day, hour = get_schedule_slot()
+			return "{}-{}-{}-{}".format(self.epoch, version, day, hour)
+		return "{}-{}".format(self.epoch, version)
+
+	def get_infos(self, args):
+		"""
+		Delegates valve information request for all valves, or for valves given by comma separated
+		 identifiers, to publisher in one pass.
+
+		Parameters
+		----------
+		args : request
+			request object with information about request
+		Returns
+		-------
+		tuple
+			tuple with dictionary of valve information keyed by identifier and HTTP response code,
+			 400 if day or hour is not valid
+		"""
+		slot = None
+		if "day" in args.args and "hour" in args.args:
+			slot = to_mode(args.args["day"], 7), to_mode(args.args["hour"], 24)
+			if None in slot:
+				return '', 400
+
+		if "ids" in args.args:
+			ids = [i for i in args.args["ids"].split(",") if i]
+		else:
+			ids = self.keeper.get_valves().ids()
+
+		messages = []
+		for ident in ids:
+			message_args = {"id": str(ident)}
+			if slot is not None:
+				message_args["day"], message_args["hour"] = slot
+			messages.append((message_args, None))
+
+		infos = {}
+		for (message_args, body), response in zip(messages, self.keeper.fire_many(messages, "GET_INFO")):
+			if response[1] == 200:
+				infos[message_args["id"]] = response[0]
+		return infos, 200
 
 	def get_temperature(self, args):
 		"""
@@ -134,6 +256,22 @@ class Server:
 		return_values = self.keeper.fire(args, "GET_TIMETMP")
 		return return_values
 
+	def get_week_temperature(self, args):
+		"""
+		Delegates week program request (whole week or one day) to publisher, and addes request identifier.
+
+		Parameters
+		----------
+		args : request
+			request object with information about request
+		Returns
+		-------
+		tuple
+			tuple with message body and HTTP response code
+		"""
+		return_values = self.keeper.fire(args, "GET_WEEKTMP")
+		return return_values
+
 	def get_temperature_mode(self, args):
 		"""
 		Delegates temperature mode request to publisher, and addes request identifier.
@@ -182,6 +320,22 @@ class Server:
 		return_values = self.keeper.fire(args, "GET_CURTMPS")
 		return return_values
 
+	def get_temperature_history(self, args):
+		"""
+		Delegates persisted temperatures request to publisher, and addes request identifier.
+
+		Parameters
+		----------
+		args : request
+			request object with information about request
+		Returns
+		-------
+		tuple
+			tuple with message body and HTTP response code
+		"""
+		return_values = self.keeper.fire(args, "GET_HISTORY")
+		return return_values
+
 	def get_alias(self, args):
 		"""
 		Delegates alias request to publisher, and addes request identifier.
@@ -198,6 +352,119 @@ class Server:
 		return_values = self.keeper.fire(args, "GET_ALIAS")
 		return return_values
 
+	def get_fleet_below(self, args):
+		"""
+		Finds valves whose current temperature is more than given difference (argument delta,
+		 0 by default) below desired temperature.
+
+		Parameters
+		----------
+		args : request
+			request object with information about request
+		Returns
+		-------
+		tuple
+			tuple with list of valves identifiers and HTTP response code
+		"""
+		if self.fleet is None:
+			return '', 501
+		delta = args.args["delta"] if "delta" in args.args else 0.0
+		if not is_float(delta):
+			return '', 400
+		return self.fleet.below_desired(float(delta)), 200
+
+	def get_fleet_stats(self, args):
+		"""
+		Computes mean of column (argument column, current temperature by default) for valves grouped
+		 by other column (argument by, temperature mode by default).
+
+		Parameters
+		----------
+		args : request
+			request object with information about request
+		Returns
+		-------
+		tuple
+			tuple with dictionary of means keyed by group and HTTP response code
+		"""
+		if self.fleet is None:
+			return '', 501
+		column = args.args["column"] if "column" in args.args else "current"
+		by = args.args["by"] if "by" in args.args else "mode"
+		try:
+			return self.fleet.mean_by(column, by), 200
+		except KeyError:
+			return '', 400
+
+	def poll_control(self, args):
+		"""
+		Returns desired temperature, mode and control parameters of valve with version token. When
+		 argument version equals the current token, waits at most timeout seconds until some of them
+		 changes, desired temperature of time based mode is checked again when week program slot changes.
+		 Every waiting poll holds its thread, so when limit of waiting polls is reached the poll is refused.
+
+		Parameters
+		----------
+		args : request
+			request object with information about request
+		Returns
+		-------
+		tuple
+			tuple with control information and HTTP response code, 304 if nothing changed until timeout,
+			 503 if too many polls wait
+		"""
+		if "id" not in args.args:
+			return '', 404
+		timeout = POLL_TIMEOUT
+		if "timeout" in args.args:
+			timeout = to_number(args.args["timeout"])
+			if timeout is None:
+				return '', 400
+			timeout = min(max(timeout, 0.0), MAX_POLL_TIMEOUT)
+		version = args.args["version"] if "version" in args.args else None
+		message = Message({"id": args.args["id"]})
+		valve = self.keeper.get_valves().get(args.args["id"])
+		if valve is None:
+			return '', 404
+
+		changed = threading.Event()
+		valve.watch(changed.set)
+		waiting = False
+		try:
+			deadline = time.monotonic() + timeout
+			while True:
+				changed.clear()
+				response = self.keeper.fire(message, "GET_CONTROL")
+				if response[1] != 200 or response[0]["version"] != version:
+					return response
+				remaining = deadline - time.monotonic()
+				if remaining <= 0:
+					return '', 304
+				if not waiting:
+					if self.pollers is not None and not self.pollers.acquire(False):
+						return '', 503
+					waiting = True
+				changed.wait(min(remaining, max(0.0, get_schedule_slot_end() - time.time()) + 0.001))
+		finally:
+			valve.unwatch(changed.set)
+			if waiting and self.pollers is not None:
+				self.pollers.release()
+
+	def get_metrics(self, args):
+		"""
+		Returns request metrics and gauges of subscribed valves in Prometheus text format.
+
+		Parameters
+		----------
+		args : request
+			request object with information about request
+		Returns
+		-------
+		tuple
+			tuple with metrics and HTTP response code
+		"""
+		return self.metrics.render(self.keeper.get_valves()), 200
+
 	def post_new_valve(self, args):
 		"""
 		Creates new ThermostaticValve and adds it to the system.
@@ -212,18 +479,23 @@ class Server:
 			tuple with message body and HTTP response code
 		"""
 		if "id" in args.args:
-			if not self.keeper.valve_exists(args.args["id"]):
-				new_valve = ThermostaticValve(args.args["id"])
-				self.keeper.subscribe(new_valve)
-				return str(new_valve.get_id()), 201
-			else:
-				return '', 200
+			if ValveRegistry.key(args.args["id"]) is None:
+				return '', 400
+			with self.keeper.lock:
+				if not self.keeper.valve_exists(args.args["id"]):
+					new_valve = ThermostaticValve(args.args["id"], self.history_size, self.store)
+					self.keeper.subscribe(new_valve)
+					logger.info("valve created", extra={"fields": {"valve": new_valve.get_id()}})
+					return str(new_valve.get_id()), 201
+				else:
+					return '', 200
 		else:
 			return '', 204
 
 	def put_info(self, args):
 		"""
-		Delegates valve information update request to publisher, and addes request identifier.
+		Decodes valves information update request once, and delegates each valve
+		 its own part of it through publisher.
 
 		Parameters
 		----------
@@ -234,7 +506,20 @@ class Server:
 		tuple
 			tuple with message body and HTTP response code
 		"""
-		return_values = self.keeper.fire(args, "PUT_INFO")
+		if args.json is None:
+			return '', 404
+		try:
+			info = load_json(args.json)
+		except ValueError:
+			return '', 400
+		if not isinstance(info, dict):
+			return '', 400
+
+		if "id" in args.args:
+			ident = args.args["id"]
+			info = {ident: info[ident]} if ident in info else {}
+
+		return_values = self.keeper.fire_each(info, "PUT_INFO")
 		return return_values
 
 	def put_current_temperature(self, args):
@@ -253,6 +538,46 @@ class Server:
 		return_values = self.keeper.fire(args, "PUT_CURTMP")
 		return return_values
 
+	def put_current_temperatures(self, args):
+		"""
+		Delegates batch of current temperature updates for many valves to publisher.
+		Batch is either dictionary {identifier: temperature}, or list of [identifier, time, temperature]
+		 lists, where time can be null for current time.
+
+		Parameters
+		----------
+		args : request
+			request object with information about request
+		Returns
+		-------
+		tuple
+			tuple with dictionary of HTTP response codes for each identifier and HTTP response code
+		"""
+		if args.json is None:
+			return '', 404
+		try:
+			readings = load_json(args.json)
+		except ValueError:
+			return '', 400
+
+		if isinstance(readings, dict):
+			readings = [(ident, None, tmp) for ident, tmp in readings.items()]
+		elif not isinstance(readings, list) or not all(isinstance(r, (list, tuple)) and len(r) == 3 for r in readings):
+			return '', 400
+
+		messages = []
+		for ident, timestamp, tmp in readings:
+			message_args = {"id": str(ident)}
+			if timestamp is not None:
+				message_args["time"] = timestamp
+			messages.append((message_args, tmp))
+
+		status = {}
+		for (message_args, tmp), response in zip(messages, self.keeper.fire_many(messages, "PUT_CURTMP")):
+			if response[1] != 200 or message_args["id"] not in status:
+				status[message_args["id"]] = response[1]
+		return status, 200
+
 	def put_eco_temperature(self, args):
 		"""
 		Delegates eco temperature update request to publisher, and addes request identifier.
@@ -301,6 +626,22 @@ class Server:
 		return_values = self.keeper.fire(args, "PUT_TIMETMP")
 		return return_values
 
+	def put_week_temperature(self, args):
+		"""
+		Delegates week program update request (whole week or one day) to publisher, and addes request identifier.
+
+		Parameters
+		----------
+		args : request
+			request object with information about request
+		Returns
+		-------
+		tuple
+			tuple with message body and HTTP response code
+		"""
+		return_values = self.keeper.fire(args, "PUT_WEEKTMP")
+		return return_values
+
 	def put_temperature_mode(self, args):
 		"""
 		Delegates temperature mode update request to publisher, and addes request identifier.
@@ -364,5 +705,6 @@ class Server:
 		"""
 		if "id" in args.args:
 			self.keeper.unsubscribe(args.args["id"])
+			logger.info("valve deleted", extra={"fields": {"valve": args.args["id"]}})
 			return '', 200
 		return '', 404
\ No newline at end of file
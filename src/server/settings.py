@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+
+import os
+import tempfile
+
+
+class Settings:
+	"""
+	A class used to represent server settings, read from DTRV_* environment variables.
+
+	...
+
+	Attributes
+	----------
+	host : str
+		address the server listens on (DTRV_HOST)
+	port : int
+		port the server listens on (DTRV_PORT)
+	threads : int
+		number of threads handling requests (DTRV_THREADS)
+	poll_waiters : int
+		the most long polls of Flask server waiting in threads at once (DTRV_POLL_WAITERS)
+	history_size : int
+		number of measured temperatures kept for each valve (DTRV_HISTORY_SIZE)
+	store : str
+		path to database with persisted temperatures, None if history is not persisted (DTRV_STORE)
+	snapshot : str
+		path to snapshot file valves are restored from and periodically saved to, None if disabled (DTRV_SNAPSHOT)
+	snapshot_interval : float
+		seconds between snapshots (DTRV_SNAPSHOT_INTERVAL)
+	journal : str
+		path to journal of valve changes, None if changes are not journaled (DTRV_JOURNAL)
+	journal_interval : float
+		seconds between writes of journaled changes to disk (DTRV_JOURNAL_INTERVAL, in milliseconds)
+	log_level : str
+		the lowest level of logged records (DTRV_LOG_LEVEL)
+	log_sample : float
+		share of logged requests when requests are logged on DEBUG level (DTRV_LOG_SAMPLE)
+	lock : str
+		path to file locked by the serving process, so that second worker process fails to start (DTRV_LOCK)
+	"""
+	def __init__(self, environ=None):
+		"""
+		Parameters
+		-------
+		environ : dict
+			environment to read settings from, os.environ if None
+		"""
+		environ = os.environ if environ is None else environ
+
+		self.host = environ.get("DTRV_HOST", "0.0.0.0")
+		self.port = int(environ.get("DTRV_PORT", 60000))
+		self.threads = int(environ.get("DTRV_THREADS", 8))
+		self.poll_waiters = int(environ.get("DTRV_POLL_WAITERS", max(1, self.threads // 2)))
+		self.history_size = int(environ.get("DTRV_HISTORY_SIZE", 40))
+		self.store = environ.get("DTRV_STORE") or None
+		self.snapshot = environ.get("DTRV_SNAPSHOT") or None
+		self.snapshot_interval = float(environ.get("DTRV_SNAPSHOT_INTERVAL", 60.0))
+		self.journal = environ.get("DTRV_JOURNAL") or None
+		self.journal_interval = float(environ.get("DTRV_JOURNAL_INTERVAL", 50)) / 1000
+		self.log_level = environ.get("DTRV_LOG_LEVEL", "INFO").upper()
+		self.log_sample = float(environ.get("DTRV_LOG_SAMPLE", 1.0))
+		self.lock = environ.get("DTRV_LOCK") or os.path.join(tempfile.gettempdir(), "dtrv-{}.lock".format(self.port))
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+
+"""
+Offline simulator of heated rooms controlled by thermostatic valves.
+
+Every room is a first order thermal model heated by radiator with thermal lag. Measured room
+ temperatures are put to valves through ValveKeeper.fire as PUT_CURTMP requests, and positions
+ computed by the server are applied to radiators, so the simulation also measures the server hot path.
+
+Usage:
+	python3 simulator.py --rooms 1000 --hours 24 --band 0.3 --kp 20 --ki 0.05 --kd 0.5
+"""
+
+import argparse
+import json
+import random
+import time
+
+from controlEngine import MAX_POSITION
+from thermostaticValve import ThermostaticValve
+from utils import Message
+from valveKeeper import ValveKeeper
+
+
+class Room:
+	"""
+	A class used to represent simulated room with radiator.
+
+	...
+
+	Attributes
+	----------
+	temperature : float
+		air temperature of room
+	radiator : float
+		heat output of radiator (degrees per minute it adds to the room)
+	heat_max : float
+		heat output of fully opened radiator
+	radiator_lag : float
+		time constant of radiator in minutes
+	loss : float
+		heat loss coeficient (share of temperature difference to outside lost per minute)
+	position : int
+		position of valve
+	"""
+	def __init__(self, temperature, heat_max, radiator_lag, loss):
+		self.temperature = temperature
+		self.radiator = 0.0
+		self.heat_max = heat_max
+		self.radiator_lag = radiator_lag
+		self.loss = loss
+		self.position = 0
+
+	def step(self, minutes, outside):
+		"""
+		Advances room temperature by given time.
+
+		Parameters
+		----------
+		minutes : float
+			length of simulation step in minutes
+		outside : float
+			outside temperature
+		"""
+		target = self.heat_max * self.position / MAX_POSITION
+		self.radiator += minutes / self.radiator_lag * (target - self.radiator)
+		self.temperature += minutes * (self.radiator - self.loss * (self.temperature - outside))
+
+
+def simulate(heating_mode, rooms=100, hours=24.0, step=3.0, desired=21.0, outside=0.0, band=0.1,
+	kp=30.0, ki=0.0, kd=0.0, tolerance=0.5, seed=0):
+	"""
+	Simulates rooms controlled by one heating algorithm and evaluates quality of control.
+
+	Parameters
+	----------
+	heating_mode : int
+		0 for hysteresis, 1 for PID
+	rooms : int
+		number of simulated rooms
+	hours : float
+		simulated time in hours
+	step : float
+		time between measurements in minutes
+	desired : float
+		desired temperature of rooms
+	outside : float
+		outside temperature
+	band : float
+		hysteresis band
+	kp : float
+		proportional coeficient
+	ki : float
+		integral coeficient
+	kd : float
+		derivative coeficient
+	tolerance : float
+		allowed difference from desired temperature of settled room
+	seed : int
+		seed of random room parameters
+	Returns
+	-------
+	dict
+		overshoot, settling time and number of valve actuations averaged over rooms,
+		 and throughput of the simulation
+	"""
+	generator = random.Random(seed)
+	keeper = ValveKeeper()
+	valves = []
+	sim = []
+	for i in range(rooms):
+		valve = ThermostaticValve(str(1000000 + i))
+		valve.set_comfort_temperature(desired)
+		valve.set_heating_mode(heating_mode)
+		valve.set_hysteresis_band(band)
+		valve.set_pid_coeficients(kp, ki, kd)
+		keeper.subscribe(valve)
+		valves.append(valve)
+		sim.append(Room(generator.uniform(15.0, 18.0), generator.uniform(0.12, 0.25),
+			generator.uniform(10.0, 30.0), generator.uniform(0.004, 0.008)))
+
+	steps = int(hours * 60 / step)
+	peaks = [float("-inf")] * rooms
+	reached = [False] * rooms
+	settled = [None] * rooms
+	actuations = [0] * rooms
+
+	start = time.perf_counter()
+	for n in range(steps):
+		now = n * step * 60.0
+		for i, room in enumerate(sim):
+			response, code = keeper.fire(Message({"id": valves[i].get_id(), "time": now}, room.temperature), "PUT_CURTMP")
+			position = int(response)
+			if position != room.position:
+				actuations[i] += 1
+				room.position = position
+			room.step(step, outside)
+
+			temperature = room.temperature
+			if temperature >= desired:
+				reached[i] = True
+			if reached[i]:
+				peaks[i] = max(peaks[i], temperature)
+			if abs(temperature - desired) > tolerance:
+				settled[i] = None
+			elif settled[i] is None:
+				settled[i] = (n + 1) * step
+	elapsed = time.perf_counter() - start
+
+	for valve in valves:
+		keeper.unsubscribe(valve.get_id())
+
+	settled_times = [s for s in settled if s is not None]
+	return {
+		"algorithm": "hysteresis" if heating_mode == 0 else "pid",
+		"rooms": rooms,
+		"overshoot": sum(max(0.0, p - desired) for p, r in zip(peaks, reached) if r) / rooms,
+		"settled_rooms": len(settled_times),
+		"settling_time": sum(settled_times) / len(settled_times) if settled_times else None,
+		"actuations": sum(actuations) / rooms,
+		"room_steps_per_second": rooms * steps / elapsed if elapsed else None,
+	}
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Simulates rooms controlled by hysteresis and PID algorithms.")
+	parser.add_argument("--rooms", type=int, default=100, help="number of simulated rooms")
+	parser.add_argument("--hours", type=float, default=24.0, help="simulated time in hours")
+	parser.add_argument("--step", type=float, default=3.0, help="time between measurements in minutes")
+	parser.add_argument("--desired", type=float, default=21.0, help="desired temperature")
+	parser.add_argument("--outside", type=float, default=0.0, help="outside temperature")
+	parser.add_argument("--band", type=float, default=0.1, help="hysteresis band")
+	parser.add_argument("--kp", type=float, default=30.0, help="proportional coeficient")
+	parser.add_argument("--ki", type=float, default=0.0, help="integral coeficient")
+	parser.add_argument("--kd", type=float, default=0.0, help="derivative coeficient")
+	parser.add_argument("--seed", type=int, default=0, help="seed of random room parameters")
+	parser.add_argument("--output", help="file the results are written to as json")
+	a = parser.parse_args()
+
+	results = [simulate(mode, a.rooms, a.hours, a.step, a.desired, a.outside, a.band, a.kp, a.ki, a.kd, seed=a.seed)
+		for mode in (0, 1)]
+	for r in results:
+		print("{algorithm:>10}: overshoot {overshoot:.2f} °C, settled {settled_rooms}/{rooms} rooms in {settling}"
+			" min, {actuations:.1f} actuations, {room_steps_per_second:.0f} room steps/s".format(
+			settling="-" if r["settling_time"] is None else "{:.0f}".format(r["settling_time"]), **r))
+	if a.output:
+		with open(a.output, "w") as f:
+			json.dump(results, f, indent=2)
@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+
+import gc
+import logging
+import os
+import struct
+import threading
+import time
+from array import array
+
+from controlEngine import ControlState
+from thermostaticValve import ThermostaticValve, DEFAULT_WEEK_PROGRAM
+from valveRegistry import ValveRegistry
+
+logger = logging.getLogger("dtrv.snapshot")
+
+MAGIC = b"DTRVSNAP"
+VERSION = 2
+
+# magic, version, journal sequence number the snapshot contains changes up to, number of valves
+HEADER = struct.Struct("<8sHQI2x")
+# registry key, eco, comfort, mode, heating mode, hysteresis band, kp, ki, kd, flags, position,
+# integral, last controlled temperature, time of last controlled temperature, current temperature,
+# length of alias, number of kept measurements; records of all valves follow the header as one table
+# decoded in bulk, the table is followed by alias padded to 8 bytes, week program if it is not default,
+# measured temperatures and times of measurements of each valve, so all floats are aligned and whole
+# snapshot can be read as one array of floats
+RECORD = struct.Struct("<qddBBddddBBddddHH")
+
+# flags of record
+CUSTOM_WEEK = 1
+CONTROLLED = 2
+FALLING = 4
+
+NAN = float("nan")
+
+
+def _number(value):
+	"""Returns value, or NaN for None."""
+	return NAN if value is None else value
+
+
+def _optional(value):
+	"""Returns value, or None for NaN."""
+	return None if value != value else value
+
+
+def encode_valve(valve):
+	"""
+	Encodes state of valve into snapshot record and its variable length data. Called under lock of the valve.
+
+	Parameters
+	----------
+	valve : ThermostaticValve
+		encoded valve
+	Returns
+	-------
+	bytes
+		the record
+	bytes
+		alias, week program and measurements following the table of records
+	"""
+	flags = 0
+	week = b''
+	if valve.week_prg is not DEFAULT_WEEK_PROGRAM:
+		flags |= CUSTOM_WEEK
+		week = valve.week_prg.tobytes()
+	state = valve.control
+	if state is None:
+		state = ControlState()
+	else:
+		flags |= CONTROLLED
+	if state.falling:
+		flags |= FALLING
+	alias = str(valve.alias).encode()
+	padding = b'\0' * (-len(alias) % 8)
+	temperatures = valve.temperatures.dump()
+	times = valve.temperatures_time.dump()
+	return (RECORD.pack(ValveRegistry.key(valve.id), valve.eco, valve.comfort, valve.mode, valve.heating_mode,
+		valve.h_band, valve.kp, valve.ki, valve.kd, flags, state.position, state.integral, _number(state.temperature),
+		_number(state.time), _number(valve.current_temperature), len(alias), len(temperatures)),
+		b''.join((alias, padding, week, temperatures.tobytes(), times.tobytes())))
+
+
+def write_snapshot(path, valves, sequence=0):
+	"""
+	Writes state of all valves to snapshot file. The snapshot is written to temporary file
+	 that replaces the previous snapshot only when it is completely on disk, so crash never leaves
+	 broken snapshot.
+
+	Parameters
+	----------
+	path : str
+		path to snapshot file
+	valves : ValveRegistry
+		valves to be written
+	sequence : int
+		sequence number of the last journaled change the snapshot contains
+	Returns
+	-------
+	int
+		number of written valves
+	"""
+	records = []
+	tails = []
+	for valve in valves:
+		with valve.lock:
+			record, tail = encode_valve(valve)
+		records.append(record)
+		tails.append(tail)
+
+	temporary = path + ".tmp"
+	with open(temporary, "wb") as f:
+		f.write(HEADER.pack(MAGIC, VERSION, sequence, len(records)))
+		f.write(b''.join(records))
+		f.write(b''.join(tails))
+		f.flush()
+		os.fsync(f.fileno())
+	os.replace(temporary, path)
+	if hasattr(os, "O_DIRECTORY"):
+		directory = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY | os.O_DIRECTORY)
+		try:
+			os.fsync(directory)
+		finally:
+			os.close(directory)
+	return len(records)
+
+
+def read_snapshot(path, history_size=40, store=None):
+	"""
+	Reads snapshot file and creates valves with the stored state. Records of all valves are decoded
+	 in bulk, only valves with alias, custom week program or measurements read more data.
+
+	Parameters
+	----------
+	path : str
+		path to snapshot file
+	history_size : int
+		number of measured temperatures kept for each valve
+	store : TemperatureStore
+		persistent store of measured temperatures of created valves
+	Returns
+	-------
+	list
+		created valves
+	int
+		sequence number of the last journaled change the snapshot contains
+	"""
+	with open(path, "rb") as f:
+		data = f.read()
+
+	magic, version, sequence, count = HEADER.unpack_from(data)
+	if magic != MAGIC or version != VERSION:
+		raise ValueError("{} is not valve snapshot".format(path))
+	end = HEADER.size + count * RECORD.size
+	if len(data) < end:
+		raise ValueError("{} is truncated".format(path))
+	floats = array('d')
+	floats.frombytes(memoryview(data)[:len(data) // 8 * 8])
+
+	valves = []
+	index = end // 8
+	for (key, eco, comfort, mode, heating_mode, h_band, kp, ki, kd, flags, position, integral, control_temperature,
+			control_time, current, alias_length, length) in RECORD.iter_unpack(memoryview(data)[HEADER.size:end]):
+		valve = ThermostaticValve(str(key), history_size, store)
+		valve.eco = eco
+		valve.comfort = comfort
+		valve.mode = mode
+		valve.heating_mode = heating_mode
+		valve.h_band = h_band
+		valve.kp = kp
+		valve.ki = ki
+		valve.kd = kd
+		if alias_length:
+			offset = index * 8
+			valve.alias = data[offset:offset + alias_length].decode()
+			index += (alias_length + 7) // 8
+		if flags & CUSTOM_WEEK:
+			valve.week_prg = floats[index:index + 168]
+			index += 168
+		if flags & CONTROLLED:
+			state = valve.control = ControlState()
+			state.position = position
+			state.integral = integral
+			state.falling = bool(flags & FALLING)
+			state.temperature = _optional(control_temperature)
+			state.time = _optional(control_time)
+		if current == current:
+			valve.current_temperature = current
+		if length:
+			valve.temperatures.load(floats[index:index + length])
+			valve.temperatures_time.load(floats[index + length:index + 2 * length])
+			index += 2 * length
+		valves.append(valve)
+
+	return valves, sequence
+
+
+def restore(server, path):
+	"""
+	Restores valves of server from snapshot file, if the file exists.
+
+	Parameters
+	----------
+	server : Server
+		server valves are restored to
+	path : str
+		path to snapshot file
+	Returns
+	-------
+	int
+		sequence number of the last journaled change the snapshot contains, 0 if there is no snapshot
+	"""
+	if not os.path.exists(path):
+		return 0
+	start = time.perf_counter()
+	# restored valves are long living objects, collecting garbage while they are created only slows restore
+	collecting = gc.isenabled()
+	gc.disable()
+	try:
+		valves, sequence = read_snapshot(path, server.history_size, server.store)
+		server.keeper.subscribe_many(valves)
+	finally:
+		if collecting:
+			gc.enable()
+	logger.info("snapshot restored", extra={"fields": {"valves": len(valves),
+		"ms": (time.perf_counter() - start) * 1000}})
+	return sequence
+
+
+class SnapshotWriter:
+	"""
+	A class used to represent thread periodically writing snapshot of subscribed valves.
+
+	...
+
+	Attributes
+	----------
+	path : str
+		path to snapshot file
+	keeper : ValveKeeper
+		publisher with subscribed valves
+	interval : float
+		seconds between snapshots
+	journal : Journal
+		journal compacted after each snapshot, None if changes are not journaled
+	stopped : threading.Event
+		set when writing of snapshots is stopped
+	thread : threading.Thread
+		thread writing snapshots
+	"""
+	def __init__(self, path, keeper, interval=60.0, journal=None):
+		self.path = path
+		self.keeper = keeper
+		self.interval = interval
+		self.journal = journal
+		self.stopped = threading.Event()
+		self.thread = threading.Thread(target=self._run, daemon=True)
+
+	def start(self):
+		"""
+		Starts periodic writing of snapshots.
+		"""
+		self.thread.start()
+
+	def stop(self):
+		"""
+		Stops periodic writing and writes the final snapshot. Failed final snapshot is only logged,
+		 the previous snapshot and journal still contain all changes.
+		"""
+		if self.stopped.is_set():
+			return
+		self.stopped.set()
+		if self.thread.is_alive():
+			self.thread.join()
+		try:
+			self.write()
+		except Exception:
+			logger.exception("final snapshot failed")
+
+	def write(self):
+		"""
+		Writes snapshot of subscribed valves, and removes changes contained in it from journal.
+		 Changes journaled while the snapshot is written can be contained in it too, replaying
+		 them again on restore sets the same values.
+		"""
+		start = time.perf_counter()
+		sequence = 0 if self.journal is None else self.journal.sequence
+		count = write_snapshot(self.path, self.keeper.get_valves(), sequence)
+		if self.journal is not None:
+			self.journal.compact(sequence)
+		logger.info("snapshot written", extra={"fields": {"valves": count, "sequence": sequence,
+			"ms": (time.perf_counter() - start) * 1000}})
+
+	def _run(self):
+		while not self.stopped.wait(self.interval):
+			try:
+				self.write()
+			except Exception:
+				# the next snapshot is tried again, failed one must not stop periodic snapshots
+				logger.exception("snapshot failed")
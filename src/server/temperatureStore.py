@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+
+import logging
+import queue
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger("dtrv.store")
+
+
+class TemperatureStore:
+	"""
+	A class used to represent persistent store of measured temperatures.
+
+	Measurements are appended to queue and written to SQLite database (in WAL mode)
+	 in batches by background thread, so the request thread is never blocked by disk.
+	 Batch that fails to be written is logged and dropped, the writer goes on with next batches.
+
+	...
+
+	Attributes
+	----------
+	path : str
+		path to the database file
+	batch_size : int
+		maximal number of measurements written in one transaction
+	flush_interval : float
+		maximal time in seconds the measurement waits in queue before it is written
+	failures : int
+		number of batches that failed to be written
+	connections : list
+		connections of all threads that used the store, closed with the store
+	lock : threading.Lock
+		lock held while connections are added or closed
+	"""
+	def __init__(self, path, batch_size=5000, flush_interval=0.5):
+		"""
+		Parameters
+		-------
+		path : str
+			path to the database file, created if it does not exist
+		batch_size : int
+			maximal number of measurements written in one transaction
+		flush_interval : float
+			maximal time in seconds the measurement waits in queue before it is written
+		"""
+		self.path = path
+		self.batch_size = batch_size
+		self.flush_interval = flush_interval
+
+		self.failures = 0
+		self.queue = queue.SimpleQueue()
+		self.local = threading.local()
+		self.connections = []
+		self.lock = threading.Lock()
+
+		connection = self._connect()
+		connection.execute("PRAGMA journal_mode=WAL")
+		connection.execute("CREATE TABLE IF NOT EXISTS temperatures (valve INTEGER, time REAL, temperature REAL)")
+		connection.execute("CREATE INDEX IF NOT EXISTS temperatures_valve_time ON temperatures (valve, time)")
+		connection.commit()
+
+		self.writer = threading.Thread(target=self._write, name="TemperatureStore", daemon=True)
+		self.writer.start()
+
+	def _connect(self):
+		"""
+		Returns database connection of calling thread.
+
+		Returns
+		-------
+		sqlite3.Connection
+			connection to the database
+		"""
+		connection = getattr(self.local, "connection", None)
+		if connection is None:
+			# connection is used only by its thread, other thread only closes it when the store is closed
+			connection = sqlite3.connect(self.path, check_same_thread=False)
+			connection.execute("PRAGMA synchronous=NORMAL")
+			self.local.connection = connection
+			with self.lock:
+				self.connections.append(connection)
+		return connection
+
+	def _write(self):
+		"""
+		Writes queued measurements to database until the store is closed.
+		"""
+		connection = self._connect()
+		running = True
+		while running:
+			batch = []
+			events = []
+			try:
+				item = self.queue.get(timeout=self.flush_interval)
+			except queue.Empty:
+				continue
+
+			while True:
+				if item is None:
+					running = False
+				elif isinstance(item, threading.Event):
+					events.append(item)
+				else:
+					batch.append(item)
+
+				if len(batch) >= self.batch_size:
+					break
+				try:
+					item = self.queue.get_nowait()
+				except queue.Empty:
+					break
+
+			if batch:
+				try:
+					connection.executemany("INSERT INTO temperatures VALUES (?, ?, ?)", batch)
+					connection.commit()
+				except sqlite3.Error:
+					self.failures += 1
+					logger.exception("measurements not stored", extra={"fields": {"count": len(batch)}})
+					try:
+						connection.rollback()
+					except sqlite3.Error:
+						pass
+			for event in events:
+				event.set()
+
+	def append(self, identifier, timestamp, temperature):
+		"""
+		Queues measurement to be written to the store.
+
+		Parameters
+		----------
+		identifier : int
+			identifier of valve that measured temperature
+		timestamp : float
+			time of measurement
+		temperature : float
+			measured temperature
+		"""
+		self.queue.put((identifier, timestamp, temperature))
+
+	def flush(self, timeout=None):
+		"""
+		Waits until all measurements queued so far are written. Waiting ends when the writer is stopped.
+
+		Parameters
+		----------
+		timeout : float
+			maximal time to wait in seconds, unlimited if None
+		Returns
+		-------
+		boolean
+			True if measurements were written, False if timeout occurred, some of them failed
+			 to be written or the store is closed
+		"""
+		failures = self.failures
+		event = threading.Event()
+		self.queue.put(event)
+		deadline = None if timeout is None else time.monotonic() + timeout
+		while not event.is_set():
+			if not self.writer.is_alive():
+				return False
+			wait = self.flush_interval
+			if deadline is not None:
+				wait = min(wait, deadline - time.monotonic())
+				if wait <= 0:
+					return False
+			event.wait(wait)
+		return self.failures == failures
+
+	def query(self, identifier, start=None, end=None):
+		"""
+		Returns measurements of valve in given time range.
+
+		Parameters
+		----------
+		identifier : int
+			identifier of valve
+		start : float
+			time of the oldest measurement, unlimited if None
+		end : float
+			time of the newest measurement, unlimited if None
+		Returns
+		-------
+		list
+			list of (time, temperature) tuples ordered by time
+		"""
+		start = float("-inf") if start is None else start
+		end = float("inf") if end is None else end
+		return self._connect().execute(
+			"SELECT time, temperature FROM temperatures WHERE valve = ? AND time BETWEEN ? AND ? ORDER BY time",
+			(identifier, start, end)).fetchall()
+
+	def close(self):
+		"""
+		Writes all queued measurements, stops background writer and closes connections of all threads.
+		"""
+		if self.writer.is_alive():
+			self.queue.put(None)
+			self.writer.join()
+		with self.lock:
+			connections = self.connections
+			self.connections = []
+		for connection in connections:
+			connection.close()
@@ -1,8 +1,46 @@
 #!/usr/bin/env python3
 
 import time
-import json
-from utils import get_day_index, get_mode_index
+import threading
+from array import array
+from utils import get_schedule_slot, get_mode_index, is_float, load_json, to_number
+from valveRegistry import ValveRegistry
+from ringBuffer import RingBuffer
+from controlEngine import ControlState, control
+
+# default week program, comfort temperature from 6:00 to 22:00 and eco temperature otherwise
+DEFAULT_WEEK_PROGRAM = array('d', [21.0 if 5 < hour < 22 else 17.0 for day in range(7) for hour in range(24)])
+
+# range of temperatures valve can be set to, and of its hysteresis band
+MIN_TEMPERATURE = 5.0
+MAX_TEMPERATURE = 30.0
+MAX_HYSTERESIS_BAND = 5.0
+# the longest alias, alias is stored in snapshot with its length in two bytes
+MAX_ALIAS_LENGTH = 255
+# number of temperature modes (comfort, eco, time based) and heating modes (hysteresis, PID)
+TEMPERATURE_MODES = 3
+HEATING_MODES = 2
+
+
+def to_mode(value, count):
+	"""
+	Converts value to index of mode.
+
+	Parameters
+	----------
+	value : object
+		value to be converted, number or string with number
+	count : int
+		number of modes
+	Returns
+	-------
+	int
+		index of mode, None if value is not index of mode
+	"""
+	value = to_number(value, 0, count - 1)
+	if value is None or not value.is_integer():
+		return None
+	return int(value)
 
 
 class ThermostaticValve:
@@ -13,10 +51,8 @@ class ThermostaticValve:
 
 	Attributes
 	----------
-	ids : list
-		identifiers of all valves in system
-	valves : list
-		all instances of valves in system
+	valves : ValveRegistry
+		all instances of valves in system indexed by identifier
 
 	id : int
 		unique identifier for valve in system
@@ -24,48 +60,65 @@ class ThermostaticValve:
 		temperature for eco mode
 	comfort : float
 		temperature for comfort mode
-	week_prg : nested list
-		temperature for time based mode
+	week_prg : array
+		temperature for time based mode, 24 hours of each of 7 days in one flat array
+		 (shared default program until the first change)
 	current_temperature : float
 		last measured temperature
-	temperatures : list
-		last 48 measured temperatures
-	temperatures_time : list
+	temperatures : RingBuffer
+		last measured temperatures (up to history_size)
+	temperatures_time : RingBuffer
 		times of temperature measurements
-	temperatures_index : int
-		index of how many measured temperatures are stored (up to 40)
+	desired : float
+		cached desired temperature, None if it has to be resolved again
+	desired_slot : tuple
+		week program slot the cached desired temperature was resolved for
+	store : TemperatureStore
+		persistent store of measured temperatures, None if history is not persisted
+	control : ControlState
+		state of server side control of valve position, None before first measurement
+	watchers : list
+		functions called after change of desired temperature, mode or control parameters, None if there are none
+	version : int
+		number of changes of valve, increased by every setter
+	lock : threading.RLock
+		lock held while valve handles request
 	"""
 
-	ids = []
-	valves = []
+	__slots__ = ("id", "eco", "comfort", "week_prg", "current_temperature", "temperatures", "temperatures_time",
+		"mode", "desired", "desired_slot", "heating_mode", "h_band", "kp", "ki", "kd", "alias", "count", "store", "control",
+		"watchers", "version", "lock")
+
+	valves = ValveRegistry()
 
 	#constructor
-	def __init__(self, id):
+	def __init__(self, id, history_size=40, store=None):
 		"""
 		Parameters
 		-------
 		id : int
 			unique identifier of valve
+		history_size : int
+			number of measured temperatures kept in history
+		store : TemperatureStore
+			persistent store of measured temperatures
 		"""
 
 		self.id = id
-		print("New valve created: " + str(self.id))
 
 		self.eco = 17.0
 		self.comfort = 21.0
 
-		self.week_prg = [None] * 7
-		for i in range(7):
-			self.week_prg[i] = [None] * 24
-			for j in range(24):
-				self.week_prg[i][j] = 21.0 if 5 < j < 22 else 17.0
+		self.week_prg = DEFAULT_WEEK_PROGRAM
 
 		self.current_temperature = None
-		self.temperatures = [None] * 40 #list of temperature
-		self.temperatures_time = [None] * 40
-		self.temperatures_index = 0
+		self.temperatures = RingBuffer(history_size)
+		self.temperatures_time = RingBuffer(history_size)
+		self.store = store
 
 		self.mode = 0
+		self.desired = None
+		self.desired_slot = None
 		self.heating_mode = 0 #0 for hyst, 1 for pid
 
 		self.h_band = 0.1
@@ -77,8 +130,12 @@ class ThermostaticValve:
 
 		self.count = 0
 
-		ThermostaticValve.valves.append(self)
-		ThermostaticValve.ids.append(self.id)
+		self.control = None
+		self.watchers = None
+		self.version = 0
+		self.lock = threading.RLock()
+
+		ThermostaticValve.valves.add(self)
 
 	#returns ids of all existing valves
 	@staticmethod
@@ -91,19 +148,19 @@ class ThermostaticValve:
 		list
 			valves identifiers
 		"""
-		return ThermostaticValve.ids
+		return ThermostaticValve.valves.ids()
 
 	@staticmethod
 	def add_valve(valve):
 		"""
-		Appends valve instance to list of valve instances.
+		Adds valve instance to registry of valve instances.
 
 		Parameters
 		----------
 		valve : ThermostaticValve
 			valve to be appended
 		"""
-		ThermostaticValve.valves.append(valve)
+		ThermostaticValve.valves.add(valve)
 
 
 	#returns valve id
@@ -129,6 +186,7 @@ class ThermostaticValve:
 			alias to be set
 		"""
 		self.alias = alias
+		self.version += 1
 
 	def get_alias(self):
 		"""
@@ -164,6 +222,7 @@ class ThermostaticValve:
 			eco temperature to be set
 		"""
 		self.eco = tmp
+		self.control_changed()
 
 
 	def get_comfort_temperature(self):
@@ -187,6 +246,7 @@ class ThermostaticValve:
 			comfort temperature to be set
 		"""
 		self.comfort = tmp
+		self.control_changed()
 
 
 	#returns week program temperature at given time
@@ -206,37 +266,103 @@ class ThermostaticValve:
 		float
 			valves time based temperature
 		"""
-		return self.week_prg[day][hour]
+		if not (0 <= day < 7 and 0 <= hour < 24):
+			raise IndexError("week program slot out of range")
+		return self.week_prg[day * 24 + hour]
 
 	#sets week program of valve
 	def set_hourly_temperature(self, day, hour, tmp):
-		self.week_prg[day][hour] = tmp
+		"""
+		Sets selected valves time based temperature.
+
+		Parameters
+		----------
+		day : int
+			day of temperature to be set
+		hour : int
+			hour of temperature to be set
+		tmp : float
+			time based temperature to be set
+		"""
+		if not (0 <= day < 7 and 0 <= hour < 24):
+			raise IndexError("week program slot out of range")
+		if self.week_prg is DEFAULT_WEEK_PROGRAM:
+			self.week_prg = array('d', DEFAULT_WEEK_PROGRAM)
+		self.week_prg[day * 24 + hour] = tmp
+		self.control_changed()
+
+	def get_week_program(self, day=None):
+		"""
+		Returns selected valves time based temperatures of whole week or one day.
+
+		Parameters
+		----------
+		day : int
+			day of requested temperatures, whole week if None
+
+		Returns
+		-------
+		list
+			24 temperatures of the day, or list of 24 temperatures for each day of the week
+		"""
+		if day is None:
+			return [self.week_prg[d * 24:d * 24 + 24].tolist() for d in range(7)]
+		if not 0 <= day < 7:
+			raise IndexError("week program day out of range")
+		return self.week_prg[day * 24:day * 24 + 24].tolist()
+
+	def set_week_program(self, program, day=None):
+		"""
+		Sets selected valves time based temperatures of whole week or one day.
+
+		Parameters
+		----------
+		program : list
+			24 temperatures of the day, or list of 24 temperatures for each day of the week
+			 (flat list of 168 temperatures is accepted too)
+		day : int
+			day of temperatures to be set, whole week if None
+		"""
+		if day is None and len(program) == 7:
+			program = [tmp for d in program for tmp in d]
+		values = array('d', [float(tmp) for tmp in program])
+		if not all(MIN_TEMPERATURE <= tmp <= MAX_TEMPERATURE for tmp in values):
+			raise ValueError("week program temperature out of range")
+		if self.week_prg is DEFAULT_WEEK_PROGRAM:
+			self.week_prg = array('d', DEFAULT_WEEK_PROGRAM)
+		if day is None:
+			if len(values) != 168:
+				raise ValueError("week program must have 168 temperatures")
+			self.week_prg[:] = values
+		else:
+			if not 0 <= day < 7:
+				raise IndexError("week program day out of range")
+			if len(values) != 24:
+				raise ValueError("day program must have 24 temperatures")
+			self.week_prg[day * 24:day * 24 + 24] = values
+		self.control_changed()
 
 
 	#sets current temperature and saves it to list for future use
-	def set_current_temperature(self, tmp):
+	def set_current_temperature(self, tmp, timestamp=None):
 		"""
-		Sets selected valves current temperature and current time.
+		Sets selected valves current temperature and time of measurement.
 
 		Parameters
 		----------
 		tmp : float
 			current temperature to be set
+		timestamp : float
+			time of measurement, current time if None
 		"""
+		tmp = float(tmp)
+		now = time.time() if timestamp is None else float(timestamp)
 		self.current_temperature = tmp
-		if self.temperatures_index == 40:
-			for i in range(0, len(self.temperatures)):
-				if i == 39:
-					self.temperatures[i] = tmp
-					self.temperatures_time[i] = time.time()
-					break
-				else:
-					self.temperatures[i] = self.temperatures[i + 1]
-					self.temperatures_time[i] = self.temperatures_time[i + 1]
-		else:
-			self.temperatures[self.temperatures_index] = tmp
-			self.temperatures_time[self.temperatures_index] = time.time()
-			self.temperatures_index += 1
+		self.temperatures.append(tmp)
+		self.temperatures_time.append(now)
+		self.version += 1
+		if self.store is not None:
+			self.store.append(ValveRegistry.key(self.id), now, tmp)
 
 	#returns current temperature
 	def get_current_temperature(self):
@@ -259,7 +385,61 @@ class ThermostaticValve:
 		list
 			valves current temperatures
 		"""
-		return self.temperatures[:self.temperatures_index], self.temperatures_time[:self.temperatures_index]
+		return self.temperatures.snapshot(), self.temperatures_time.snapshot()
+
+	def get_history_fill(self):
+		"""
+		Returns number of kept measured temperatures and maximal number of kept temperatures.
+
+		Returns
+		-------
+		tuple
+			number of kept temperatures and history size
+		"""
+		return len(self.temperatures), self.temperatures.get_capacity()
+
+	def control_valve(self):
+		"""
+		Calculates new position of valve from the last measured temperature with selected heating mode.
+
+		Returns
+		-------
+		int
+			valves position (0 - 30)
+		"""
+		if self.control is None:
+			self.control = ControlState()
+		return control(self.control, self, self.current_temperature, self.temperatures_time.last())
+
+	def get_valve_position(self):
+		"""
+		Returns selected valves last calculated position.
+
+		Returns
+		-------
+		int
+			valves position (0 - 30)
+		"""
+		return 0 if self.control is None else self.control.position
+
+	def get_temperature_history(self, start=None, end=None):
+		"""
+		Returns selected valves persisted temperatures in given time range.
+
+		Parameters
+		----------
+		start : float
+			time of the oldest measurement, unlimited if None
+		end : float
+			time of the newest measurement, unlimited if None
+		Returns
+		-------
+		list
+			list of (time, temperature) tuples, None if history is not persisted
+		"""
+		if self.store is None:
+			return None
+		return self.store.query(ValveRegistry.key(self.id), start, end)
 
 	#returns temperature according to selected mode
 	def get_desired_temperature(self):
@@ -271,12 +451,16 @@ class ThermostaticValve:
 		float
 			valves desired temperature
 		"""
-		if self.mode == 0:
-			return self.get_comfort_temperature()
-		elif self.mode == 1:
-			return self.get_eco_temperature()
-		elif self.mode == 2:
-			return self.get_hourly_temperature(get_day_index(time.strftime("%a")), int(time.strftime("%H")))
+		slot = get_schedule_slot() if self.mode == 2 else None
+		if self.desired is None or self.desired_slot != slot:
+			if self.mode == 0:
+				self.desired = self.get_comfort_temperature()
+			elif self.mode == 1:
+				self.desired = self.get_eco_temperature()
+			elif self.mode == 2:
+				self.desired = self.get_hourly_temperature(slot[0], slot[1])
+			self.desired_slot = slot
+		return self.desired
 
 
 	def get_temperature_mode(self):
@@ -300,6 +484,7 @@ class ThermostaticValve:
 			temperature mode to be set
 		"""
 		self.mode = mode
+		self.control_changed()
 
 	def get_heating_mode(self):
 		"""
@@ -322,6 +507,7 @@ class ThermostaticValve:
 			heating mode to be set
 		"""
 		self.heating_mode = mode
+		self.control_changed()
 
 	def get_hysteresis_band(self):
 		"""
@@ -344,6 +530,7 @@ class ThermostaticValve:
 			hysteresis band to be set
 		"""
 		self.h_band = band
+		self.control_changed()
 
 	def get_pid_coeficients(self):
 		"""
@@ -372,6 +559,61 @@ class ThermostaticValve:
 		self.kp = kp
 		self.ki = ki
 		self.kd = kd
+		self.control_changed()
+
+	def control_changed(self):
+		"""
+		Invalidates cached desired temperature, increases version and informs watchers about changed
+		 desired temperature, mode or control parameters.
+		"""
+		self.desired = None
+		self.version += 1
+		if self.watchers:
+			for watcher in tuple(self.watchers):
+				watcher()
+
+	def watch(self, watcher):
+		"""
+		Adds function called after every change of desired temperature, mode or control parameters.
+		 The function is called in thread that changed valve and must not block.
+
+		Parameters
+		----------
+		watcher : function
+			function without arguments
+		"""
+		with self.lock:
+			if self.watchers is None:
+				self.watchers = []
+			self.watchers.append(watcher)
+
+	def unwatch(self, watcher):
+		"""
+		Removes function added by watch.
+
+		Parameters
+		----------
+		watcher : function
+			function without arguments
+		"""
+		with self.lock:
+			self.watchers.remove(watcher)
+			if not self.watchers:
+				self.watchers = None
+
+	def get_control_info(self):
+		"""
+		Returns desired temperature, mode and control parameters the head needs, with version token
+		 that changes only when some of them changes.
+
+		Returns
+		-------
+		dict
+			version token, desired temperature, temperature mode, heating mode, hysteresis band and PID coeficients
+		"""
+		values = (self.get_desired_temperature(), self.mode, self.heating_mode, self.h_band, self.kp, self.ki, self.kd)
+		return {"version": "{:016x}".format(hash(values) & 0xffffffffffffffff), "desired": values[0], "mode": self.mode,
+			"heating_mode": self.heating_mode, "hysteresis_band": self.h_band, "kp": self.kp, "ki": self.ki, "kd": self.kd}
 
 	@staticmethod
 	def get_valve(identifier):
@@ -388,12 +630,7 @@ class ThermostaticValve:
 		ThermostaticValve
 			valve with matching identifier as was given
 		"""
-		if (isinstance(identifier, str) and identifier.isdigit()) or isinstance(identifier, int):
-			for valve in ThermostaticValve.valves:
-				if int(identifier) == valve.get_id():
-					return valve
-
-		return None
+		return ThermostaticValve.valves.get(identifier)
 
 	#deletes valve from system
 	@staticmethod
@@ -410,14 +647,294 @@ class ThermostaticValve:
 		boolean
 			True if valve was succesfully removed, False otherwise
 		"""
-		del_valve = ThermostaticValve.get_valve(identifier)
+		return ThermostaticValve.valves.remove(identifier) is not None
+
+	def _get_info(self, args, body):
+		"""Handles GET_INFO request."""
+		kp, ki, kd = self.get_pid_coeficients()
+		info = {
+			"comfort": self.get_comfort_temperature(),
+			"eco": self.get_eco_temperature(),
+			"current": self.get_current_temperature(),
+			"desired": self.get_desired_temperature(),
+			"mode": self.get_temperature_mode(),
+			"heating_mode": self.get_heating_mode(),
+			"hysteresis_band": self.get_hysteresis_band(),
+			"kp": kp,
+			"ki": ki,
+			"kd": kd,
+			"alias": self.get_alias(),
+			"position": self.get_valve_position()
+		}
+		if "day" in args and "hour" in args:
+			try:
+				info["hourly"] = self.get_hourly_temperature(int(args["day"]), int(args["hour"]))
+			except (ValueError, IndexError):
+				return ('', 400), 1
+		return (info, 200), 1
+
+	def _get_temperature(self, args, body):
+		"""Handles GET_TMP request."""
+		temperatures = {
+			"comfort": self.get_comfort_temperature(),
+			"eco": self.get_eco_temperature(),
+			"current": self.get_current_temperature(),
+			"desired": self.get_desired_temperature(),
+		}
+		if "day" in args and "hour" in args:
+			temperatures["hourly"] = self.get_hourly_temperature(int(args["day"]), int(args["hour"]))
+		return (temperatures, 200), 1
+
+	def _get_current_temperature(self, args, body):
+		"""Handles GET_CURTMP request."""
+		cur_tmp = self.get_current_temperature()
+		return (str(cur_tmp), 200), 1
+
+	def _get_desired_temperature(self, args, body):
+		"""Handles GET_DESTMP request."""
+		des_tmp = self.get_desired_temperature()
+		return (str(des_tmp), 200), 1
+
+	def _get_eco_temperature(self, args, body):
+		"""Handles GET_ECOTMP request."""
+		des_tmp = self.get_eco_temperature()
+		return (str(des_tmp), 200), 1
+
+	def _get_comfort_temperature(self, args, body):
+		"""Handles GET_COMTMP request."""
+		des_tmp = self.get_comfort_temperature()
+		return (str(des_tmp), 200), 1
+
+	def _get_hourly_temperature(self, args, body):
+		"""Handles GET_TIMETMP request."""
+		try:
+			time_tmp = self.get_hourly_temperature(int(args["day"]), int(args["hour"]))
+		except (KeyError, ValueError, IndexError):
+			return ('', 400), 1
+		return (str(time_tmp), 200), 1
+
+	def _get_week_program(self, args, body):
+		"""Handles GET_WEEKTMP request."""
+		try:
+			program = self.get_week_program(int(args["day"]) if "day" in args else None)
+		except (ValueError, IndexError):
+			return ('', 400), 1
+		return (program, 200), 1
+
+	def _get_temperature_mode(self, args, body):
+		"""Handles GET_TMPMODE request."""
+		mode = self.get_temperature_mode()
+		return (str(mode), 200), 1
+
+	def _get_heating_mode(self, args, body):
+		"""Handles GET_HEATMODE request."""
+		alg = self.get_heating_mode()
+		hyst = self.get_hysteresis_band()
+		coeficients = self.get_pid_coeficients()
+		h_dict = {"heating_mode": alg, "hysteresis_band": hyst,
+			"kp": coeficients[0], "ki": coeficients[1], "kd": coeficients[2]}
+		return (h_dict, 200), 1
+
+	def _get_alias(self, args, body):
+		"""Handles GET_ALIAS request."""
+		alias = self.get_alias()
+		return (alias, 200), 1
+
+	def _get_control_info(self, args, body):
+		"""Handles GET_CONTROL request."""
+		return (self.get_control_info(), 200), 1
+
+	def _get_current_temperatures(self, args, body):
+		"""Handles GET_CURTMPS request."""
+		tmps, times = self.get_current_temperatures()
+		d = {}
+		for x, y in zip(tmps, times):
+			d[str(int(y))] = x
+		return (d, 200), 1
+
+	def _get_temperature_history(self, args, body):
+		"""Handles GET_HISTORY request."""
+		if not all(is_float(args[k]) for k in ("from", "to") if k in args):
+			return ('', 400), 1
+		history = self.get_temperature_history(
+			float(args["from"]) if "from" in args else None, float(args["to"]) if "to" in args else None)
+		if history is None:
+			return ('', 404), 1
+		return ([list(h) for h in history], 200), 1
+
+	def _put_info(self, args, body):
+		"""Handles PUT_INFO request, nothing is set when some of the values is not valid."""
+		valve1 = body
+		if not isinstance(valve1, dict):
+			return ('', 400), -1
+
+		values = {}
+		for key in ("comfort", "eco"):
+			if key in valve1:
+				values[key] = to_number(valve1[key], MIN_TEMPERATURE, MAX_TEMPERATURE)
+		if "mode" in valve1:
+			try:
+				values["mode"] = get_mode_index(valve1["mode"])
+			except (AttributeError, KeyError):
+				values["mode"] = None
+		if "heating_mode" in valve1:
+			values["heating_mode"] = to_mode(valve1["heating_mode"], HEATING_MODES)
+		if "hysteresis_band" in valve1:
+			values["hysteresis_band"] = to_number(valve1["hysteresis_band"], 0.0, MAX_HYSTERESIS_BAND)
+		if "kp" in valve1 and "ki" in valve1 and "kd" in valve1:
+			for key in ("kp", "ki", "kd"):
+				values[key] = to_number(valve1[key], 0.0)
+		if None in values.values():
+			return ('', 400), -1
+
+		if "comfort" in values:
+			self.set_comfort_temperature(values["comfort"])
+		if "eco" in values:
+			self.set_eco_temperature(values["eco"])
+		if "mode" in values:
+			self.set_temperature_mode(values["mode"])
+		if "heating_mode" in values:
+			self.set_heating_mode(values["heating_mode"])
+		if "hysteresis_band" in values:
+			self.set_hysteresis_band(values["hysteresis_band"])
+		if "kp" in values:
+			self.set_pid_coeficients(values["kp"], values["ki"], values["kd"])
+
+		return (' ', 200), 3
+
+	def _put_current_temperature(self, args, body):
+		"""Handles PUT_CURTMP request."""
+		tmp = to_number(body)
+		timestamp = to_number(args["time"]) if "time" in args else None
+		if tmp is None or ("time" in args and timestamp is None):
+			return ('', 400), 2
+		self.set_current_temperature(tmp, timestamp)
+		position = self.control_valve()
+		return (str(position), 200), 2
+
+	def _put_eco_temperature(self, args, body):
+		"""Handles PUT_ECOTMP request."""
+		tmp = to_number(body, MIN_TEMPERATURE, MAX_TEMPERATURE)
+		if tmp is None:
+			return ('', 400), 2
+		self.set_eco_temperature(tmp)
+		return (' ', 200), 2
+
+	def _put_comfort_temperature(self, args, body):
+		"""Handles PUT_COMTMP request."""
+		tmp = to_number(body, MIN_TEMPERATURE, MAX_TEMPERATURE)
+		if tmp is None:
+			return ('', 400), 2
+		self.set_comfort_temperature(tmp)
+		return (' ', 200), 2
+
+	def _put_hourly_temperature(self, args, body):
+		"""Handles PUT_TIMETMP request."""
+		tmp = to_number(body, MIN_TEMPERATURE, MAX_TEMPERATURE)
+		if tmp is None:
+			return ('', 400), 2
+		try:
+			self.set_hourly_temperature(int(args["day"]), int(args["hour"]), tmp)
+		except (KeyError, ValueError, IndexError):
+			return ('', 400), 2
+		return (' ', 200), 2
+
+	def _put_week_program(self, args, body):
+		"""Handles PUT_WEEKTMP request."""
+		try:
+			self.set_week_program(body, int(args["day"]) if "day" in args else None)
+		except (TypeError, ValueError, IndexError):
+			return ('', 400), 2
+		return (' ', 200), 2
+
+	def _put_temperature_mode(self, args, body):
+		"""Handles PUT_TMPMODE request."""
+		mode = to_mode(body, TEMPERATURE_MODES)
+		if mode is None:
+			return ('', 400), 2
+		self.set_temperature_mode(mode)
+		return (' ', 200), 2
+
+	def _put_heating_mode(self, args, body):
+		"""Handles PUT_HEATMODE request."""
+		mode = to_mode(body, HEATING_MODES)
+		if mode is None:
+			return ('', 400), 2
+		self.set_heating_mode(mode)
+		return (' ', 200), 2
+
+	def _put_alias(self, args, body):
+		"""Handles PUT_ALIAS request."""
+		if not isinstance(body, str) or len(body) > MAX_ALIAS_LENGTH:
+			return ('', 400), 2
+		self.set_alias(body)
+		return (' ', 200), 2
+
+	# handlers of request types, each takes request arguments and decoded request body
+	handlers = {
+		"GET_INFO": _get_info,
+		"GET_TMP": _get_temperature,
+		"GET_CURTMP": _get_current_temperature,
+		"GET_DESTMP": _get_desired_temperature,
+		"GET_ECOTMP": _get_eco_temperature,
+		"GET_COMTMP": _get_comfort_temperature,
+		"GET_TIMETMP": _get_hourly_temperature,
+		"GET_WEEKTMP": _get_week_program,
+		"GET_TMPMODE": _get_temperature_mode,
+		"GET_HEATMODE": _get_heating_mode,
+		"GET_ALIAS": _get_alias,
+		"GET_CONTROL": _get_control_info,
+		"GET_CURTMPS": _get_current_temperatures,
+		"GET_HISTORY": _get_temperature_history,
+		"PUT_INFO": _put_info,
+		"PUT_CURTMP": _put_current_temperature,
+		"PUT_ECOTMP": _put_eco_temperature,
+		"PUT_COMTMP": _put_comfort_temperature,
+		"PUT_TIMETMP": _put_hourly_temperature,
+		"PUT_WEEKTMP": _put_week_program,
+		"PUT_TMPMODE": _put_temperature_mode,
+		"PUT_HEATMODE": _put_heating_mode,
+		"PUT_ALIAS": _put_alias,
+	}
+
+	# request types that are delivered to all valves when no identifier is given
+	broadcasts = {"PUT_INFO"}
+	# request types whose body contains part for each valve keyed by identifier, valve handles only its part
+	keyed = {"PUT_INFO"}
 
-		if del_valve is not None:
-			ThermostaticValve.valves.remove(del_valve)
-			ThermostaticValve.ids.remove(int(identifier))
-			return True
-		else:
-			return False
+	@staticmethod
+	def get_part(body, valve):
+		"""
+		Returns part of keyed request body meant for valve.
+
+		Parameters
+		----------
+		body : dict
+			decoded request body keyed by identifiers of valves
+		valve : ThermostaticValve
+			the valve
+		Returns
+		-------
+		object
+			part of body for valve, None if there is none
+		"""
+		return body.get(str(ValveRegistry.key(valve.get_id())))
+
+	@staticmethod
+	def get_handler(message_type):
+		"""
+		Returns handler of request type.
+
+		Parameters
+		----------
+		message_type : string
+			identifier of request type
+		Returns
+		-------
+		function
+			handler taking valve, request arguments and decoded request body, None if request type is unknown
+		"""
+		return ThermostaticValve.handlers.get(message_type)
 
 	def update(self, message, message_type):
 		"""
@@ -436,141 +953,27 @@ class ThermostaticValve:
 		int
 			returns code that specifies if request was performed succesfully and what should caller do next
 		"""
+		handler = ThermostaticValve.get_handler(message_type)
 		args = message.args
-		_json = message.json
-		if _json is None and message_type[:3] == "PUT":
+		if handler is None:
 			return ('', 404), -1
-
-		if "id" in args and int(args["id"]) != int(self.get_id()):
+		if "id" in args:
+			if ValveRegistry.key(args["id"]) != ValveRegistry.key(self.get_id()):
+				return (), -1
+		elif message_type not in ThermostaticValve.broadcasts:
 			return (), -1
 
-		if message_type == "GET_INFO" and "id" in args:
-			kp, ki, kd = self.get_pid_coeficients()
-			info = {
-				"comfort": self.get_comfort_temperature(),
-				"eco": self.get_eco_temperature(),
-				"current": self.get_current_temperature(),
-				"desired": self.get_desired_temperature(),
-				"mode": self.get_temperature_mode(),
-				"heating_mode": self.get_heating_mode(),
-				"hysteresis_band": self.get_hysteresis_band(),
-				"kp": kp,
-				"ki": ki,
-				"kd": kd
-			}
-			if "day" in args and "hour" in args:
-				info["hourly"] = self.get_hourly_temperature(int(args["day"]), int(args["hour"]))
-			return (info, 200), 1
-
-		elif message_type == "GET_TMP" and "id" in args:
-			temperatures = {
-				"comfort": self.get_comfort_temperature(),
-				"eco": self.get_eco_temperature(),
-				"current": self.get_current_temperature(),
-				"desired": self.get_desired_temperature(),
-			}
-			if "day" in args and "hour" in args:
-				temperatures["hourly"] = self.get_hourly_temperature(int(args["day"]), int(args["hour"]))
-			return (temperatures, 200), 1
-
-		elif message_type == "GET_CURTMP" and "id" in args:
-			cur_tmp = self.get_current_temperature()
-			return (str(cur_tmp), 200), 1
-
-		elif message_type == "GET_DESTMP" and "id" in args:
-			des_tmp = self.get_desired_temperature()
-			return (str(des_tmp), 200), 1
-
-		elif message_type == "GET_ECOTMP" and "id" in args:
-			des_tmp = self.get_eco_temperature()
-			return (str(des_tmp), 200), 1
-
-		elif message_type == "GET_COMTMP" and "id" in args:
-			des_tmp = self.get_comfort_temperature()
-			return (str(des_tmp), 200), 1
-
-		elif message_type == "GET_TIMETMP" and "id" in args:
-			time_tmp = self.get_hourly_temperature(int(args["day"]), int(args["hour"]))
-			return (str(time_tmp), 200), 1
-
-		elif message_type == "GET_TMPMODE" and "id" in args:
-			mode = self.get_temperature_mode()
-			return (str(mode), 200), 1
-
-		elif message_type == "GET_HEATMODE" and "id" in args:
-			alg = self.get_heating_mode()
-			hyst = self.get_hysteresis_band()
-			coeficients = self.get_pid_coeficients()
-			h_dict = {"heating_mode": alg, "hysteresis_band": hyst,
-				"kp": coeficients[0], "ki": coeficients[1], "kd": coeficients[2]}
-			print(h_dict)
-			return (h_dict, 200), 1
-
-		elif message_type == "GET_ALIAS" and "id" in args:
-			alias = self.get_alias()
-			return (alias, 200), 1
-
-		elif message_type == "GET_CURTMPS" and "id" in args:
-			tmps, times = self.get_current_temperatures()
-			d = {}
-			for x, y in zip(tmps, times):
-				d[str(int(y))] = x
-			return (d, 200), 1
-
-		elif message_type == "PUT_INFO":
-			valve1 = json.loads(_json)
-			if str(self.get_id()) in valve1:
-				valve1 = valve1[str(self.get_id())]
-			else:
+		body = None
+		if message_type[:3] == "PUT":
+			body = message.json
+			if body is None:
 				return ('', 404), -1
-
-			if "comfort" in valve1:
-				self.set_comfort_temperature(valve1["comfort"])
-			if "eco" in valve1:
-				self.set_eco_temperature(valve1["eco"])
-			if "mode" in valve1:
-				mode = get_mode_index(valve1["mode"])
-				self.set_temperature_mode(mode)
-			if "heating_mode" in valve1:
-				self.set_heating_mode(valve1["heating_mode"])
-			if "hysteresis_band" in valve1:
-				self.set_hysteresis_band(valve1["hysteresis_band"])
-			if "kp" in valve1 and "ki" in valve1 and "kd" in valve1:
-				self.set_pid_coeficients(valve1["kp"], valve1["ki"], valve1["kd"])
-
-			return (' ', 200), 3
-
-		elif message_type == "PUT_CURTMP" and "id" in args:
-			_json = json.loads(_json)
-			self.set_current_temperature(_json)
-			return (' ', 200), 2
-
-		elif message_type == "PUT_ECOTMP" and "id" in args:
-			_json = json.loads(_json)
-			self.set_eco_temperature(_json)
-			return (' ', 200), 2
-
-		elif message_type == "PUT_COMTMP" and "id" in args:
-			_json = json.loads(_json)
-			self.set_comfort_temperature(_json)
-			return (' ', 200), 2
-
-		elif message_type == "PUT_TIMETMP" and "id" in args:
-			_json = json.loads(_json)
-			self.set_hourly_temperature(int(args["day"]), int(args["hour"]), float(_json))
-			return (' ', 200), 2
-
-		elif message_type == "PUT_TMPMODE" and "id" in args:
-			_json = json.loads(_json)
-			self.set_temperature_mode(int(_json))
-			return (' ', 200), 2
-
-		elif message_type == "PUT_HEATMODE" and "id" in args:
-			_json = json.loads(_json)
-			self.set_heating_mode(int(_json))
-			return (' ', 200), 2
-
-		elif message_type == "PUT_ALIAS" and "id" in args:
-			_json = json.loads(_json)
-			self.set_alias(_json)
-			return (' ', 200), 2
\ No newline at end of file
+			body = load_json(body)
+			if message_type in ThermostaticValve.keyed:
+				if not isinstance(body, dict):
+					return ('', 400), -1
+				body = ThermostaticValve.get_part(body, self)
+				if body is None:
+					return (), -1
+		with self.lock:
+			return handler(self, args, body)
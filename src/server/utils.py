@@ -1,14 +1,97 @@
 #!/usr/bin/env python3
 
+import json
+import math
+import time
+
+try:
+	import fcntl
+except ImportError:
+	fcntl = None
+
+
+class Message:
+	"""
+	A class used to represent already decoded request delivered to valves.
+
+	...
+
+	Attributes
+	----------
+	args : dict
+		request arguments
+	json : object
+		decoded request body
+	"""
+	def __init__(self, args, json=None):
+		self.args = args
+		self.json = json
+
+
 #returns True if value is float, otherwise returns False
 def is_float(value):
 	try:
 		float(value)
 		return True
-	except ValueError:
+	except (TypeError, ValueError):
 		return False
 
 
+def to_number(value, low=-math.inf, high=math.inf):
+	"""
+	Converts value to finite float in range.
+
+	Parameters
+	----------
+	value : object
+		value to be converted, number or string with number
+	low : float
+		the lowest allowed value
+	high : float
+		the highest allowed value
+	Returns
+	-------
+	float
+		the number, None if value is not finite number in range
+	"""
+	if isinstance(value, bool) or not is_float(value):
+		return None
+	value = float(value)
+	if not (math.isfinite(value) and low <= value <= high):
+		return None
+	return value
+
+
+def lock_process(path):
+	"""
+	Takes exclusive lock of file, so that valves are served by only one process. The lock is held
+	 until the returned file is closed or the process exits. Without fcntl (on Windows) nothing is locked.
+
+	Parameters
+	----------
+	path : str
+		path to lock file, created if it does not exist
+	Returns
+	-------
+	file
+		the locked file, None if locking is not available
+	Raises
+	------
+	RuntimeError
+		if other process holds the lock
+	"""
+	if fcntl is None:
+		return None
+	f = open(path, "a")
+	try:
+		fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+	except OSError:
+		f.close()
+		raise RuntimeError("{} is locked, valves are kept in memory of one process, "
+			"so the server must run as one process with more threads".format(path))
+	return f
+
+
 #returns index of day of the week
 def get_day_index(day):
 	"""
@@ -33,6 +116,39 @@ def get_day_index(day):
 			'sun': 6,
 		}[day.lower()]
 
+# current (day, hour) slot of week program and time when the slot ends
+schedule_slot = ((0, 0), 0.0)
+
+def get_schedule_slot():
+	"""
+	Returns current slot of week program. The slot is computed once per hour and shared by all valves.
+
+	Returns
+	-------
+	tuple
+		index of the day of the week starting with monday and hour of the day
+	"""
+	global schedule_slot
+	slot, end = schedule_slot
+	now = time.time()
+	if now >= end:
+		t = time.localtime(now)
+		slot = (t.tm_wday, t.tm_hour)
+		schedule_slot = (slot, now - now % 60 - t.tm_min * 60 + 3600)
+	return slot
+
+def get_schedule_slot_end():
+	"""
+	Returns time when current slot of week program ends.
+
+	Returns
+	-------
+	float
+		time of the next hour (time.time)
+	"""
+	get_schedule_slot()
+	return schedule_slot[1]
+
 def get_mode_index(mode):
 	"""
 	Performs change of the temperature name to its index.
@@ -50,4 +166,21 @@ def get_mode_index(mode):
 			'comfort': 0,
 			'eco': 1,
 			'hourly': 2,
-		}[mode.lower()]
\ No newline at end of file
+		}[mode.lower()]
+
+def load_json(body):
+	"""
+	Decodes request body, that can be sent as json encoded string, to python object.
+
+	Parameters
+	----------
+	body : object
+		request body as received by server
+	Returns
+	-------
+	object
+		decoded request body
+	"""
+	if isinstance(body, (str, bytes)):
+		return json.loads(body)
+	return body
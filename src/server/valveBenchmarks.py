@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+
+"""
+Microbenchmarks of in-process hot path of the server (without HTTP).
+
+Measures ValveKeeper.fire and ThermostaticValve.update for every request type, PUT_INFO settings push to all valves,
+ set_current_temperature with full history and get_desired_temperature in hourly mode,
+ for given numbers of subscribed valves, and memory of server per valve with full history.
+ Results (nanoseconds per operation, bytes per valve for memory) are written as json,
+ so they can be compared between commits.
+
+Usage:
+	python3 valveBenchmarks.py --sizes 10 1000 100000 --output bench.json
+	python3 valveBenchmarks.py --compare bench.json
+"""
+
+import argparse
+import json
+import time
+import tracemalloc
+
+from server import Server
+from utils import Message
+
+# request types with arguments and body of benchmarked request
+messages = {
+	"GET_INFO": ({}, None),
+	"GET_TMP": ({}, None),
+	"GET_CURTMP": ({}, None),
+	"GET_DESTMP": ({}, None),
+	"GET_ECOTMP": ({}, None),
+	"GET_COMTMP": ({}, None),
+	"GET_TIMETMP": ({"day": "2", "hour": "8"}, None),
+	"GET_WEEKTMP": ({}, None),
+	"GET_TMPMODE": ({}, None),
+	"GET_HEATMODE": ({}, None),
+	"GET_ALIAS": ({}, None),
+	"GET_CURTMPS": ({}, None),
+	"PUT_CURTMP": ({}, "20.5"),
+	"PUT_ECOTMP": ({}, "17.5"),
+	"PUT_COMTMP": ({}, "21.5"),
+	"PUT_TIMETMP": ({"day": "2", "hour": "8"}, "20.0"),
+	"PUT_WEEKTMP": ({"day": "2"}, json.dumps([20.0] * 24)),
+	"PUT_TMPMODE": ({}, "0"),
+	"PUT_HEATMODE": ({}, "0"),
+	"PUT_ALIAS": ({}, '"room"'),
+}
+
+
+def measure(function, target=0.2, repeat=3):
+	"""
+	Measures time of one call of function.
+
+	Parameters
+	----------
+	function : function
+		measured function without arguments
+	target : float
+		approximate time of one measurement in seconds
+	repeat : int
+		number of measurements, the fastest is taken
+	Returns
+	-------
+	float
+		time of one call in nanoseconds
+	"""
+	number = 1
+	while True:
+		start = time.perf_counter()
+		for i in range(number):
+			function()
+		elapsed = time.perf_counter() - start
+		if elapsed >= target / 10 or number >= 1 << 24:
+			break
+		number *= 10
+
+	best = elapsed / number
+	for r in range(repeat):
+		start = time.perf_counter()
+		for i in range(number):
+			function()
+		best = min(best, (time.perf_counter() - start) / number)
+	return best * 1e9
+
+
+def create_server(size, history_size):
+	"""
+	Creates server with subscribed valves that have full temperature history.
+
+	Parameters
+	----------
+	size : int
+		number of subscribed valves
+	history_size : int
+		number of measured temperatures kept for each valve
+	Returns
+	-------
+	Server
+		the server
+	"""
+	server = Server(history_size)
+	for i in range(size):
+		server.post_new_valve(Message({"id": str(i)}))
+	for valve in server.keeper.get_valves():
+		for i in range(history_size):
+			valve.set_current_temperature(20.0 + i % 3)
+	return server
+
+
+def benchmark(sizes, history_size=40, target=0.2):
+	"""
+	Runs all benchmarks for every number of subscribed valves.
+
+	Parameters
+	----------
+	sizes : list
+		numbers of subscribed valves
+	history_size : int
+		number of measured temperatures kept for each valve
+	target : float
+		approximate time of one measurement in seconds
+	Returns
+	-------
+	dict
+		nanoseconds per operation (bytes per valve for memory) keyed by name of benchmark and number of valves
+	"""
+	results = {}
+	for size in sizes:
+		tracemalloc.start()
+		server = create_server(size, history_size)
+		results["memory/valve/{}".format(size)] = tracemalloc.get_traced_memory()[0] / size
+		tracemalloc.stop()
+		keeper = server.keeper
+		ident = str(size // 2)
+		valve = keeper.get_valves().get(ident)
+
+		for message_type, (args, body) in messages.items():
+			message = Message(dict(args, id=ident), body)
+			results["fire/{}/{}".format(message_type, size)] = measure(
+				lambda: keeper.fire(message, message_type), target)
+			results["update/{}/{}".format(message_type, size)] = measure(
+				lambda: valve.update(message, message_type), target)
+
+		info = Message({}, json.dumps({str(i): {"comfort": 21.0, "eco": 17.0} for i in range(size)}))
+		results["put_info/all/{}".format(size)] = measure(lambda: server.put_info(info), target)
+
+		results["set_current_temperature/full/{}".format(size)] = measure(
+			lambda: valve.set_current_temperature(20.5), target)
+
+		valve.set_temperature_mode(2)
+		results["get_desired_temperature/hourly/{}".format(size)] = measure(valve.get_desired_temperature, target)
+
+		for v in list(keeper.get_valves()):
+			keeper.unsubscribe(v.get_id())
+	return results
+
+
+def unit_of(name):
+	"""
+	Returns unit of benchmark result.
+
+	Parameters
+	----------
+	name : str
+		name of benchmark
+	Returns
+	-------
+	str
+		B for memory, ns for time
+	"""
+	return "B" if name.startswith("memory/") else "ns"
+
+
+def compare(old, new):
+	"""
+	Prints comparison of two benchmark results.
+
+	Parameters
+	----------
+	old : dict
+		previous results
+	new : dict
+		current results
+	"""
+	for name in new:
+		unit = unit_of(name)
+		if name in old:
+			print("{:<45} {:>12.0f} {:<2} {:>12.0f} {:<2} {:>+8.1f} %".format(
+				name, old[name], unit, new[name], unit, (new[name] - old[name]) / old[name] * 100))
+		else:
+			print("{:<45} {:>15} {:>12.0f} {}".format(name, "-", new[name], unit))
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Microbenchmarks of ValveKeeper.fire and ThermostaticValve.")
+	parser.add_argument("--sizes", type=int, nargs="+", default=[10, 1000, 100000], help="numbers of valves")
+	parser.add_argument("--history-size", type=int, default=40, help="number of kept temperatures of valve")
+	parser.add_argument("--target", type=float, default=0.2, help="approximate time of one measurement in seconds")
+	parser.add_argument("--output", help="file the results are written to as json")
+	parser.add_argument("--compare", help="json file with previous results to compare with")
+	a = parser.parse_args()
+
+	results = benchmark(a.sizes, a.history_size, a.target)
+	if a.compare:
+		with open(a.compare) as f:
+			compare(json.load(f), results)
+	else:
+		for name, ns in results.items():
+			print("{:<45} {:>12.0f} {}".format(name, ns, unit_of(name)))
+	if a.output:
+		with open(a.output, "w") as f:
+			json.dump(results, f, indent=2, sort_keys=True)
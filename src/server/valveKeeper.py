@@ -1,6 +1,10 @@
 #!/usr/bin/env python3
 
+import threading
+
 from thermostaticValve import ThermostaticValve
+from valveRegistry import ValveRegistry
+from utils import load_json
 
 class ValveKeeper:
 	"""
@@ -10,42 +14,83 @@ class ValveKeeper:
 
 	Attributes
 	----------
-	valves : set
-		set of ThermostaticValve that are subscribed
+	valves : ValveRegistry
+		registry of ThermostaticValve that are subscribed
+	lock : threading.RLock
+		lock serializing changes of subscribed valves, requests are handled under lock of the valve
+	observers : list
+		objects informed about subscribed, unsubscribed and changed valves
+	metrics : Metrics
+		metrics recording number of valves requests are delivered to, None if not recorded
 	"""
-	def __init__(self):
-		self.valves = set()
+	def __init__(self, metrics=None):
+		self.valves = ValveRegistry()
+		self.lock = threading.RLock()
+		self.observers = []
+		self.metrics = metrics
+
+	def observe(self, observer):
+		"""
+		Adds observer informed about changes of subscribed valves. Observer implements methods
+		 valve_added(valve), valves_added(valves), valve_removed(valve) and
+		 valve_changed(valve, message_type, args, body).
+
+		Parameters
+		----------
+		observer : object
+			the observer
+		"""
+		self.observers.append(observer)
 
 	def subscribe(self, s):
 		"""
-		Adds ThermostaticValve to set of valves.
+		Adds ThermostaticValve to registry of valves.
 
 		Parameters
 		----------
 		s : ThermostaticValve
 			object that wants to subscribe to this publisher
 		"""
-		self.valves.add(s)
+		with self.lock:
+			self.valves.add(s)
+			for observer in self.observers:
+				observer.valve_added(s)
+
+	def subscribe_many(self, valves):
+		"""
+		Adds batch of ThermostaticValve objects to registry of valves in one pass.
+
+		Parameters
+		----------
+		valves : list
+			objects that want to subscribe to this publisher
+		"""
+		with self.lock:
+			self.valves.update(valves)
+			for observer in self.observers:
+				observer.valves_added(valves)
 
 	def unsubscribe(self, s):
 		"""
-		Removes ThermostaticValve from set and deletes it from system.
+		Removes ThermostaticValve from registry and deletes it from system.
 
 		Parameters
 		----------
-		s : ThermostaticValve
-			unsibscribing object
+		s : int
+			identifier of unsibscribing object
 		"""
-		for v in self.valves:
-			if v.get_id() == s:
-				self.valves.discard(v)
+		with self.lock:
+			valve = self.valves.remove(s)
+			if valve is not None:
 				ThermostaticValve.remove_valve(s)
-				del v
-				break
+				for observer in self.observers:
+					observer.valve_removed(valve)
 
 	def fire(self, message, message_type):
 		"""
-		Updates subscribers with new request.
+		Updates subscribers with new request. Request with identifier is delivered only
+		 to the valve it targets, request without identifier is broadcasted to all subscribers.
+		 Keyed request body is decoded once and each valve gets only its own part of it.
 
 		Parameters
 		----------
@@ -58,27 +103,164 @@ class ValveKeeper:
 		tuple
 			returns tuple containing message body and http response code
 		"""
+		handler = ThermostaticValve.get_handler(message_type)
+		if handler is None:
+			return ('', 404)
+
+		args = message.args
+		if "id" in args:
+			valve = self.valves.get(args["id"])
+			targets = () if valve is None else (valve,)
+		elif message_type in ThermostaticValve.broadcasts:
+			targets = self.valves
+		else:
+			targets = ()
+		if self.metrics is not None:
+			self.metrics.observe_fanout(len(targets))
+
+		body = None
+		changes = message_type[:3] == "PUT"
+		if changes and targets:
+			body = message.json
+			if body is None:
+				return ('', 404)
+			try:
+				body = load_json(body)
+			except ValueError:
+				return ('', 400)
+		keyed = changes and message_type in ThermostaticValve.keyed
+		if keyed and targets and not isinstance(body, dict):
+			return ('', 400)
+
 		delivered = False
-		for v in self.valves:
-			response, return_code = v.update(message, message_type)
+		invalid = False
+		for v in targets:
+			part = body
+			if keyed:
+				part = ThermostaticValve.get_part(body, v)
+				if part is None:
+					continue
+			with v.lock:
+				response, return_code = handler(v, args, part)
+				if changes and response[1] == 200:
+					self.changed(v, message_type, args, part)
 			if return_code == 1 or return_code == 2:
 				return response
 			elif return_code == 3:
 				delivered = True
+			elif response[1] == 400:
+				invalid = True
 
+		if invalid:
+			return ('', 400)
 		if delivered:
 			return ('', 200)
 
 		return ('', 404)
 
-	def get_valves(self):
+	def fire_each(self, messages, message_type):
 		"""
-		Returns list with subcribed ThermostaticValve objects.
+		Updates subscribers with their own part of already decoded request. When some part
+		 is not valid the response is 400, valid parts are still delivered.
 
+		Parameters
+		----------
+		messages : dict
+			decoded request bodies keyed by identifier of valve they are meant for
+		message_type : string
+			identifier of request type
+		Returns
+		-------
+		tuple
+			returns tuple containing message body and http response code
+		"""
+		handler = ThermostaticValve.get_handler(message_type)
+		if handler is None:
+			return ('', 404)
+		if self.metrics is not None:
+			self.metrics.observe_fanout(len(messages))
+
+		delivered = False
+		invalid = False
+		for identifier, body in messages.items():
+			v = self.valves.get(identifier)
+			if v is None:
+				continue
+			with v.lock:
+				response, return_code = handler(v, {"id": identifier}, body)
+				if return_code == 3:
+					self.changed(v, message_type, {"id": identifier}, body)
+			if return_code == 3:
+				delivered = True
+			elif response[1] == 400:
+				invalid = True
+
+		if invalid:
+			return ('', 400)
+		if delivered:
+			return ('', 200)
+
+		return ('', 404)
+
+	def fire_many(self, messages, message_type):
+		"""
+		Updates subscribers with batch of already decoded requests in one pass.
+
+		Parameters
+		----------
+		messages : list
+			list of (arguments, body) tuples, arguments contain identifier of valve request is meant for
+		message_type : string
+			identifier of request type
 		Returns
 		-------
 		list
-			returns list containing subcribed ThermostaticValve objects
+			returns list of tuples containing message body and http response code for each request
+		"""
+		handler = ThermostaticValve.get_handler(message_type)
+		changes = message_type[:3] == "PUT"
+		if self.metrics is not None:
+			self.metrics.observe_fanout(len(messages))
+		responses = []
+		for args, body in messages:
+			v = self.valves.get(args["id"])
+			if handler is None or v is None:
+				responses.append(('', 404))
+				continue
+			with v.lock:
+				response, return_code = handler(v, args, body)
+				if changes and response[1] == 200:
+					self.changed(v, message_type, args, body)
+			responses.append(response)
+
+		return responses
+
+	def changed(self, valve, message_type, args, body):
+		"""
+		Informs observers about valve changed by request, called under lock of the valve.
+
+		Parameters
+		----------
+		valve : ThermostaticValve
+			changed valve
+		message_type : string
+			identifier of request type
+		args : dict
+			request arguments
+		body : object
+			decoded request body
+		"""
+		for observer in self.observers:
+			observer.valve_changed(valve, message_type, args, body)
+
+	def get_valves(self):
+		"""
+		Returns registry with subcribed ThermostaticValve objects.
+
+		Returns
+		-------
+		ValveRegistry
+			returns registry containing subcribed ThermostaticValve objects
 		"""
 		return self.valves
 
@@ -95,8 +277,4 @@ class ValveKeeper:
 		boolean
 			returns True if valve is subscribed, False otherwise
 		"""
-		for v in self.valves:
-			if int(v.get_id()) == int(id):
-				return True
-
-		return False
\ No newline at end of file
+		return id in self.valves
\ No newline at end of file
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+
+
+class ValveRegistry:
+	"""
+	A class used to represent identifier indexed collection of ThermostaticValve objects.
+
+	Lookups are lock free and iteration goes over snapshot of valves, so valves can be added
+	 and removed by other threads while registry is iterated.
+
+	...
+
+	Attributes
+	----------
+	valves : dict
+		valves keyed by their integer identifier
+	generation : int
+		number of changes of registry, increased whenever valve is added or removed
+	"""
+	def __init__(self):
+		self.valves = {}
+		self.generation = 0
+
+	@staticmethod
+	def key(identifier):
+		"""
+		Converts valve identifier to registry key.
+
+		Parameters
+		----------
+		identifier : int or str
+			valves identifier
+		Returns
+		-------
+		int
+			integer key of valve, None if identifier is not integer
+		"""
+		if isinstance(identifier, int):
+			return identifier
+		if isinstance(identifier, str) and identifier.isdigit():
+			return int(identifier)
+		return None
+
+	def add(self, valve):
+		"""
+		Adds valve to registry, valve with same identifier is replaced.
+
+		Parameters
+		----------
+		valve : ThermostaticValve
+			valve to be added
+		"""
+		self.valves[ValveRegistry.key(valve.get_id())] = valve
+		self.generation += 1
+
+	def update(self, valves):
+		"""
+		Adds all valves to registry at once, valves with same identifier are replaced.
+
+		Parameters
+		----------
+		valves : list
+			valves to be added
+		"""
+		key = ValveRegistry.key
+		self.valves.update((key(v.get_id()), v) for v in valves)
+		self.generation += 1
+
+	def get(self, identifier):
+		"""
+		Returns valve according to identifier.
+
+		Parameters
+		----------
+		identifier : int or str
+			valves identifier
+		Returns
+		-------
+		ThermostaticValve
+			valve with matching identifier, None if there is no such valve
+		"""
+		return self.valves.get(ValveRegistry.key(identifier))
+
+	def remove(self, identifier):
+		"""
+		Removes valve specified by identifier from registry.
+
+		Parameters
+		----------
+		identifier : int or str
+			valves identifier
+		Returns
+		-------
+		ThermostaticValve
+			removed valve, None if there was no such valve
+		"""
+		valve = self.valves.pop(ValveRegistry.key(identifier), None)
+		if valve is not None:
+			self.generation += 1
+		return valve
+
+	def ids(self):
+		"""
+		Returns identifiers of all valves in registry.
+
+		Returns
+		-------
+		list
+			valves identifiers
+		"""
+		return [v.get_id() for v in self.valves.values()]
+
+	def __contains__(self, identifier):
+		return ValveRegistry.key(identifier) in self.valves
+
+	def __iter__(self):
+		return iter(list(self.valves.values()))
+
+	def __len__(self):
+		return len(self.valves)
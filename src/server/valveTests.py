@@ -2,8 +2,34 @@
 
 import unittest
 from thermostaticValve import ThermostaticValve
+from valveKeeper import ValveKeeper
+from server import Server
+from temperatureStore import TemperatureStore
+from fleetView import FleetView
+from simulator import simulate
+from valveBenchmarks import benchmark
+from metrics import Counter, Histogram, Metrics
+from logs import setup_logging, stop_logging
+from snapshot import write_snapshot, restore, SnapshotWriter
+from journal import Journal
+from persistence import recover
+from settings import Settings
+from utils import lock_process
+import asyncio
+import io
+import json
+import logging
+import os
+import tempfile
+import threading
 import time
 
+try:
+	from aiohttp.test_utils import TestClient, TestServer
+	import asyncApi
+except ImportError:
+	asyncApi = None
+
 class TestValveMethods(unittest.TestCase):
 
 	def test_constructor(self):
@@ -18,7 +44,8 @@ class TestValveMethods(unittest.TestCase):
 		self.assertEqual(t.get_alias(), '')
 		self.assertEqual(t.get_hysteresis_band(), 0.1)
 		self.assertEqual(t.get_pid_coeficients(), (30.0, 0.0, 0.0))
-		self.assertEqual([t], ThermostaticValve.valves)
+		self.assertEqual([t], list(ThermostaticValve.valves))
+		self.assertFalse(hasattr(t, "__dict__"))
 
 		ThermostaticValve.remove_valve(1)
 
@@ -46,6 +73,23 @@ class TestValveMethods(unittest.TestCase):
 		with self.assertRaises(IndexError):
 			t.get_hourly_temperature(0, 24)
 
+		program = t.get_week_program()
+		self.assertEqual(len(program), 7)
+		self.assertEqual(program[5][10], 20.0)
+		self.assertEqual(program[0][:7], [17.0] * 6 + [21.0])
+		self.assertEqual(ThermostaticValve(9).get_hourly_temperature(5, 10), 21.0)
+		ThermostaticValve.remove_valve(9)
+		t.set_week_program([19.0] * 24, 6)
+		self.assertEqual(t.get_week_program(6), [19.0] * 24)
+		t.set_week_program([[18.0] * 24] * 7)
+		self.assertEqual(t.get_hourly_temperature(6, 23), 18.0)
+		t.set_week_program([22.0] * 168)
+		self.assertEqual(t.get_week_program(0), [22.0] * 24)
+		with self.assertRaises(ValueError):
+			t.set_week_program([22.0] * 23, 0)
+		with self.assertRaises(IndexError):
+			t.get_week_program(7)
+
 		t.set_current_temperature(20.0)
 		self.assertEqual(t.get_current_temperature(), 20.0)
 		self.assertEqual(t.get_current_temperatures()[0], [20.0])
@@ -60,6 +104,14 @@ class TestValveMethods(unittest.TestCase):
 		self.assertEqual(t.get_desired_temperature(), 18.0)
 		self.assertEqual(t.get_temperature_mode(), 1)
 
+		t.set_temperature_mode(2)
+		day, hour = time.localtime().tm_wday, time.localtime().tm_hour
+		self.assertEqual(t.get_desired_temperature(), t.get_hourly_temperature(day, hour))
+		t.set_hourly_temperature(day, hour, 23.5)
+		self.assertEqual(t.get_desired_temperature(), 23.5)
+		t.set_temperature_mode(1)
+		self.assertEqual(t.get_desired_temperature(), 18.0)
+
 		t.set_hysteresis_band(0.5)
 		self.assertEqual(t.get_hysteresis_band(), 0.5)
 		t.set_pid_coeficients(1.0, 1.1, 1.2)
@@ -72,15 +124,676 @@ class TestValveMethods(unittest.TestCase):
 
 		ThermostaticValve.remove_valve(2)
 
+	def test_temperature_history(self):
+		t = ThermostaticValve(4, 3)
+		for tmp in [20.0, "20.5", 21.0, 21.5, 22.0]:
+			t.set_current_temperature(tmp)
+		tmps, times = t.get_current_temperatures()
+		self.assertEqual(tmps, [21.0, 21.5, 22.0])
+		self.assertEqual(len(times), 3)
+		self.assertEqual(times, sorted(times))
+		self.assertEqual(t.get_current_temperature(), 22.0)
+
+		ThermostaticValve.remove_valve(4)
+
+	def test_temperature_store(self):
+		directory = tempfile.mkdtemp()
+		store = TemperatureStore(os.path.join(directory, "history.db"))
+		t = ThermostaticValve(5, 2, store)
+		for tmp in [20.0, 20.5, 21.0]:
+			t.set_current_temperature(tmp)
+		store.append(6, time.time(), 25.0)
+		self.assertTrue(store.flush(5))
+
+		history = t.get_temperature_history()
+		self.assertEqual([h[1] for h in history], [20.0, 20.5, 21.0])
+		self.assertEqual(t.get_temperature_history(history[1][0], history[1][0]), [history[1]])
+		self.assertEqual(t.get_temperature_history(end=history[0][0] - 1), [])
+
+		store.append(6, time.time(), object())
+		with self.assertLogs("dtrv.store", logging.ERROR):
+			self.assertFalse(store.flush(5))
+		t.set_current_temperature(21.5)
+		self.assertTrue(store.flush(5))
+		history = t.get_temperature_history()
+		self.assertEqual(len(history), 4)
+
+		reader = threading.Thread(target=store.query, args=(5,))
+		reader.start()
+		reader.join()
+		self.assertEqual(len(store.connections), 3)
+		store.close()
+		self.assertEqual(store.connections, [])
+		self.assertFalse(store.flush())
+		store = TemperatureStore(os.path.join(directory, "history.db"))
+		self.assertEqual(store.query(5), history)
+		store.close()
+
+		ThermostaticValve.remove_valve(5)
+
+	def test_snapshot(self):
+		path = os.path.join(tempfile.mkdtemp(), "valves.snapshot")
+		server = Server(3)
+		for ident in ("20", "21"):
+			server.post_new_valve(Request({"id": ident}))
+		t = ThermostaticValve.get_valve(20)
+		t.set_alias("obývák")
+		t.set_eco_temperature(16.5)
+		t.set_temperature_mode(2)
+		t.set_hourly_temperature(1, 7, 23.0)
+		t.set_heating_mode(1)
+		t.set_pid_coeficients(20.0, 0.1, 0.5)
+		for i, tmp in enumerate([20.0, 20.5, 21.0, 19.5]):
+			t.set_current_temperature(tmp, 1000.0 + 60 * i)
+			t.control_valve()
+		self.assertEqual(write_snapshot(path, server.keeper.get_valves(), 7), 2)
+		for ident in ("20", "21"):
+			server.keeper.unsubscribe(ident)
+
+		server = Server(2)
+		self.assertEqual(restore(server, path), 7)
+		self.assertEqual(sorted(server.keeper.get_valves().ids()), ["20", "21"])
+		r = ThermostaticValve.get_valve(20)
+		self.assertEqual(r.get_alias(), "obývák")
+		self.assertEqual(r.get_eco_temperature(), 16.5)
+		self.assertEqual(r.get_week_program(), t.get_week_program())
+		self.assertEqual((r.get_temperature_mode(), r.get_heating_mode()), (2, 1))
+		self.assertEqual(r.get_pid_coeficients(), (20.0, 0.1, 0.5))
+		self.assertEqual(r.get_current_temperature(), 19.5)
+		self.assertEqual(r.get_current_temperatures(), ([21.0, 19.5], [1120.0, 1180.0]))
+		self.assertEqual(r.get_valve_position(), t.get_valve_position())
+		self.assertEqual(r.control.integral, t.control.integral)
+		u = ThermostaticValve.get_valve(21)
+		self.assertEqual((u.get_current_temperature(), u.control, u.get_alias()), (None, None, ""))
+		self.assertEqual(u.get_hourly_temperature(1, 7), 21.0)
+		if server.fleet is not None:
+			self.assertEqual(sorted(server.fleet.rows), [20, 21])
+		for ident in ("20", "21"):
+			server.keeper.unsubscribe(ident)
+		self.assertEqual(restore(server, path + ".missing"), 0)
+		with open(path, "rb") as f:
+			data = f.read()
+		with open(path + ".truncated", "wb") as f:
+			f.write(data[:100])
+		self.assertRaises(ValueError, restore, server, path + ".truncated")
+
+		server.post_new_valve(Request({"id": "20"}))
+		ThermostaticValve.get_valve(20).mode = 300
+		writer = SnapshotWriter(path, server.keeper, 0.01)
+		with self.assertLogs("dtrv.snapshot", logging.ERROR):
+			writer.start()
+			time.sleep(0.1)
+		ThermostaticValve.get_valve(20).mode = 1
+		time.sleep(0.1)
+		self.assertTrue(writer.thread.is_alive())
+		writer.stopped.set()
+		writer.thread.join()
+		server.keeper.unsubscribe("20")
+		self.assertEqual(restore(server, path), 0)
+		self.assertEqual(ThermostaticValve.get_valve(20).get_temperature_mode(), 1)
+		server.keeper.unsubscribe("20")
+
+	def test_journal(self):
+		path = os.path.join(tempfile.mkdtemp(), "valves.journal")
+		server = Server()
+		journal = Journal(path, 60.0)
+		journal.replay(server)
+		server.keeper.observe(journal)
+		journal.start()
+		for ident in ("22", "23"):
+			server.post_new_valve(Request({"id": ident}))
+		server.put_alias(Request({"id": "22"}, '"hall"'))
+		server.put_info(Request({}, json.dumps({"23": {"comfort": 23.5, "kp": 12.0}})))
+		server.put_current_temperature(Request({"id": "22"}, "20.0"))
+		server.delete_valve(Request({"id": "23"}))
+		self.assertEqual(journal.sequence, 5)
+		journal.flush()
+		with open(path, "ab") as f:
+			f.write(b"\x06\x00\x00")
+		journal.close()
+		server.keeper.unsubscribe("22")
+
+		server = Server()
+		journal = Journal(path, 60.0)
+		self.assertEqual(journal.replay(server), 5)
+		self.assertEqual(server.keeper.get_valves().ids(), ["22"])
+		self.assertEqual(ThermostaticValve.get_valve(22).get_alias(), "hall")
+		self.assertEqual(ThermostaticValve.get_valve(22).get_current_temperature(), None)
+		server.keeper.observe(journal)
+		journal.start()
+		server.post_new_valve(Request({"id": "24"}))
+		server.put_info(Request({}, json.dumps({"24": {"comfort": 23.5, "kp": 12.0, "ki": 0.1, "kd": 0.0}})))
+		self.assertEqual(journal.sequence, 7)
+		journal.compact(6)
+		journal.close()
+		self.assertEqual([change[0] for change in journal.read()[0]], [7])
+		for ident in ("22", "24"):
+			server.keeper.unsubscribe(ident)
+
+		server = Server()
+		server.post_new_valve(Request({"id": "24"}))
+		journal = Journal(path)
+		self.assertEqual(journal.replay(server, 6), 1)
+		journal.close()
+		self.assertEqual(ThermostaticValve.get_valve(24).get_comfort_temperature(), 23.5)
+		self.assertEqual(ThermostaticValve.get_valve(24).get_pid_coeficients(), (12.0, 0.1, 0.0))
+		server.keeper.unsubscribe("24")
+
+	def test_recover(self):
+		directory = tempfile.mkdtemp()
+		settings = Settings({"DTRV_SNAPSHOT": os.path.join(directory, "valves.snapshot"),
+			"DTRV_JOURNAL": os.path.join(directory, "valves.journal"), "DTRV_JOURNAL_INTERVAL": "60000"})
+		server = Server()
+		close = recover(server, settings)
+		server.post_new_valve(Request({"id": "25"}))
+		server.put_alias(Request({"id": "25"}, '"attic"'))
+		ThermostaticValve.get_valve(25).mode = 300
+		with self.assertLogs("dtrv.snapshot", logging.ERROR):
+			close()
+		self.assertEqual([change[1] for change in Journal(settings.journal).read()[0]], ["POST", "PUT_ALIAS"])
+		server.keeper.unsubscribe("25")
+
+	def test_lock_process(self):
+		path = os.path.join(tempfile.mkdtemp(), "dtrv.lock")
+		lock = lock_process(path)
+		with self.assertRaises(RuntimeError):
+			lock_process(path)
+		lock.close()
+		lock_process(path).close()
+		self.assertEqual(Settings({"DTRV_LOCK": path}).lock, path)
+
+	def test_control(self):
+		t = ThermostaticValve(7)
+		self.assertEqual(t.get_valve_position(), 0)
+		for tmp, position in [(21.0, 0), (20.9, 30), (21.05, 30), (21.1, 0), (21.0, 0)]:
+			t.set_current_temperature(tmp)
+			self.assertEqual(t.control_valve(), position)
+
+		t.set_heating_mode(1)
+		t.set_pid_coeficients(10.0, 1.0, 2.0)
+		t.set_current_temperature(20.0, 1000.0)
+		self.assertEqual(t.control_valve(), 10)
+		t.set_current_temperature(20.5, 1180.0)
+		self.assertEqual(t.control_valve(), 6)
+		self.assertAlmostEqual(t.control.integral, 1.5)
+		t.set_current_temperature(18.0, 1360.0)
+		self.assertEqual(t.control_valve(), 30)
+		self.assertEqual(t.get_valve_position(), 30)
+		t.set_current_temperature(18.0, 4960.0)
+		self.assertEqual(t.control_valve(), 30)
+		self.assertEqual(t.control.integral, 30.0)
+		t.set_current_temperature(21.5, 5140.0)
+		self.assertEqual(t.control_valve(), 21)
+		for body in ('"nan"', '"inf"', '"x"'):
+			self.assertEqual(t.update(Request({"id": "7"}, body), "PUT_CURTMP"), (('', 400), 2))
+		self.assertEqual(t.get_current_temperature(), 21.5)
+		t.set_current_temperature(float("nan"), 5320.0)
+		self.assertEqual(t.control_valve(), 21)
+		self.assertEqual((t.control.temperature, t.control.time), (21.5, 5140.0))
+		self.assertEqual(t.update(Request({"id": "7"}, '"21.0"'), "PUT_CURTMP")[0][1], 200)
+
+		ThermostaticValve.remove_valve(7)
+
+	def test_simulator(self):
+		for mode in (0, 1):
+			result = simulate(mode, rooms=3, hours=12, kp=20.0, ki=0.05)
+			self.assertEqual(result["rooms"], 3)
+			self.assertGreater(result["actuations"], 0)
+			self.assertGreaterEqual(result["overshoot"], 0.0)
+		self.assertEqual(len(ThermostaticValve.valves), 0)
+
+	def test_benchmarks(self):
+		results = benchmark([10], target=0.001)
+		self.assertIn("fire/GET_DESTMP/10", results)
+		self.assertIn("update/PUT_CURTMP/10", results)
+		self.assertIn("put_info/all/10", results)
+		self.assertTrue(all(ns > 0 for ns in results.values()))
+		self.assertEqual(len(ThermostaticValve.valves), 0)
+
 	def test_static_methods(self):
 		t = ThermostaticValve(3)
 		self.assertEqual(ThermostaticValve.get_valve(3), t)
 		self.assertEqual(ThermostaticValve.get_ids(), [3])
-		self.assertEqual(ThermostaticValve.valves, [t])
+		self.assertEqual(ThermostaticValve.get_valve("3"), t)
+		self.assertEqual(ThermostaticValve.get_valve("x"), None)
+		self.assertEqual(list(ThermostaticValve.valves), [t])
 		ThermostaticValve.add_valve(t)
-		self.assertEqual(ThermostaticValve.valves, [t, t])
-		ThermostaticValve.valves.remove(t)
-		self.assertEqual(ThermostaticValve.valves, [t])
+		self.assertEqual(list(ThermostaticValve.valves), [t])
+		self.assertTrue(ThermostaticValve.remove_valve(3))
+		self.assertFalse(ThermostaticValve.remove_valve(3))
+		self.assertEqual(list(ThermostaticValve.valves), [])
+
+
+class Request:
+	def __init__(self, args, json=None):
+		self.args = args
+		self.json = json
+
+
+class TestKeeperMethods(unittest.TestCase):
+
+	def setUp(self):
+		self.keeper = ValveKeeper()
+		for i in range(10, 13):
+			self.keeper.subscribe(ThermostaticValve(str(i)))
+
+	def tearDown(self):
+		for i in range(10, 13):
+			self.keeper.unsubscribe(str(i))
+
+	def test_fire(self):
+		self.assertTrue(self.keeper.valve_exists("11"))
+		self.assertFalse(self.keeper.valve_exists("42"))
+		self.assertEqual(self.keeper.fire(Request({"id": "11"}, '"20.5"'), "PUT_CURTMP"), ('30', 200))
+		self.assertEqual(self.keeper.fire(Request({"id": "11"}), "GET_CURTMP"), ('20.5', 200))
+		self.assertEqual(self.keeper.fire(Request({"id": "12"}), "GET_CURTMP"), ('None', 200))
+		self.assertEqual(self.keeper.fire(Request({"id": "42"}), "GET_CURTMP"), ('', 404))
+
+	def test_update(self):
+		t = ThermostaticValve.get_valve(10)
+		self.assertEqual(t.update(Request({"id": "10"}, '"room"'), "PUT_ALIAS"), ((' ', 200), 2))
+		self.assertEqual(t.update(Request({"id": "10"}), "GET_ALIAS"), (("room", 200), 1))
+		self.assertEqual(t.update(Request({"id": "11"}), "GET_ALIAS"), ((), -1))
+		self.assertEqual(t.update(Request({}), "GET_ALIAS"), ((), -1))
+		self.assertEqual(t.update(Request({"id": "10"}), "PUT_ALIAS"), (('', 404), -1))
+		self.assertEqual(t.update(Request({"id": "10"}), "GET_UNKNOWN"), (('', 404), -1))
+		self.assertEqual(self.keeper.fire(Request({"id": "10"}), "GET_UNKNOWN"), ('', 404))
+		self.assertEqual(self.keeper.fire(Request({}), "GET_ALIAS"), ('', 404))
+		self.assertEqual(self.keeper.fire(Request({"id": "10"}, '{'), "PUT_ALIAS"), ('', 400))
+
+	def test_validation(self):
+		invalid = [("PUT_ECOTMP", '"warm"'), ("PUT_ECOTMP", "NaN"), ("PUT_COMTMP", "45.0"), ("PUT_COMTMP", "true"),
+			("PUT_TMPMODE", "300"), ("PUT_TMPMODE", "-1"), ("PUT_TMPMODE", "1.5"), ("PUT_HEATMODE", "2"),
+			("PUT_ALIAS", "42"), ("PUT_ALIAS", json.dumps("x" * 300))]
+		for message_type, body in invalid:
+			self.assertEqual(self.keeper.fire(Request({"id": "10"}, body), message_type), ('', 400), message_type + body)
+		self.assertEqual(self.keeper.fire(Request({"id": "10", "day": "0", "hour": "0"}, "Infinity"), "PUT_TIMETMP"),
+			('', 400))
+		self.assertEqual(self.keeper.fire(Request({"id": "10"}, [[21.0] * 24] * 6 + [["x"] * 24]), "PUT_WEEKTMP"),
+			('', 400))
+		t = ThermostaticValve.get_valve(10)
+		for info in ({"eco": "warm", "comfort": 22.0}, {"mode": "away"}, {"mode": 1}, {"heating_mode": 3},
+				{"hysteresis_band": -1.0}, {"kp": 10.0, "ki": "x", "kd": 0.0}):
+			self.assertEqual(ThermostaticValve.get_handler("PUT_INFO")(t, {}, info), (('', 400), -1))
+
+		self.assertEqual((t.get_eco_temperature(), t.get_comfort_temperature(), t.get_alias()), (17.0, 21.0, ''))
+		self.assertEqual((t.get_temperature_mode(), t.get_heating_mode(), t.get_hysteresis_band()), (0, 0, 0.1))
+		self.assertEqual(t.get_hourly_temperature(0, 0), 17.0)
+
+		self.assertEqual(self.keeper.fire(Request({"id": "10"}, '"16.5"'), "PUT_ECOTMP"), (' ', 200))
+		self.assertEqual(self.keeper.fire(Request({"id": "10"}, "2"), "PUT_TMPMODE"), (' ', 200))
+		self.assertEqual((t.get_eco_temperature(), t.get_temperature_mode()), (16.5, 2))
+
+	def test_concurrent_requests(self):
+		t = ThermostaticValve(20, 4000)
+		self.keeper.subscribe(t)
+		errors = []
+
+		def ingest():
+			try:
+				for i in range(500):
+					self.keeper.fire(Request({"id": "20"}, "20.0"), "PUT_CURTMP")
+					self.keeper.fire(Request({}, json.dumps({"20": {"eco": 16.0 + i % 5}})), "PUT_INFO")
+			except Exception as e:
+				errors.append(e)
+
+		def churn():
+			try:
+				for i in range(500):
+					self.keeper.subscribe(ThermostaticValve(100 + i))
+					self.keeper.unsubscribe(100 + i)
+			except Exception as e:
+				errors.append(e)
+
+		threads = [threading.Thread(target=ingest) for i in range(4)] + [threading.Thread(target=churn)]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+
+		self.assertEqual(errors, [])
+		self.assertEqual(len(t.get_current_temperatures()[0]), 2000)
+		self.assertEqual(t.get_eco_temperature(), 20.0)
+		self.keeper.unsubscribe(20)
+
+	@unittest.skipUnless(FleetView.available(), "numpy is not installed")
+	def test_fleet_view(self):
+		fleet = FleetView(2)
+		self.keeper.observe(fleet)
+		for i in range(10, 13):
+			fleet.valve_added(ThermostaticValve.get_valve(i))
+		self.keeper.subscribe(ThermostaticValve("13"))
+
+		self.keeper.fire(Request({"id": "10"}, "18.0"), "PUT_CURTMP")
+		self.keeper.fire(Request({"id": "11"}, "21.5"), "PUT_CURTMP")
+		self.keeper.fire(Request({"id": "13"}, "20.0"), "PUT_CURTMP")
+		self.assertEqual(sorted(fleet.below_desired(0.5)), ["10", "13"])
+		self.assertEqual(fleet.below_desired(2.0), ["10"])
+
+		self.keeper.fire(Request({"id": "13"}, "1"), "PUT_TMPMODE")
+		self.assertEqual(fleet.below_desired(0.5), ["10"])
+		self.assertEqual(fleet.mean_by("current"), {0: 19.75, 1: 20.0})
+		self.assertEqual(fleet.mean_by("desired", "heating_mode"), {0: 20.0})
+
+		self.keeper.unsubscribe("13")
+		self.assertEqual(fleet.mean_by("current"), {0: 19.75})
+		with self.assertRaises(KeyError):
+			fleet.mean_by("alias")
+
+		valve = self.keeper.get_valves().get(11)
+		valve.current_temperature = "x"
+		fleet.valve_changed(valve, "PUT_CURTMP", {}, None)
+		with self.assertLogs("dtrv.fleet", logging.WARNING):
+			self.assertEqual(fleet.mean_by("current"), {0: 18.0})
+		self.assertEqual(fleet.below_desired(0.5), ["10"])
+		self.keeper.fire(Request({"id": "11"}, "20.0"), "PUT_CURTMP")
+		self.assertEqual(fleet.mean_by("current"), {0: 19.0})
+
+	def test_poll_control(self):
+		server = Server()
+		server.keeper = self.keeper
+		info, code = server.poll_control(Request({"id": "10"}))
+		self.assertEqual((info["desired"], info["mode"], code), (21.0, 0, 200))
+		self.assertEqual(server.poll_control(Request({"id": "10", "version": info["version"], "timeout": "0.05"})),
+			('', 304))
+		ThermostaticValve.get_valve(10).set_eco_temperature(16.0)
+		self.assertEqual(server.poll_control(Request({"id": "10", "version": info["version"], "timeout": "0"})),
+			('', 304))
+
+		timer = threading.Timer(0.05, ThermostaticValve.get_valve(10).set_temperature_mode, (1,))
+		timer.start()
+		start = time.monotonic()
+		changed, code = server.poll_control(Request({"id": "10", "version": info["version"], "timeout": "5"}))
+		self.assertLess(time.monotonic() - start, 1.0)
+		self.assertEqual((changed["desired"], changed["mode"], code), (16.0, 1, 200))
+		self.assertNotEqual(changed["version"], info["version"])
+		self.assertIsNone(ThermostaticValve.get_valve(10).watchers)
+		self.assertEqual(server.poll_control(Request({"id": "42"})), ('', 404))
+		self.assertEqual(server.poll_control(Request({"id": "10", "timeout": "x"})), ('', 400))
+		self.assertEqual(server.poll_control(Request({"id": "10", "timeout": "nan"})), ('', 400))
+		self.assertEqual(server.poll_control(Request({"id": "10", "timeout": "inf"})), ('', 400))
+
+		server = Server(pollers=1)
+		server.keeper = self.keeper
+		version = server.poll_control(Request({"id": "10"}))[0]["version"]
+		waiting = threading.Thread(target=server.poll_control, args=(Request({"id": "10", "version": version, "timeout": "0.3"}),))
+		waiting.start()
+		time.sleep(0.05)
+		other = server.poll_control(Request({"id": "11"}))[0]["version"]
+		self.assertEqual(server.poll_control(Request({"id": "11", "version": other, "timeout": "5"})), ('', 503))
+		self.assertEqual(server.poll_control(Request({"id": "10", "version": version, "timeout": "0"})), ('', 304))
+		self.assertEqual(server.poll_control(Request({"id": "11", "version": "x", "timeout": "5"}))[1], 200)
+		waiting.join()
+		self.assertEqual(server.poll_control(Request({"id": "11", "version": other, "timeout": "0.01"})), ('', 304))
+
+	def test_unsubscribe(self):
+		self.keeper.unsubscribe("11")
+		self.assertFalse(self.keeper.valve_exists("11"))
+		self.assertEqual(ThermostaticValve.get_valve("11"), None)
+		self.assertEqual(self.keeper.fire(Request({"id": "11"}), "GET_CURTMP"), ('', 404))
+		self.assertEqual(sorted(self.keeper.get_valves().ids()), ["10", "12"])
+
+	def test_put_info(self):
+		server = Server()
+		server.keeper = self.keeper
+		info = {"10": {"comfort": 22.0, "mode": "eco"}, "12": {"eco": 19.0}, "42": {"eco": 16.0}}
+		self.assertEqual(server.put_info(Request({}, json.dumps(info))), ('', 200))
+		self.assertEqual(ThermostaticValve.get_valve(10).get_comfort_temperature(), 22.0)
+		self.assertEqual(ThermostaticValve.get_valve(10).get_temperature_mode(), 1)
+		self.assertEqual(ThermostaticValve.get_valve(11).get_eco_temperature(), 17.0)
+		self.assertEqual(ThermostaticValve.get_valve(12).get_eco_temperature(), 19.0)
+
+		info = {"10": {"eco": 18.0}, "12": {"eco": 18.0}}
+		self.assertEqual(server.put_info(Request({"id": "12"}, json.dumps(info))), ('', 200))
+		self.assertEqual(ThermostaticValve.get_valve(10).get_eco_temperature(), 17.0)
+		self.assertEqual(ThermostaticValve.get_valve(12).get_eco_temperature(), 18.0)
+
+		self.assertEqual(server.put_info(Request({"id": "11"}, json.dumps(info))), ('', 404))
+		self.assertEqual(server.put_info(Request({}, "[1, 2]")), ('', 400))
+		self.assertEqual(server.put_info(Request({}, "{")), ('', 400))
+		self.assertEqual(server.put_info(Request({}, '{"10": {"mode": "away"}}')), ('', 400))
+		self.assertEqual(server.put_info(Request({}, '{"10": {"comfort": "abc"}, "11": {"eco": 18.0}}')), ('', 400))
+		self.assertEqual(self.keeper.get_valves().get(11).get_eco_temperature(), 18.0)
+		self.assertEqual(self.keeper.fire(Request({}, '{"10": {"comfort": "abc"}, "11": {"eco": 18.5}}'), "PUT_INFO"),
+			('', 400))
+
+		changes = []
+		class Observer:
+			def valve_removed(self, valve):
+				pass
+			def valve_changed(self, valve, message_type, args, body):
+				changes.append((valve.get_id(), body))
+		self.keeper.observe(Observer())
+		self.assertEqual(self.keeper.fire(Request({}, '{"10": {"eco": 15.0}}'), "PUT_INFO"), ('', 200))
+		self.assertEqual(ThermostaticValve.get_valve(10).get_eco_temperature(), 15.0)
+		self.assertEqual(self.keeper.fire(Request({"id": "10"}, '{"10": {"eco": 16.0}}'), "PUT_INFO"), ('', 200))
+		self.assertEqual(ThermostaticValve.get_valve(10).get_eco_temperature(), 16.0)
+		self.assertEqual(self.keeper.fire(Request({"id": "11"}, '{"10": {"eco": 16.0}}'), "PUT_INFO"), ('', 404))
+		self.assertEqual(self.keeper.fire(Request({}, '{"10": {"eco": "warm"}}'), "PUT_INFO"), ('', 400))
+		self.assertEqual(self.keeper.fire(Request({}, '[1]'), "PUT_INFO"), ('', 400))
+		self.assertEqual(changes, [("10", {"eco": 15.0}), ("10", {"eco": 16.0})])
+
+		t = ThermostaticValve.get_valve(12)
+		self.assertEqual(t.update(Request({}, '{"12": {"comfort": 23.0}}'), "PUT_INFO"), ((' ', 200), 3))
+		self.assertEqual(t.update(Request({}, '{"10": {"comfort": 24.0}}'), "PUT_INFO"), ((), -1))
+		self.assertEqual(t.get_comfort_temperature(), 23.0)
+
+	def test_get_infos(self):
+		server = Server()
+		server.keeper = self.keeper
+		ThermostaticValve.get_valve(11).set_alias("kitchen")
+		infos, code = server.get_infos(Request({}))
+		self.assertEqual(code, 200)
+		self.assertEqual(sorted(infos), ["10", "11", "12"])
+		self.assertEqual(infos["11"]["alias"], "kitchen")
+		self.assertEqual(infos["10"]["comfort"], 21.0)
+
+		infos, code = server.get_infos(Request({"ids": "11,42", "day": "0", "hour": "8"}))
+		self.assertEqual(list(infos), ["11"])
+		self.assertEqual(infos["11"]["hourly"], 21.0)
+		for day, hour in (("x", "8"), ("7", "8"), ("0", "24"), ("0", "-1")):
+			self.assertEqual(server.get_infos(Request({"day": day, "hour": hour})), ('', 400))
+			self.assertEqual(server.get_info(Request({"id": "11", "day": day, "hour": hour})), ('', 400))
+
+	def test_put_current_temperatures(self):
+		server = Server()
+		server.keeper = self.keeper
+		readings = {"10": 20.5, "11": "x", "42": 20.0}
+		self.assertEqual(server.put_current_temperatures(Request({}, json.dumps(readings))),
+			({"10": 200, "11": 400, "42": 404}, 200))
+		self.assertEqual(ThermostaticValve.get_valve(10).get_current_temperature(), 20.5)
+
+		readings = [[12, 1000.0, 19.0], [12, None, 19.5], [10, "x", 21.0]]
+		self.assertEqual(server.put_current_temperatures(Request({}, readings)), ({"12": 200, "10": 400}, 200))
+		tmps, times = ThermostaticValve.get_valve(12).get_current_temperatures()
+		self.assertEqual(tmps, [19.0, 19.5])
+		self.assertEqual(times[0], 1000.0)
+		self.assertEqual(server.put_current_temperatures(Request({}, [[12, 19.0]])), ('', 400))
+		self.assertEqual(server.put_current_temperatures(Request({}, '[["12", NaN, 20.0], ["11", 1000.0, Infinity]]')),
+			({"12": 400, "11": 400}, 200))
+		self.assertEqual(self.keeper.fire(Request({"id": "12", "time": "inf"}, "20.0"), "PUT_CURTMP"), ('', 400))
+		self.assertEqual(self.keeper.get_valves().get(12).get_current_temperatures(), (tmps, times))
+		self.assertEqual(server.get_current_temperatures(Request({"id": "12"}))[1], 200)
+
+	def test_events(self):
+		server = Server()
+		events = []
+		server.events.subscribe(events.append)
+		server.post_new_valve(Request({"id": "20"}))
+		server.put_current_temperatures(Request({}, [[20, 1000.0, 19.5]]))
+		server.put_eco_temperature(Request({"id": "20"}, "16.0"))
+		server.get_info(Request({"id": "20"}))
+		server.events.unsubscribe(events.append)
+		server.put_comfort_temperature(Request({"id": "20"}, "22.0"))
+		server.delete_valve(Request({"id": "20"}))
+
+		events = [json.loads(e) for e in events]
+		self.assertEqual([e["type"] for e in events], ["added", "temperature", "changed"])
+		self.assertEqual(events[0], {"type": "added", "id": "20"})
+		self.assertEqual((events[1]["id"], events[1]["current"], events[1]["time"], events[1]["desired"]),
+			("20", 19.5, 1000.0, 21.0))
+		self.assertEqual((events[2]["request"], events[2]["settings"]["eco"], events[2]["settings"]["comfort"]),
+			("PUT_ECOTMP", 16.0, 21.0))
+		self.assertEqual(server.events.subscribers, ())
+
+	def test_etag(self):
+		server = Server()
+		server.keeper = self.keeper
+		ids = server.get_etag("get_info", Request({}))
+		info = server.get_etag("get_info", Request({"id": "10"}))
+		self.assertEqual(server.get_etag("get_current_temperatures", Request({"id": "10"})), info)
+		self.assertEqual(server.get_etag("get_info", Request({"id": "10"})), info)
+		self.assertIsNone(server.get_etag("get_alias", Request({"id": "10"})))
+		self.assertIsNone(server.get_etag("get_current_temperatures", Request({})))
+		self.assertIsNone(server.get_etag("get_info", Request({"id": "42"})))
+
+		server.put_current_temperature(Request({"id": "10"}, "20.5"))
+		current = server.get_etag("get_info", Request({"id": "10"}))
+		self.assertNotEqual(current, info)
+		ThermostaticValve.get_valve(10).set_alias("kitchen")
+		self.assertNotEqual(server.get_etag("get_info", Request({"id": "10"})), current)
+		self.assertEqual(server.get_etag("get_info", Request({"id": "11"})), info)
+		ThermostaticValve.get_valve(11).set_temperature_mode(2)
+		self.assertEqual(server.get_etag("get_desired_temperature", Request({"id": "11"})).count("-"), 3)
+
+		self.assertEqual(server.get_etag("get_info", Request({})), ids)
+		self.keeper.unsubscribe("12")
+		self.assertNotEqual(server.get_etag("get_info", Request({})), ids)
+		self.assertNotEqual(Server().get_etag("get_info", Request({})), ids)
+
+	def test_metrics(self):
+		counter = Counter()
+		histogram = Histogram((1, 10))
+		def count():
+			for i in range(1000):
+				counter.inc()
+				histogram.observe(i % 20)
+		threads = [threading.Thread(target=count) for i in range(4)]
+		for t in threads:
+			t.start()
+		for t in threads:
+			t.join()
+		count()
+		self.assertEqual(counter.value(), 5000)
+		self.assertEqual(histogram.collect(), [500, 2250, 2250, 5 * sum(range(20)) * 50])
+		self.assertEqual(histogram.render("h")[:3], ['h_bucket{le="1"} 500', 'h_bucket{le="10"} 2750',
+			'h_bucket{le="+Inf"} 5000'])
+
+		metrics = Metrics()
+		self.keeper.metrics = metrics
+		ThermostaticValve.get_valve(10).set_current_temperature(20.0)
+		self.keeper.fire(Request({"id": "10"}), "GET_CURTMP")
+		self.assertEqual(self.keeper.fire(Request({}, '{"10": {"eco": 16.0}, "12": {"comfort": 22.0}}'), "PUT_INFO"),
+			('', 200))
+		self.assertEqual(ThermostaticValve.get_valve(10).get_eco_temperature(), 16.0)
+		self.assertEqual(ThermostaticValve.get_valve(12).get_comfort_temperature(), 22.0)
+		metrics.observe_request("GET", "/device/radiator-valve", 200, 0.002)
+		text = metrics.render(self.keeper.get_valves())
+		self.assertIn('valve_requests_total{method="GET",route="/device/radiator-valve",code="200"} 1', text)
+		self.assertIn('valve_request_duration_seconds_bucket{method="GET",route="/device/radiator-valve",le="0.0025"} 1', text)
+		self.assertIn('valve_fire_fanout_bucket{le="1"} 1', text)
+		self.assertIn("valve_fire_fanout_sum 4", text)
+		self.assertIn("valve_registry_size 3", text)
+		self.assertIn("valve_history_fill_ratio {}".format(1 / 40 / 3), text)
+
+	def test_logging(self):
+		stream = io.StringIO()
+		setup_logging("DEBUG", 0.0, stream)
+		server = Server()
+		server.post_new_valve(Request({"id": "13"}))
+		logging.getLogger("dtrv.api").debug("request", extra={"sampled": True})
+		stop_logging()
+		records = [json.loads(line) for line in stream.getvalue().splitlines()]
+		self.assertEqual(len(records), 1)
+		self.assertEqual(records[0]["message"], "valve created")
+		self.assertEqual(records[0]["level"], "INFO")
+		self.assertEqual(records[0]["valve"], "13")
+		server.keeper.unsubscribe("13")
+
+
+@unittest.skipIf(asyncApi is None, "aiohttp is not installed")
+class TestAsyncApi(unittest.IsolatedAsyncioTestCase):
+
+	async def asyncSetUp(self):
+		self.app = asyncApi.create_app(Settings({"DTRV_LOG_LEVEL": "WARNING"}))
+		self.client = TestClient(TestServer(self.app))
+		await self.client.start_server()
+		response = await self.client.post("/device/radiator-valve", params={"id": "30"})
+		self.assertEqual(response.status, 201)
+
+	async def asyncTearDown(self):
+		await self.client.delete("/device/radiator-valve", params={"id": "30"})
+		await self.client.close()
+		stop_logging()
+
+	async def test_info(self):
+		response = await self.client.put("/device/radiator-valve", json={"30": {"eco": 16.0, "mode": "eco"}})
+		self.assertEqual(response.status, 200)
+		response = await self.client.put("/device/radiator-valve", json={"30": {"eco": "x"}})
+		self.assertEqual(response.status, 400)
+		response = await self.client.put("/device/radiator-valve", data="{", headers={"Content-Type": "application/json"})
+		self.assertEqual(response.status, 400)
+		response = await self.client.get("/device/radiator-valve", params={"id": "30"})
+		self.assertEqual(response.status, 200)
+		info = await response.json()
+		self.assertEqual((info["eco"], info["mode"]), (16.0, 1))
+		response = await self.client.get("/device/radiator-valve", params={"id": "31"})
+		self.assertEqual(response.status, 404)
+
+	async def test_current_temperature(self):
+		path = "/device/radiator-valve/temperature/current"
+		response = await self.client.put(path, params={"id": "30"}, json="20.5")
+		self.assertEqual(response.status, 200)
+		response = await self.client.put(path, params={"id": "30"}, json="x")
+		self.assertEqual(response.status, 400)
+		response = await self.client.get(path, params={"id": "30"})
+		self.assertEqual((response.status, await response.json()), (200, "20.5"))
+
+	async def test_hourly_temperature(self):
+		path = "/device/radiator-valve/temperature/hourly"
+		response = await self.client.put(path, params={"id": "30", "day": "2", "hour": "7"}, json=23.0)
+		self.assertEqual(response.status, 200)
+		response = await self.client.get(path, params={"id": "30", "day": "2", "hour": "7"})
+		self.assertEqual((response.status, await response.json()), (200, "23.0"))
+		for params in ({"id": "30"}, {"id": "30", "day": "2"}, {"id": "30", "day": "x", "hour": "7"},
+				{"id": "30", "day": "9", "hour": "7"}):
+			response = await self.client.get(path, params=params)
+			self.assertEqual(response.status, 400)
+			response = await self.client.put(path, params=params, json=23.0)
+			self.assertEqual(response.status, 400)
+
+	async def test_poll_control(self):
+		path = "/device/radiator-valve/control"
+		response = await self.client.get(path, params={"id": "30"})
+		self.assertEqual(response.status, 200)
+		version = (await response.json())["version"]
+		response = await self.client.get(path, params={"id": "30", "version": version, "timeout": "0.05"})
+		self.assertEqual(response.status, 304)
+		for timeout in ("x", "nan", "inf"):
+			response = await self.client.get(path, params={"id": "30", "version": version, "timeout": timeout})
+			self.assertEqual(response.status, 400)
+
+		poll = asyncio.ensure_future(self.client.get(path, params={"id": "30", "version": version, "timeout": "5"}))
+		await asyncio.sleep(0.05)
+		self.assertFalse(poll.done())
+		response = await self.client.put("/device/radiator-valve/mode/temperature", params={"id": "30"}, json=1)
+		self.assertEqual(response.status, 200)
+		response = await asyncio.wait_for(poll, 1.0)
+		self.assertEqual(response.status, 200)
+		self.assertEqual((await response.json())["mode"], 1)
+
+	async def test_etag(self):
+		path = "/device/radiator-valve"
+		response = await self.client.get(path, params={"id": "30"})
+		self.assertEqual(response.status, 200)
+		etag = response.headers["ETag"]
+		response = await self.client.get(path, params={"id": "30"}, headers={"If-None-Match": etag})
+		self.assertEqual(response.status, 304)
+		response = await self.client.put("/device/radiator-valve/temperature/eco", params={"id": "30"}, json=16.0)
+		self.assertEqual(response.status, 200)
+		response = await self.client.get(path, params={"id": "30"}, headers={"If-None-Match": etag})
+		self.assertEqual(response.status, 200)
+		self.assertNotEqual(response.headers["ETag"], etag)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,19 @@
+#!/usr/bin/env python3
+
+"""
+WSGI entry point for production servers.
+
+Valves are kept in memory of the serving process, so the server has to run as one process
+ with many threads, e.g.:
+	gunicorn --workers 1 --threads 8 --bind 0.0.0.0:60000 wsgi:app
+	waitress-serve --threads 8 --port 60000 wsgi:app
+The serving process locks file DTRV_LOCK, so every other worker process fails to start.
+"""
+
+from api import create_app
+from settings import Settings
+from utils import lock_process
+
+settings = Settings()
+lock = lock_process(settings.lock)
+app = create_app(settings)